@@ -2,6 +2,7 @@ import streamlit as st
 import keiba_bot
 from datetime import datetime, timedelta, timezone
 import re
+import time
 
 # ==================================================
 # ページ設定
@@ -73,6 +74,58 @@ selected_race_labels = st.sidebar.multiselect(
 
 target_races = {int(r.replace("R", "")) for r in selected_race_labels}
 
+workers = st.sidebar.slider(
+    "同時に処理するレース数",
+    min_value=1,
+    max_value=6,
+    value=1,
+    help="2以上にすると複数レースを並列で処理し、終わったレースから表示します（ブラウザを並列数ぶん起動します）",
+)
+
+dify_concurrency = st.sidebar.slider(
+    "AI分析の同時実行数",
+    min_value=0,
+    max_value=8,
+    value=0,
+    help="1以上にすると、データ取得を進めながらAI分析を同時に流します（混雑時は自動で本数を下げます）。0は従来どおり",
+)
+
+http_fetch = st.sidebar.checkbox(
+    "高速取得（ログイン後はブラウザを使わない）",
+    value=False,
+    help="競馬ブックの談話/調教/日程ページを、ログイン cookie を引き継いだ HTTP で取得します",
+)
+
+pooled = st.sidebar.checkbox(
+    "ブラウザを常駐させる（起動・ログイン待ちを省略）",
+    value=False,
+    help="ログイン済みの Chrome を実行をまたいで使い回します（2回目以降の実行が速くなります）",
+)
+
+refresh = st.sidebar.checkbox(
+    "キャッシュを使わず取り直す",
+    value=False,
+    help="OFF の時は、少し前に取得した出馬表/談話/調教/日程ページを再利用します",
+)
+
+incremental = st.sidebar.checkbox(
+    "変更があったレースだけAIを再実行",
+    value=False,
+    help="出馬表（乗り替わり）・談話・調教が前回実行時と同じレースは、前回の回答をそのまま表示します",
+)
+
+dify_refresh = st.sidebar.checkbox(
+    "AIの回答を作り直す",
+    value=False,
+    help="OFF の時は、入力データが前回と全く同じレースは保存済みの回答をすぐ表示します",
+)
+
+show_timings = st.sidebar.checkbox(
+    "処理時間の内訳を表示",
+    value=False,
+    help="ログイン/日程/出馬表/談話/調教/AI（最初の応答まで・全体）/保存 にかかった時間をレースごとに表示します",
+)
+
 st.sidebar.caption("※ 設定後、下の「分析スタート」で実行します。")
 
 # ==================================================
@@ -99,33 +152,83 @@ if run:
         st.warning("レースを選んでください")
     else:
         live = st.container()        # レースごとの表示をここに積む
-        result_blocks = []           # 最後にまとめコピー用
+        result_blocks = []           # 最後にまとめコピー用 (race_num, block)
+        run_report = {}              # race_num -> {"reused", "changes", ...}
+        timings = keiba_bot.RunTimings()
+
+        if pooled and not http_fetch:
+            # 並列数ぶんのブラウザを裏で起動＆ログインしておく（日程の取得と重ねる）
+            keiba_bot.get_driver_pool().warm_async(workers)
+
+        slots = {}                   # race_num -> st.empty()（最初のイベントが届いた順に積む）
+        streams = {}                 # race_num -> 途中までの回答
+        last_paint = {}              # race_num -> 最後に途中経過を描いた時刻（描きすぎ防止）
+
+        def _slot(race_num):
+            if race_num not in slots:
+                with live:
+                    slots[race_num] = st.empty()
+            return slots[race_num]
 
-        with st.spinner("分析中...（終わったレースから順に表示します）"):
+        with st.spinner("分析中...（AIの回答は届いた分から表示します）"):
             try:
-                # 逐次取得：race_num, block_text
-                for race_num, block in keiba_bot.run_races_iter(
+                # 逐次取得：("chunk", race_num, 回答の増分) / ("done", race_num, block_text)
+                for kind, race_num, payload in keiba_bot.run_races_events(
                     year=str(year),
                     month=str(month),
                     day=str(day),
                     place_code=str(place_code),
                     target_races=target_races,
-                    ui=False
+                    ui=False,
+                    workers=workers,
+                    fetch_mode="http" if http_fetch else "browser",
+                    pooled=pooled,
+                    refresh=refresh,
+                    dify_refresh=dify_refresh,
+                    incremental=incremental,
+                    report=run_report,
+                    dify_concurrency=dify_concurrency,
+                    timings=timings,
                 ):
-                    block = _normalize_text(block)
-                    result_blocks.append(block)
+                    if kind == "chunk":
+                        streams[race_num] = streams.get(race_num, "") + payload
+                        now = time.monotonic()
+                        if now - last_paint.get(race_num, 0.0) < 0.15:
+                            continue
+                        last_paint[race_num] = now
+                        with _slot(race_num).container():
+                            with st.expander(f"{place_name} {race_num}R（AI分析中…）", expanded=True):
+                                st.markdown(streams[race_num] + "▌")
+                        continue
 
-                    # レースごとに表示
-                    with live:
-                        with st.expander(f"{place_name} {race_num}R", expanded=False):
+                    block = _normalize_text(payload)
+                    result_blocks.append((race_num, block))
+                    streams.pop(race_num, None)
+
+                    info = run_report.get(race_num) or {}
+                    label = f"{place_name} {race_num}R"
+                    if info.get("reused"):
+                        label += "（変更なし・前回の回答）"
+
+                    # レースごとに表示（途中経過を完成版で置き換える）
+                    with _slot(race_num).container():
+                        with st.expander(label, expanded=False):
+                            if info.get("changes"):
+                                st.caption("🔁 前回からの変更: " + " / ".join(keiba_bot.format_race_changes(info["changes"])))
+                            if info.get("prompt_tokens"):
+                                st.caption("🧮 " + keiba_bot.format_prompt_stats(info["prompt_tokens"]))
+                            if show_timings:
+                                spans = timings.race(race_num)
+                                st.caption("⏱ " + " / ".join(f"{k} {v:.2f}s" for k, v in spans.items()))
                             st.text_area(
                                 f"{place_name} {race_num}R",
                                 block,
                                 height=280
                             )
 
-                # まとめ保存（コピー用）
-                result_text = _normalize_text("\n\n".join(result_blocks))
+                # まとめ保存（コピー用）：並列時は終わった順に届くのでレース番号順に戻す
+                result_blocks.sort(key=lambda x: x[0])
+                result_text = _normalize_text("\n\n".join(b for _, b in result_blocks))
                 st.session_state["result_text"] = result_text
                 st.session_state["last_meta"] = {
                     "year": year, "month": month, "day": day,
@@ -135,6 +238,23 @@ if run:
 
                 st.success(f"{place_name}：{', '.join(f'{r}R' for r in sorted(target_races))} の分析が完了しました！")
 
+                cache_stats = keiba_bot.get_html_cache().stats()
+                dify_stats = keiba_bot.get_dify_cache().stats()
+                st.caption(
+                    f"HTMLキャッシュ: hit {cache_stats['hit']} / miss {cache_stats['miss']}　"
+                    f"AI回答キャッシュ: hit {dify_stats['hit']} / miss {dify_stats['miss']}"
+                )
+                circuit = keiba_bot.circuit_report()
+                if circuit:
+                    st.warning("🔌 失敗が続いたため送信を止めた接続先があります\n\n" + "\n".join(f"- {line}" for line in circuit))
+
+                # 処理時間の内訳は下の結果表示で出す（ダウンロードボタンを押した後の再実行でも残るように）
+                st.session_state["last_timings"] = {
+                    "summary": timings.summary(),
+                    "jsonl": timings.to_jsonl(),
+                    "file_name": f"timings_{year}{month}{day}_{place_code}.jsonl",
+                }
+
             except Exception as e:
                 st.error(f"エラーが発生しました: {e}")
 
@@ -163,3 +283,18 @@ if "result_text" in st.session_state and st.session_state["result_text"]:
             st.session_state["result_text"],
             height=360
         )
+
+    last_timings = st.session_state.get("last_timings")
+    if show_timings and last_timings:
+        summary = last_timings["summary"]
+        with st.expander(f"⏱ 処理時間の内訳（全体 {summary['wall_s']:.1f}s）", expanded=False):
+            st.table([
+                {"段階": stage, "回数": v["count"], "合計(s)": v["total_s"], "平均(s)": v["mean_s"], "最大(s)": v["max_s"]}
+                for stage, v in summary["stages"].items()
+            ])
+            st.download_button(
+                "JSON Lines でダウンロード",
+                last_timings["jsonl"],
+                file_name=last_timings["file_name"],
+                mime="application/jsonl",
+            )
@@ -0,0 +1,7 @@
+"""
+オフラインのベンチマーク一式（本番サイトに繋がずに取得〜パース〜Dify〜保存までを計る）
+
+    python -m bench.run                      合成フィクスチャで計測 → .cache/bench/*.json
+    python -m bench.run --fixtures DIR       録ったフィクスチャで計測
+    python -m bench.record DIR --date ...    本番から1開催分を録る（ログイン cookie が必要）
+"""
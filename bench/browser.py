@@ -0,0 +1,152 @@
+"""
+Chrome のプロファイル（BROWSER_PROFILE）ごとに、競馬ブックのページ1枚の読み込み時間を比べる
+
+    python -m bench.browser
+    python -m bench.browser --profiles full,fast --races 6 --rounds 5 --asset-latency 0.2
+
+スタブサーバ（画像/CSS/フォント/外部タグつきの合成ページ）を Chrome で開き、
+  1) 起動（build_driver + 保存済み cookie の投入）にかかった時間
+  2) ページ種別（日程 / 談話 / 調教）ごとの1ページあたり時間（BrowserPageSource._get_html_live）
+  3) 読みに行った画像/CSS/フォント/外部タグの数
+  4) 取れた内容（パース結果）が1つ目のプロファイルと同じか
+を計り、JSON に保存する。Chrome と chromedriver が要る。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fixtures import synthetic  # noqa: E402
+from bench.run import _git_rev, prepare_workdir  # noqa: E402
+from bench.stub_server import StubLatency, StubServer  # noqa: E402
+
+
+def _targets(kb, fx) -> list[tuple[str, str, tuple, object]]:
+    """(kind, url, ready, 抽出) の一覧（run_races_iter が開くのと同じページ / 目印）"""
+    By = kb.By
+    date = f"{fx.year}{fx.month}{fx.day}"
+    out = [(
+        "schedule", kb._keibabook_url(f"/chihou/nittei/{date}10"), (By.TAG_NAME, "a"),
+        lambda html: kb.parse_schedule_index(html),
+    )]
+    for rid in fx.race_ids:
+        out.append((
+            "danwa", kb._keibabook_url(f"/chihou/danwa/1/{rid}"), (By.CLASS_NAME, "danwa"),
+            lambda html: (lambda p: (p.race_info(), p.danwa_comments()))(kb.KeibabookPage(html)),
+        ))
+        out.append((
+            "cyokyo", kb._keibabook_url(f"/chihou/cyokyo/1/{rid}"), (By.CLASS_NAME, "cyokyo"),
+            lambda html: kb.KeibabookPage(html).training_rows(),
+        ))
+    return out
+
+
+def bench_profile(kb, fx, server: StubServer, profile: str, rounds: int) -> tuple[dict, list]:
+    server.reset_counts()
+    t0 = time.perf_counter()
+    driver = kb.build_driver(profile)
+    try:
+        pages = kb.BrowserPageSource(driver)
+        kb.login_keibabook(driver, pages.wait)
+        launch_s = time.perf_counter() - t0
+
+        samples: dict[str, list[float]] = {}
+        extracted = []
+        for r in range(rounds):
+            for kind, url, ready, extract in _targets(kb, fx):
+                t = time.perf_counter()
+                html = pages._get_html_live(url, ready=ready)
+                samples.setdefault(kind, []).append(time.perf_counter() - t)
+                if r == 0:
+                    extracted.append(extract(html))
+    finally:
+        kb._quit_quietly(driver)
+
+    hits = server.reset_counts()
+    result = {
+        "launch_s": round(launch_s, 3),
+        "pages": {
+            kind: {
+                "median_ms": round(statistics.median(xs) * 1000, 1),
+                "max_ms": round(max(xs) * 1000, 1),
+                "n": len(xs),
+            }
+            for kind, xs in samples.items()
+        },
+        "all_median_ms": round(statistics.median([x for xs in samples.values() for x in xs]) * 1000, 1),
+        "asset_requests": {k: hits.get(k, 0) for k in ("static", "ads")},
+    }
+    return result, extracted
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--profiles", default="full,fast", help="カンマ区切り（最初のものを基準に比べる）")
+    ap.add_argument("--races", type=int, default=4)
+    ap.add_argument("--horses", type=int, default=12)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--page-latency", type=float, default=StubLatency.page)
+    ap.add_argument("--asset-latency", type=float, default=StubLatency.asset, help="画像/CSS/フォント/外部タグ 1個の遅延（秒）")
+    ap.add_argument("--out", help="結果 JSON（省略時は .cache/bench/browser-YYYYmmdd-HHMMSS.json）")
+    args = ap.parse_args(argv)
+
+    profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+    fx = synthetic(races=args.races, horses=args.horses, assets=True)
+    latency = StubLatency(page=args.page_latency, asset=args.asset_latency)
+    out_path = os.path.abspath(
+        args.out or os.path.join(ROOT, ".cache", "bench", time.strftime("browser-%Y%m%d-%H%M%S.json"))
+    )
+
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "fixtures": f"synthetic(races={args.races}, horses={args.horses}, assets=True)",
+            "latency": vars(latency),
+            "rounds": args.rounds,
+        },
+        "profiles": {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix="keiba-bench-browser-")
+    with StubServer(fx, latency=latency) as server:
+        prepare_workdir(workdir, server.base_url, server.httpd.server_address[0])
+        import keiba_bot as kb
+
+        reference = None
+        for profile in profiles:
+            print(f"{profile}...")
+            res, extracted = bench_profile(kb, fx, server, profile, args.rounds)
+            if reference is None:
+                reference = extracted
+            res["same_as_" + profiles[0]] = extracted == reference
+            result["profiles"][profile] = res
+            print(
+                f"  launch {res['launch_s']:.2f}s  page median {res['all_median_ms']:.0f}ms  "
+                + "  ".join(f"{k} {v['median_ms']:.0f}ms" for k, v in res["pages"].items())
+                + f"  assets {res['asset_requests']}  same={res['same_as_' + profiles[0]]}"
+            )
+
+    base = result["profiles"].get(profiles[0])
+    for profile in profiles[1:]:
+        cur = result["profiles"][profile]
+        if base and base["all_median_ms"]:
+            print(f"{profile} vs {profiles[0]}: page median x{cur['all_median_ms'] / base['all_median_ms']:.2f}")
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved → {out_path}")
+
+
+if __name__ == "__main__":
+    main()
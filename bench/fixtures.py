@@ -0,0 +1,259 @@
+"""
+ベンチマーク用の HTML フィクスチャ（日程 / 談話 / 調教 / DebaTableSmall）
+
+ディレクトリ構成:
+    meta.json                 {"year", "month", "day", "place_code", "baba_code", "race_ids", "source"}
+    schedule.html             競馬ブック 日程ページ
+    danwa/{race_id}.html      競馬ブック 談話ページ
+    cyokyo/{race_id}.html     競馬ブック 調教ページ
+    keibago/{race_no}.html    keiba.go.jp DebaTableSmall（race_no は日程ページのレース番号。1 から連番とは限らない）
+
+record.py で本番から録ったもの（cookie / ログイン ID は消してある）を bench/fixtures/ に置いておくと、
+bench.run の既定の入力と tests のパーサ比較に使われる。source に出どころを書く。
+録ったものが無い環境では synthetic() で同じ DOM 構造のページを決定的に作る。
+synthetic(assets=True) は競馬ブックのページに画像/CSS/フォント/外部タグを付ける（ブラウザのベンチ用）。
+"""
+import json
+import os
+import random
+from dataclasses import dataclass, field
+
+_SURNAMES = ["佐藤", "鈴木", "高橋", "田中", "渡辺", "伊藤", "山本", "中村", "小林", "加藤", "吉田", "山田"]
+_GIVEN = ["一郎", "健太", "翔", "大輔", "直樹", "亮", "誠", "拓也", "隆", "悠斗", "陽介", "和也"]
+_HORSE_HEAD = ["サクラ", "キタノ", "ミラクル", "ゴールド", "シルバー", "ダイヤ", "スター", "ブルー", "レッド", "ホワイト"]
+_HORSE_TAIL = ["ボーイ", "クイーン", "ロード", "ウイング", "ハート", "ドリーム", "フラッシュ", "キング", "ビート", "ソング"]
+_TANPYO = ["好気配", "動き軽快", "平凡", "上昇中", "まずまず", "仕上がり良", "やや重め", "態勢整う"]
+_DANWA = [
+    "前走は展開が向かなかった。今回は枠も良いし、自分の形なら巻き返せる。",
+    "調教の動きは良くなっている。距離も合うので楽しみ。",
+    "使いつつ良くなってきた。相手は強いが、どこまでやれるか。",
+    "休み明けでも仕上がりは上々。ゲートさえ決まれば。",
+    "馬体が締まってきた。砂を被らなければしぶとい。",
+]
+
+# 本番ページは本文よりナビ/スクリプト/フッタの方が重いので、パース時間が近くなるように詰め物を入れる
+_CHROME_LINKS = "".join(f'<li><a href="/chihou/menu/{i}">メニュー{i}</a></li>' for i in range(120))
+_CHROME_SCRIPT = "<script>" + ";".join(f"var v{i}={i}" for i in range(600)) + "</script>"
+
+# ブラウザで開いた時に読まれるもの（HTTP 取得では読まれない）。外部タグのホストはスタブが配信時に差し替える
+THIRD_PARTY = "__THIRD_PARTY__"
+_ASSETS_HEAD = f'<link rel="stylesheet" href="/static/site.css"><script src="{THIRD_PARTY}/ads/tag.js"></script>'
+_ASSETS_BODY = "".join(f'<img src="/static/banner{i}.jpg" width="300" height="250">' for i in range(6))
+
+
+def _page(title: str, body: str, assets: bool = False) -> str:
+    head, banners = (_ASSETS_HEAD, _ASSETS_BODY) if assets else ("", "")
+    return (
+        "<!DOCTYPE html><html lang=\"ja\"><head><meta charset=\"utf-8\">"
+        f"<title>{title}</title>{head}{_CHROME_SCRIPT}</head><body>"
+        f"<header><nav><ul>{_CHROME_LINKS}</ul></nav>{banners}</header>"
+        f"<main>{body}</main>"
+        f"<footer><ul>{_CHROME_LINKS}</ul>{_CHROME_SCRIPT}</footer>"
+        "</body></html>"
+    )
+
+
+def _person(rng: random.Random) -> str:
+    return f"{rng.choice(_SURNAMES)}{rng.choice(_GIVEN)}"
+
+
+@dataclass
+class FixtureSet:
+    year: str
+    month: str
+    day: str
+    place_code: str
+    baba_code: str
+    race_ids: list[str]
+    schedule: str
+    danwa: dict[str, str] = field(default_factory=dict)
+    cyokyo: dict[str, str] = field(default_factory=dict)
+    keibago: dict[int, str] = field(default_factory=dict)
+    source: str = ""
+
+    def pages_by_kind(self) -> dict[str, list[str]]:
+        return {
+            "schedule": [self.schedule],
+            "danwa": list(self.danwa.values()),
+            "cyokyo": list(self.cyokyo.values()),
+            "keibago": list(self.keibago.values()),
+        }
+
+    def samples(self) -> dict[str, str]:
+        """種類ごとに1ページ（bench.parity.parity_report に渡せる形）"""
+        return {kind: pages[0] for kind, pages in self.pages_by_kind().items() if pages}
+
+    def total_bytes(self) -> int:
+        return sum(len(h.encode("utf-8")) for pages in self.pages_by_kind().values() for h in pages)
+
+    # ---------- 保存 / 読み込み ----------
+    def save(self, root: str):
+        for sub in ("danwa", "cyokyo", "keibago"):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        meta = {
+            "year": self.year, "month": self.month, "day": self.day,
+            "place_code": self.place_code, "baba_code": self.baba_code,
+            "race_ids": self.race_ids, "source": self.source,
+        }
+        _write(os.path.join(root, "meta.json"), json.dumps(meta, ensure_ascii=False, indent=2))
+        _write(os.path.join(root, "schedule.html"), self.schedule)
+        for rid, html in self.danwa.items():
+            _write(os.path.join(root, "danwa", f"{rid}.html"), html)
+        for rid, html in self.cyokyo.items():
+            _write(os.path.join(root, "cyokyo", f"{rid}.html"), html)
+        for no, html in self.keibago.items():
+            _write(os.path.join(root, "keibago", f"{no}.html"), html)
+
+    @classmethod
+    def load(cls, root: str) -> "FixtureSet":
+        meta = json.loads(_read(os.path.join(root, "meta.json")))
+        race_ids = meta["race_ids"]
+        fx = cls(
+            year=meta["year"], month=meta["month"], day=meta["day"],
+            place_code=meta["place_code"], baba_code=meta["baba_code"],
+            race_ids=race_ids,
+            schedule=_read(os.path.join(root, "schedule.html")),
+            source=meta.get("source", ""),
+        )
+        for rid in race_ids:
+            for kind, store in (("danwa", fx.danwa), ("cyokyo", fx.cyokyo)):
+                path = os.path.join(root, kind, f"{rid}.html")
+                if os.path.exists(path):
+                    store[rid] = _read(path)
+        # race_no は保存された名前から取る（日程に抜けがあると race_ids の位置とは合わない）
+        keibago_dir = os.path.join(root, "keibago")
+        names = os.listdir(keibago_dir) if os.path.isdir(keibago_dir) else []
+        for no in sorted(int(n[:-5]) for n in names if n.endswith(".html") and n[:-5].isdigit()):
+            fx.keibago[no] = _read(os.path.join(keibago_dir, f"{no}.html"))
+        return fx
+
+
+# record.py で録ったカードを置く場所（1カード1ディレクトリ。tests と bench.run が読む）
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def recorded_fixture_dirs() -> list[str]:
+    """FIXTURES_DIR の下の、meta.json があるディレクトリ（名前順）"""
+    if not os.path.isdir(FIXTURES_DIR):
+        return []
+    return [
+        os.path.join(FIXTURES_DIR, name)
+        for name in sorted(os.listdir(FIXTURES_DIR))
+        if os.path.exists(os.path.join(FIXTURES_DIR, name, "meta.json"))
+    ]
+
+
+def _write(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+# ==================================================
+# 合成フィクスチャ（本番と同じ DOM 構造）
+# ==================================================
+def synthetic(
+    races: int = 12,
+    horses: int = 12,
+    year: str = "2025",
+    month: str = "01",
+    day: str = "15",
+    place_code: str = "10",
+    baba_code: str = "20",
+    seed: int = 0,
+    assets: bool = False,
+) -> FixtureSet:
+    rng = random.Random(seed)
+    race_ids = [f"{year}{month}{place_code}{day}0101{n:02d}" for n in range(1, races + 1)]
+    # 他場のレースも混ぜる（場コードで絞れているかを見るため）
+    other = [f"{year}{month}11{day}0101{n:02d}" for n in range(1, races + 1)]
+
+    links = "".join(
+        f'<li><a href="/chihou/syutuba/{rid}">{i}R</a></li>'
+        for ids in (race_ids, other)
+        for i, rid in enumerate(ids, 1)
+    )
+    schedule = _page("日程", f'<div class="nittei"><ul>{links}</ul></div>', assets)
+
+    fx = FixtureSet(
+        year=year, month=month, day=day, place_code=place_code, baba_code=baba_code,
+        race_ids=race_ids, schedule=schedule,
+        source=f"synthetic(races={races}, horses={horses}, seed={seed})",
+    )
+    for no, rid in enumerate(race_ids, 1):
+        field_ = [
+            {
+                "umaban": str(u),
+                "waku": str(min(8, (u + 1) // 2 if horses > 8 else u)),
+                "horse": f"{rng.choice(_HORSE_HEAD)}{rng.choice(_HORSE_TAIL)}{u}",
+                "trainer": _person(rng),
+                "jockey": _person(rng),
+                "prev_jockey": _person(rng) if rng.random() < 0.3 else None,
+                "tanpyo": rng.choice(_TANPYO),
+                "danwa": rng.choice(_DANWA),
+            }
+            for u in range(1, horses + 1)
+        ]
+        fx.danwa[rid] = _danwa_page(no, field_, assets)
+        fx.cyokyo[rid] = _cyokyo_page(no, field_, rng, assets)
+        fx.keibago[no] = _keibago_page(year, month, day, no, field_)
+    return fx
+
+
+def _racetitle(no: int) -> str:
+    return (
+        '<div class="racetitle">'
+        f'<div class="racemei"><p>{no}R</p><p>第{no}競走 ベンチマーク特別</p></div>'
+        f'<div class="racetitle_sub"><p>15:{no:02d}発走</p><p>ダート 1{no % 6}00m 右 外 良</p></div>'
+        "</div>"
+    )
+
+
+def _danwa_page(no: int, field_: list[dict], assets: bool = False) -> str:
+    rows = "".join(
+        f'<tr><td class="umaban">{h["umaban"]}</td><td class="bamei">{h["horse"]}</td></tr>'
+        f'<tr><td class="danwa" colspan="2">{h["danwa"]}（{h["trainer"]}調教師）</td></tr>'
+        for h in field_
+    )
+    return _page("談話", _racetitle(no) + f'<table class="danwa"><tbody>{rows}</tbody></table>', assets)
+
+
+def _cyokyo_page(no: int, field_: list[dict], rng: random.Random, assets: bool = False) -> str:
+    tables = []
+    for h in field_:
+        times = " ".join(f"{rng.uniform(11.8, 16.5):.1f}" for _ in range(5))
+        tables.append(
+            '<table class="cyokyo"><tbody>'
+            f'<tr><td class="umaban">{h["umaban"]}</td><td class="kbamei">{h["horse"]}</td>'
+            f'<td class="tanpyo">{h["tanpyo"]}</td></tr>'
+            f'<tr><td colspan="3">{h["jockey"]} 大井 良 {times} 馬なり余力</td></tr>'
+            "</tbody></table>"
+        )
+    return _page("調教", _racetitle(no) + "".join(tables), assets)
+
+
+def _keibago_page(year: str, month: str, day: str, no: int, field_: list[dict]) -> str:
+    rows = []
+    last_waku = None
+    for h in field_:
+        prev = h["prev_jockey"] or h["jockey"]
+        zenso = f"{year}.{month}.01 大井 3人 {prev} 56.0 1400ダ 1:28.5"
+        cells = (
+            f'<td>{h["umaban"]}</td>'
+            f'<td><font class="bamei"><b>{h["horse"]}</b></font></td>'
+            f'<td>{h["trainer"]}（大井）</td>'
+            f'<td>{h["jockey"]}<br>56.0</td>'
+            "<td>460</td><td>牡4</td><td>鹿毛</td>"
+            f"<td>{zenso}</td>"
+        )
+        if h["waku"] != last_waku:
+            cells = f'<td>{h["waku"]}</td>' + cells
+            last_waku = h["waku"]
+        rows.append(f"<tr>{cells}</tr>")
+    header = f'<table class="bs"><tr><td>{year}年{month}月{day}日 大井 第{no}競走</td></tr></table>'
+    main = '<table><tr><td class="dbtbl"><table class="bs" border="1">' + "".join(rows) + "</table></td></tr></table>"
+    return _page("出馬表", header + main)
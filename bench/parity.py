@@ -0,0 +1,49 @@
+"""
+パーサのバックエンド（keiba_bot._PARSER_BACKENDS）ごとの抽出結果を html.parser と比べる
+
+tests/test_parser_parity.py と bench.run（--skip-parsers でない時）から使う。
+"""
+
+
+# 本番のページで起こりうる崩れ（録ったページが無い間は合成ページをこう崩して比べる）
+MALFORMED = {
+    "unclosed_td": lambda html: html.replace("</td>", ""),
+    "unclosed_tr": lambda html: html.replace("</tr>", ""),
+    "unclosed_td_tr": lambda html: html.replace("</td>", "").replace("</tr>", ""),
+    "unclosed_p": lambda html: html.replace("</p>", ""),
+    "no_tbody": lambda html: html.replace("<tbody>", "").replace("</tbody>", ""),
+    "stray_div": lambda html: html.replace("<main>", "<main></div>").replace("</table>", "</table></div>"),
+}
+
+
+def extract(kb, kind: str, html: str, backend: str):
+    """ページ種別ごとに、本番の取得処理が使う抽出をまとめて返す"""
+    if kind == "schedule":
+        return kb.parse_schedule_index(html, backend=backend)
+    if kind == "danwa":
+        page = kb.KeibabookPage(html, backend=backend)
+        return {"race_info": page.race_info(), "danwa": page.danwa_comments()}
+    if kind == "cyokyo":
+        page = kb.KeibabookPage(html, backend=backend)
+        return {"cyokyo": page.cyokyo(), "training": page.training_rows()}
+    if kind == "keibago":
+        return kb.parse_keibago_debatable_small(html, backend=backend)
+    raise ValueError(f"unknown page kind: {kind}")
+
+
+def parity_report(kb, pages: dict[str, str], backends: list[str] | None = None) -> dict:
+    """
+    pages: {"schedule": html, "danwa": html, "cyokyo": html, "keibago": html}（あるものだけ）
+    return: {backend: {kind: "ok" | "差分の説明"}}
+    """
+    report = {}
+    for backend in backends or kb.available_parser_backends():
+        report[backend] = {}
+        for kind, html in pages.items():
+            expected = extract(kb, kind, html, "html.parser")
+            got = extract(kb, kind, html, backend)
+            if got == expected:
+                report[backend][kind] = "ok"
+            else:
+                report[backend][kind] = f"mismatch: expected={expected!r} got={got!r}"[:2000]
+    return report
@@ -0,0 +1,105 @@
+"""
+本番（競馬ブック / keiba.go.jp）から1開催分のページを録って FixtureSet として保存する
+
+    python -m bench.record bench/fixtures/20250115_oi --date 20250115 --place 10 [--races 1,2,3]
+
+競馬ブックは保存済みのログイン cookie（KEIBABOOK_COOKIE_FILE）を使う。無ければ Chrome でログインする。
+設定は keiba_bot と同じ（環境変数か .streamlit/secrets.toml / KEIBA_BOT_CONFIG）。
+
+保存する前に、ページに埋め込まれた cookie の値とログイン ID を消す（残っていたら保存しない）。
+bench/fixtures/ の下に録ったものはそのままコミットしてよい。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fixtures import FixtureSet  # noqa: E402
+
+# run_races_iter と同じ対応表
+_BABA_CODES = {"10": "20", "11": "21", "12": "19", "13": "18"}
+
+REDACTED = "REDACTED"
+
+
+def _secrets(kb, pages) -> list[str]:
+    """ページから消すもの（セッション cookie の値とログイン ID。短すぎるものは誤爆するので除く）"""
+    values = [c.value for c in pages.sess.cookies if c.value]
+    values += [c.value for c in kb.get_keibago_session().cookies if c.value]
+    if kb.KEIBA_ID:
+        values.append(kb.KEIBA_ID)
+    return sorted({v for v in values if len(v) >= 6}, key=len, reverse=True)
+
+
+def scrub(fx: FixtureSet, secrets: list[str]):
+    """fx の全ページから secrets を REDACTED に置き換え、残っていないことを確かめる"""
+    def clean(html: str) -> str:
+        for s in secrets:
+            html = html.replace(s, REDACTED)
+        return html
+
+    fx.schedule = clean(fx.schedule)
+    for store in (fx.danwa, fx.cyokyo, fx.keibago):
+        for key in store:
+            store[key] = clean(store[key])
+    for pages in fx.pages_by_kind().values():
+        for html in pages:
+            if any(s in html for s in secrets):
+                raise SystemExit("cookie / ログイン ID がページに残っています（保存しません）")
+
+
+def record(out: str, year: str, month: str, day: str, place_code: str, targets: set[int] | None = None) -> FixtureSet:
+    import keiba_bot as kb
+    from selenium.webdriver.common.by import By
+
+    pages = kb.HttpPageSource()
+    if not pages.load_saved_cookies():
+        pages.relogin()
+
+    schedule = pages.get_html(kb._keibabook_url(f"/chihou/nittei/{year}{month}{day}10"), ready=(By.TAG_NAME, "a"), refresh=True)
+    races = kb.parse_schedule_index(schedule).get(place_code, [])
+    race_ids = [rid for _, rid in races]
+    if not race_ids:
+        raise SystemExit(f"race_id が見つかりません（{year}{month}{day} place={place_code}）")
+
+    fx = FixtureSet(
+        year=year, month=month, day=day, place_code=place_code, baba_code=_BABA_CODES[place_code],
+        race_ids=race_ids, schedule=schedule,
+        source=f"recorded {time.strftime('%Y-%m-%d')} (keibabook / keiba.go.jp)",
+    )
+    sess = kb.get_keibago_session()
+    for race_no, race_id in kb._select_target_race_ids(races, targets):
+        print(f"{race_no}R {race_id}")
+        fx.danwa[race_id] = pages.get_html(
+            kb._keibabook_url(f"/chihou/danwa/1/{race_id}"), ready=(By.CLASS_NAME, "danwa"), refresh=True,
+        )
+        fx.cyokyo[race_id] = pages.get_html(
+            kb._keibabook_url(f"/chihou/cyokyo/1/{race_id}"), ready=(By.CLASS_NAME, "cyokyo"), refresh=True,
+        )
+        r = sess.get(kb._keibago_debatable_url(year, month, day, race_no, fx.baba_code), timeout=25)
+        r.raise_for_status()
+        fx.keibago[race_no] = kb._decode_keibago(r)
+
+    scrub(fx, _secrets(kb, pages))
+    fx.save(out)
+    return fx
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("out")
+    ap.add_argument("--date", required=True, help="YYYYMMDD")
+    ap.add_argument("--place", required=True, choices=sorted(_BABA_CODES), help="競馬ブックの場コード")
+    ap.add_argument("--races", default="", help="カンマ区切りのレース番号（省略時は全レース）")
+    args = ap.parse_args(argv)
+
+    races = {int(x) for x in args.races.split(",") if x.strip()} or None
+    d = args.date
+    fx = record(args.out, d[:4], d[4:6], d[6:8], args.place, races)
+    print(f"saved {len(fx.danwa)} races, {fx.total_bytes() / 1024:.0f} KiB → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
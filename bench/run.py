@@ -0,0 +1,294 @@
+"""
+オフライン・ベンチマーク
+
+ローカルのスタブサーバ（stub_server.py）を立て、keiba_bot をそこに向けて
+  1) 各パーサ（日程 / 談話 / 調教 / DebaTableSmall）× 各バックエンドの1ページあたり時間
+  2) run_races_iter の端から端まで（HTTP 取得モード・保存済み cookie で Chrome は起動しない）
+を計り、結果を JSON に保存する。--baseline で前回の JSON と比べる。
+
+    python -m bench.run                       # bench/fixtures/ の最初のカード（無ければ合成）
+    python -m bench.run --fixtures bench/fixtures/20250115_oi --repeat 5
+    python -m bench.run --synthetic --races 12
+    python -m bench.run --baseline .cache/bench/bench-20250115-090000.json
+
+keiba_bot の設定は環境変数で渡す（設定ファイルより優先される）。
+Supabase は空にするので history は書かない。HTML / Dify のキャッシュは作業用の一時ディレクトリ。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fixtures import FixtureSet, recorded_fixture_dirs, synthetic  # noqa: E402
+from bench.parity import parity_report  # noqa: E402
+from bench.stub_server import SESSION_COOKIE, SESSION_VALUE, StubLatency, StubServer  # noqa: E402
+
+# name: run_races_iter の引数（fetch_mode="http" 固定）。warm は1回温めてから計る
+SCENARIOS = {
+    "serial": {"workers": 1, "pipeline_depth": 0, "refresh": True, "dify_refresh": True},
+    "pipeline": {"workers": 1, "pipeline_depth": 2, "refresh": True, "dify_refresh": True},
+    "parallel4": {"workers": 4, "refresh": True, "dify_refresh": True},
+    "async_dify4": {"dify_concurrency": 4, "refresh": True, "dify_refresh": True},
+    "warm": {"workers": 1, "refresh": False, "dify_refresh": False},
+}
+
+
+def prepare_workdir(workdir: str, base_url: str, host: str) -> dict:
+    """keiba_bot の設定を環境変数に入れ、ログイン済み扱いの cookie ファイルを置く（keiba_bot の import より前に呼ぶ）"""
+    settings = {
+        "KEIBA_ID": "",
+        "KEIBA_PASS": "",
+        "DIFY_API_KEY": "bench",
+        "DIFY_BASE_URL": base_url,
+        "KEIBABOOK_BASE_URL": base_url,
+        # 本番と同じくホストを分ける（サーキットブレーカーはホストごと）
+        "KEIBAGO_BASE_URL": base_url.replace("://127.0.0.1:", "://localhost:"),
+        "SUPABASE_URL": "",
+        "SUPABASE_ANON_KEY": "",
+        "KEIBABOOK_COOKIE_FILE": os.path.join(workdir, "cookies.json"),
+        "HTML_CACHE_DIR": os.path.join(workdir, "cache", "html"),
+        "DIFY_CACHE_DIR": os.path.join(workdir, "cache", "dify"),
+        "RACE_STATE_DIR": os.path.join(workdir, "cache", "race_state"),
+        "HISTORY_SPOOL_FILE": os.path.join(workdir, "cache", "history_spool.jsonl"),
+        "ARCHIVE_DIR": os.path.join(workdir, "cache", "archive"),
+        "TIMINGS_LOG_FILE": "",
+    }
+    os.environ.update(settings)
+
+    cookies = [{"name": SESSION_COOKIE, "value": SESSION_VALUE, "domain": host, "path": "/"}]
+    with open(settings["KEIBABOOK_COOKIE_FILE"], "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "cookies": cookies}, f)
+    return settings
+
+
+# ==================================================
+# パーサ
+# ==================================================
+def bench_parsers(kb, fx: FixtureSet, rounds: int) -> dict:
+    """{backend: {kind: {"ms_per_page", "pages"}}} と、html.parser との一致確認"""
+    extract = {
+        "schedule": lambda html, b: kb.parse_schedule_index(html, backend=b),
+        "danwa": lambda html, b: (lambda p: (p.race_info(), p.danwa_comments()))(kb.KeibabookPage(html, b)),
+        "cyokyo": lambda html, b: kb.KeibabookPage(html, b).cyokyo(),
+        "keibago": lambda html, b: kb.parse_keibago_debatable_small(html, backend=b),
+    }
+    by_kind = fx.pages_by_kind()
+    out = {}
+    for backend in kb.available_parser_backends():
+        out[backend] = {}
+        for kind, pages in by_kind.items():
+            if not pages:
+                continue
+            fn = extract[kind]
+            samples = []
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                for html in pages:
+                    fn(html, backend)
+                samples.append((time.perf_counter() - t0) / len(pages))
+            out[backend][kind] = {"ms_per_page": round(min(samples) * 1000, 3), "pages": len(pages)}
+    return {"timings": out, "parity": parity_report(kb, fx.samples())}
+
+
+# ==================================================
+# run_races_iter
+# ==================================================
+def _one_run(kb, fx: FixtureSet, kwargs: dict) -> dict:
+    timings = kb.RunTimings()
+    t0 = time.perf_counter()
+    first = None
+    races = errors = 0
+    for race_num, block in kb.run_races_iter(
+        fx.year, fx.month, fx.day, fx.place_code, None, ui=False, fetch_mode="http", timings=timings, **kwargs,
+    ):
+        if first is None:
+            first = time.perf_counter() - t0
+        races += 1
+        if "⚠️" in block:
+            errors += 1
+    return {
+        "seconds": time.perf_counter() - t0, "first_race_seconds": first, "races": races, "errors": errors,
+        "stages": timings.summary()["stages"],
+    }
+
+
+def bench_pipeline(kb, fx: FixtureSet, server: StubServer, scenarios: list[str], repeat: int) -> dict:
+    out = {}
+    for name in scenarios:
+        kwargs = SCENARIOS[name]
+        if not kwargs.get("refresh"):
+            _one_run(kb, fx, kwargs)  # キャッシュを温める
+        server.reset_counts()
+        runs = [_one_run(kb, fx, kwargs) for _ in range(repeat)]
+        secs = [r["seconds"] for r in runs]
+        out[name] = {
+            "args": kwargs,
+            "median_s": round(statistics.median(secs), 4),
+            "min_s": round(min(secs), 4),
+            "max_s": round(max(secs), 4),
+            "first_race_median_s": round(statistics.median(r["first_race_seconds"] or 0 for r in runs), 4),
+            "races": runs[-1]["races"],
+            "errors": max(r["errors"] for r in runs),
+            "requests_per_run": {k: v / repeat for k, v in sorted(server.reset_counts().items())},
+            "stages_last_run": runs[-1]["stages"],
+        }
+        print(f"  {name:<12} median {out[name]['median_s']:.3f}s  first {out[name]['first_race_median_s']:.3f}s"
+              f"  races={out[name]['races']} errors={out[name]['errors']}")
+    return out
+
+
+# ==================================================
+# 比較
+# ==================================================
+def compare(current: dict, baseline: dict) -> list[str]:
+    lines = []
+    cur_imp, base_imp = current.get("import"), baseline.get("import")
+    if cur_imp and base_imp and base_imp.get("median_ms"):
+        ratio = cur_imp["median_ms"] / base_imp["median_ms"]
+        lines.append(f"import keiba_bot      {base_imp['median_ms']:.0f}ms → {cur_imp['median_ms']:.0f}ms  (x{ratio:.2f})")
+    for name, cur in current.get("pipeline", {}).items():
+        base = baseline.get("pipeline", {}).get(name)
+        if base and base.get("median_s"):
+            ratio = cur["median_s"] / base["median_s"]
+            lines.append(f"pipeline {name:<12} {base['median_s']:.3f}s → {cur['median_s']:.3f}s  (x{ratio:.2f})")
+    for backend, kinds in current.get("parsers", {}).get("timings", {}).items():
+        for kind, cur in kinds.items():
+            base = baseline.get("parsers", {}).get("timings", {}).get(backend, {}).get(kind)
+            if base and base.get("ms_per_page"):
+                ratio = cur["ms_per_page"] / base["ms_per_page"]
+                lines.append(
+                    f"parser {backend:<11} {kind:<8} {base['ms_per_page']:.2f}ms → {cur['ms_per_page']:.2f}ms  (x{ratio:.2f})"
+                )
+    return lines
+
+
+def measure_import(repeat: int = 5) -> dict:
+    """新しいプロセスで import keiba_bot にかかる時間（ms）と、その時点で読み込まれた重い依存"""
+    code = (
+        "import sys, time; t = time.perf_counter(); import keiba_bot; "
+        "ms = (time.perf_counter() - t) * 1000; "
+        "heavy = [m for m in ('streamlit', 'selenium', 'supabase', 'httpx') if m in sys.modules]; "
+        "print(ms, ','.join(heavy))"
+    )
+    samples = []
+    heavy = ""
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, text=True).split()
+        samples.append(float(out[0]))
+        heavy = out[1] if len(out) > 1 else ""
+    return {
+        "median_ms": round(statistics.median(samples), 1),
+        "min_ms": round(min(samples), 1),
+        "heavy_modules_loaded": [m for m in heavy.split(",") if m],
+    }
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return ""
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixtures", help="フィクスチャのディレクトリ（省略時は bench/fixtures/ の最初のカード）")
+    ap.add_argument("--synthetic", action="store_true", help="コミット済みのカードを使わず合成フィクスチャで計る")
+    ap.add_argument("--races", type=int, default=12, help="合成フィクスチャのレース数")
+    ap.add_argument("--horses", type=int, default=12, help="合成フィクスチャの頭数")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help="カンマ区切り: " + ",".join(SCENARIOS))
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--parser-rounds", type=int, default=5)
+    ap.add_argument("--skip-parsers", action="store_true")
+    ap.add_argument("--skip-pipeline", action="store_true")
+    ap.add_argument("--page-latency", type=float, default=StubLatency.page)
+    ap.add_argument("--keibago-latency", type=float, default=StubLatency.keibago)
+    ap.add_argument("--dify-first", type=float, default=StubLatency.dify_first)
+    ap.add_argument("--dify-chunk", type=float, default=StubLatency.dify_chunk)
+    ap.add_argument("--dify-mode", choices=["sse", "blocking"], default="sse")
+    ap.add_argument("--keibago-status", type=int, default=0, help="keiba.go.jp が常に返すステータス（例: 503。落ちている時を見る）")
+    ap.add_argument("--dify-stall", type=float, default=0.0, help="streaming だけ止める秒数（blocking の並走を見る）")
+    ap.add_argument("--dify-stall-at", type=int, default=0, help="何個目の text_chunk の前で止めるか（0 = 最初のイベントの前）")
+    ap.add_argument("--dify-ping", type=float, default=0.0, help="止まっている間に ping 行を送る間隔（秒）")
+    ap.add_argument("--out", help="結果 JSON（省略時は .cache/bench/bench-YYYYmmdd-HHMMSS.json）")
+    ap.add_argument("--baseline", help="比較する前回の結果 JSON")
+    args = ap.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        ap.error(f"unknown scenario: {', '.join(unknown)}")
+
+    fixtures = args.fixtures
+    if not fixtures and not args.synthetic:
+        fixtures = next(iter(recorded_fixture_dirs()), None)
+        if fixtures is None:
+            print("bench/fixtures/ にカードが無いので合成フィクスチャを使います")
+    fx = FixtureSet.load(fixtures) if fixtures else synthetic(races=args.races, horses=args.horses)
+    print(f"fixtures: {os.path.relpath(fixtures, ROOT) if fixtures else 'synthetic'} ({fx.source or '-'}, {len(fx.danwa)} races)")
+    latency = StubLatency(
+        page=args.page_latency, keibago=args.keibago_latency,
+        dify_first=args.dify_first, dify_chunk=args.dify_chunk,
+        dify_stall=args.dify_stall, dify_stall_at=args.dify_stall_at, dify_ping=args.dify_ping,
+    )
+    out_path = args.out or os.path.join(ROOT, ".cache", "bench", time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    out_path = os.path.abspath(out_path)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "fixtures": os.path.relpath(fixtures, ROOT) if fixtures else "synthetic",
+            "fixture_source": fx.source,
+            "fixture_bytes": fx.total_bytes(),
+            "latency": vars(latency),
+            "dify_mode": args.dify_mode,
+            "keibago_status": args.keibago_status,
+            "repeat": args.repeat,
+        },
+    }
+
+    result["import"] = measure_import()
+    print(f"import keiba_bot: {result['import']['median_ms']:.0f} ms"
+          f"  heavy={','.join(result['import']['heavy_modules_loaded']) or '-'}")
+
+    workdir = tempfile.mkdtemp(prefix="keiba-bench-")
+    with StubServer(fx, latency=latency, dify_mode=args.dify_mode, keibago_status=args.keibago_status) as server:
+        prepare_workdir(workdir, server.base_url, server.httpd.server_address[0])
+        import keiba_bot as kb
+
+        if not args.skip_parsers:
+            print("parsers...")
+            result["parsers"] = bench_parsers(kb, fx, args.parser_rounds)
+            for backend, kinds in result["parsers"]["timings"].items():
+                print(f"  {backend:<11} " + "  ".join(f"{k} {v['ms_per_page']:.2f}ms" for k, v in kinds.items()))
+        if not args.skip_pipeline:
+            print("run_races_iter...")
+            result["pipeline"] = bench_pipeline(kb, fx, server, scenarios, args.repeat)
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved → {out_path}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"vs {baseline_path}")
+        for line in compare(result, baseline):
+            print("  " + line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+ベンチマーク用のローカル HTTP サーバ（競馬ブック / keiba.go.jp / Dify の代役）
+
+    /login/login                                  ログインフォーム（cookie が無い時はここに飛ばす）
+    /chihou/nittei/{YYYYMMDD}10                   日程
+    /chihou/danwa/1/{race_id}                     談話
+    /chihou/cyokyo/1/{race_id}                    調教
+    /KeibaWeb/TodayRaceInfo/DebaTableSmall?...    出馬表（k_raceNo で引く）
+    POST /v1/workflows/run                        Dify workflow（streaming=SSE / blocking=JSON）
+    /static/*, /ads/*                             画像/CSS/フォント/外部タグ（synthetic(assets=True) のページが参照する）
+
+遅延はすべて秒で指定（本番の RTT / LLM の初回トークン待ちを真似る）。
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .fixtures import THIRD_PARTY, FixtureSet
+
+SESSION_COOKIE = "bench_session"
+SESSION_VALUE = "ok"
+
+_LOGIN_PAGE = (
+    '<html><body><form action="/login/login" method="post">'
+    '<input name="login_id"><input type="password" name="pass"><input type="submit">'
+    "</form></body></html>"
+)
+
+
+@dataclass
+class StubLatency:
+    page: float = 0.05          # 競馬ブック 1ページ
+    keibago: float = 0.05       # keiba.go.jp 1ページ
+    dify_first: float = 0.3     # Dify: 最初のイベントまで
+    dify_chunk: float = 0.01    # Dify: text_chunk 1個ごと
+    dify_chunks: int = 20
+    dify_stall: float = 0.0     # Dify: streaming だけ途中で止まる秒数（blocking の並走を確かめる）
+    dify_stall_at: int = 0      # 何個目の text_chunk の前で止まるか（0 = 最初のイベントの前）
+    dify_ping: float = 0.0      # 止まっている間に "event: ping" を送る間隔（0 = 送らない。本番の Dify は送る）
+    asset: float = 0.1          # 画像/CSS/フォント/外部タグ 1個
+
+
+# path の拡張子 → (Content-Type, 本文)
+_ASSETS = {
+    ".css": ("text/css", '@font-face{font-family:kb;src:url(/static/font.woff2)}body{font-family:kb,sans-serif}'),
+    ".js": ("application/javascript", "var ad=document.createElement('img');ad.src='/static/ad.jpg';document.body&&document.body.appendChild(ad);"),
+    ".jpg": ("image/jpeg", "x" * 40 * 1024),
+    ".woff2": ("font/woff2", "x" * 60 * 1024),
+}
+
+
+def fake_answer(prompt: str) -> str:
+    """プロンプトから決まる回答（同じプロンプト → 同じ回答）"""
+    # full 形式は "[馬番N]"、compact 形式は行頭の "N|"
+    umaban = re.findall(r"\[馬番(\d+)\]", prompt) or re.findall(r"(?m)^(\d+)\|", prompt) or ["1"]
+    d = hashlib.sha256(prompt.encode("utf-8")).digest()
+    picks = [umaban[b % len(umaban)] for b in d[:4]]
+    lines = [
+        f"◎ {picks[0]}番 ○ {picks[1]}番 ▲ {picks[2]}番 △ {picks[3]}番",
+        "展開: 先行争いは激しくなく、内枠の先行馬がそのまま残る形を想定。",
+    ]
+    lines += [f"{u}番: 談話・調教ともに平行線。" for u in umaban]
+    return "\n".join(lines)
+
+
+class StubServer:
+    """
+    dify_mode="sse"     : streaming 要求に SSE を返す（本番と同じ）
+    dify_mode="blocking": streaming 要求にも JSON を返す（クライアントの blocking フォールバックを通す）
+    dify_status         : 0 以外なら Dify は常にそのステータスを返す（429 等の挙動確認用）
+    keibago_status      : 0 以外なら keiba.go.jp は常にそのステータスを返す（落ちている時の挙動確認用）
+    """
+
+    def __init__(
+        self,
+        fixtures: FixtureSet,
+        latency: StubLatency | None = None,
+        dify_mode: str = "sse",
+        dify_status: int = 0,
+        keibago_status: int = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.fixtures = fixtures
+        self.latency = latency or StubLatency()
+        self.dify_mode = dify_mode
+        self.dify_status = dify_status
+        self.keibago_status = keibago_status
+        self.hits: Counter = Counter()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def third_party_url(self) -> str:
+        """外部タグの配信元（同じサーバを別のホスト名で指す）"""
+        return f"http://localhost:{self.httpd.server_address[1]}"
+
+    def count(self, route: str):
+        with self._lock:
+            self.hits[route] += 1
+
+    def reset_counts(self) -> dict:
+        with self._lock:
+            out = dict(self.hits)
+            self.hits.clear()
+        return out
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name="bench-stub")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, fmt, *args):
+                pass
+
+            # ---------- 共通 ----------
+            def _send(self, status: int, body: str, ctype: str = "text/html; charset=utf-8", headers: dict | None = None):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _logged_in(self) -> bool:
+                return f"{SESSION_COOKIE}={SESSION_VALUE}" in (self.headers.get("Cookie") or "")
+
+            # ---------- GET ----------
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                path = parts.path
+                fx = server.fixtures
+
+                if path.startswith("/KeibaWeb/TodayRaceInfo/DebaTableSmall"):
+                    server.count("keibago")
+                    time.sleep(server.latency.keibago)
+                    if server.keibago_status:
+                        return self._send(server.keibago_status, "stub error")
+                    no = int((parse_qs(parts.query).get("k_raceNo") or ["0"])[0])
+                    html = fx.keibago.get(no)
+                    return self._send(200, html) if html else self._send(404, "not found")
+
+                if path.startswith("/login/login"):
+                    server.count("login")
+                    return self._send(200, _LOGIN_PAGE)
+
+                if path.startswith(("/static/", "/ads/")):
+                    server.count("ads" if path.startswith("/ads/") else "static")
+                    time.sleep(server.latency.asset)
+                    ctype, body = _ASSETS.get(path[path.rfind("."):], ("application/octet-stream", ""))
+                    return self._send(200, body, ctype=ctype)
+
+                m = re.match(r"^/chihou/(nittei|danwa|cyokyo)/", path)
+                if not m:
+                    return self._send(404, "not found")
+
+                kind = m.group(1)
+                server.count(kind)
+                time.sleep(server.latency.page)
+                if not self._logged_in():
+                    return self._send(302, "", headers={"Location": "/login/login"})
+
+                if kind == "nittei":
+                    html = fx.schedule
+                else:
+                    rid = path.rstrip("/").rsplit("/", 1)[-1]
+                    html = (fx.danwa if kind == "danwa" else fx.cyokyo).get(rid)
+                if not html:
+                    return self._send(404, "not found")
+                return self._send(200, html.replace(THIRD_PARTY, server.third_party_url))
+
+            # ---------- POST（Dify） ----------
+            def do_POST(self):
+                if urlsplit(self.path).path != "/v1/workflows/run":
+                    return self._send(404, "not found")
+                server.count("dify")
+                n = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(n) or b"{}")
+                prompt = ((payload.get("inputs") or {}).get("text")) or ""
+
+                time.sleep(server.latency.dify_first)
+                if server.dify_status:
+                    return self._send(
+                        server.dify_status, json.dumps({"code": "stub", "message": "stub error"}),
+                        ctype="application/json", headers={"Retry-After": "1"},
+                    )
+
+                answer = fake_answer(prompt)
+                if payload.get("response_mode") == "streaming" and server.dify_mode == "sse":
+                    return self._stream(answer)
+
+                if payload.get("response_mode") == "streaming":
+                    # SSE を返さない（プロキシ越し等）ケース：クライアントは blocking に切り替えるはず
+                    return self._send(200, json.dumps({"message": "streaming disabled"}), ctype="application/json")
+
+                time.sleep(server.latency.dify_chunk * server.latency.dify_chunks)
+                body = {"data": {"status": "succeeded", "outputs": {"text": answer}}}
+                return self._send(200, json.dumps(body, ensure_ascii=False), ctype="application/json")
+
+            def _stream(self, answer: str):
+                # 本番（Dify / nginx）と同じ chunked で返す（close 区切りだと requests の iter_lines が 512B 溜まるまで返さない）
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                def write(data: bytes):
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+
+                def emit(evt: dict):
+                    write(f"data: {json.dumps(evt, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+                lat = server.latency
+
+                def stall():
+                    end = time.monotonic() + lat.dify_stall
+                    while lat.dify_ping > 0 and time.monotonic() + lat.dify_ping < end:
+                        time.sleep(lat.dify_ping)
+                        write(b"event: ping\n\n")
+                    time.sleep(max(0.0, end - time.monotonic()))
+
+                try:
+                    if lat.dify_stall and lat.dify_stall_at <= 0:
+                        stall()
+                    emit({"event": "workflow_started", "data": {}})
+                    n = max(1, lat.dify_chunks)
+                    step = max(1, -(-len(answer) // n))
+                    for k, i in enumerate(range(0, len(answer), step), 1):
+                        time.sleep(lat.dify_chunk)
+                        if lat.dify_stall and k == lat.dify_stall_at:
+                            stall()
+                        emit({"event": "text_chunk", "data": {"text": answer[i:i + step]}})
+                    emit({"event": "workflow_finished", "data": {"status": "succeeded", "outputs": {"text": answer}}})
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # クライアントが先に切った（blocking が勝って streaming を捨てた等）
+                    pass
+
+        return Handler
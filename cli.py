@@ -0,0 +1,144 @@
+"""
+コマンドラインから開催を分析して結果をファイルに書く（Streamlit 不要。cron / ワーカー用）
+
+    python cli.py --date 20250115 --place 大井
+    python cli.py --date 20250115 --place 10 --races 1-6,9 --out result.txt
+    python cli.py --from 20250113 --to 20250117 --place 大井,川崎,船橋,浦和 --jsonl results.jsonl
+
+設定は環境変数（KEIBA_ID / DIFY_API_KEY / SUPABASE_URL ...）か TOML ファイル（--config、
+無ければ .streamlit/secrets.toml）から読む。Supabase が設定されていれば history にも保存する。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def _parse_races(spec: str) -> set[int] | None:
+    """"1-6,9" → {1,2,3,4,5,6,9}（空なら全レース）"""
+    races = set()
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-", 1)
+            races.update(range(int(a), int(b) + 1))
+        else:
+            races.add(int(part))
+    return races or None
+
+
+def _parse_places(spec: str, place_names: dict[str, str]) -> list[str]:
+    by_name = {v: k for k, v in place_names.items()}
+    codes = []
+    for part in spec.split(","):
+        part = part.strip()
+        code = part if part in place_names else by_name.get(part)
+        if code is None:
+            raise SystemExit(f"unknown place: {part}（{', '.join(f'{k}={v}' for k, v in place_names.items())}）")
+        codes.append(code)
+    return codes
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--date", help="YYYYMMDD")
+    ap.add_argument("--from", dest="date_from", help="YYYYMMDD（--to と一緒に。期間内の全日付）")
+    ap.add_argument("--to", dest="date_to", help="YYYYMMDD")
+    ap.add_argument("--place", required=True, help="競馬場（コードか名前、カンマ区切り）: 10=大井 11=川崎 12=船橋 13=浦和")
+    ap.add_argument("--races", default="", help="レース番号（例: 1-6,9。省略時は全レース）")
+    ap.add_argument("--fetch-mode", choices=["http", "browser"], default="http")
+    ap.add_argument("--pooled", action="store_true", help="Chrome を常駐プールから借りる")
+    ap.add_argument("--browser-profile", choices=["full", "fast"], help="Chrome の設定（BROWSER_PROFILE と同じ。既定 full。fast は画像/外部タグを読まない）")
+    ap.add_argument("--dify-concurrency", type=int, default=4, help="Dify の同時実行数（0 で1レースずつ）")
+    ap.add_argument("--refresh", action="store_true", help="HTML キャッシュを使わず取り直す")
+    ap.add_argument("--dify-refresh", action="store_true", help="AI の回答キャッシュを使わない")
+    ap.add_argument("--incremental", action="store_true", help="入力が前回と同じレースは前回の回答を使う")
+    ap.add_argument("--out", help="結果テキストの出力先（省略時は標準出力）")
+    ap.add_argument("--jsonl", help="1レース1行の JSON Lines 出力先")
+    ap.add_argument("--timings", help="段階ごとの所要時間（JSON Lines）の出力先")
+    ap.add_argument("--config", help="設定 TOML（環境変数 KEIBA_BOT_CONFIG と同じ）")
+    ap.add_argument("--import-time", action="store_true", help="keiba_bot の import 時間を表示する")
+    args = ap.parse_args(argv)
+
+    if args.date:
+        dates = [args.date]
+    elif args.date_from and args.date_to:
+        dates = None
+    else:
+        ap.error("--date か --from/--to を指定してください")
+
+    if args.config:
+        os.environ["KEIBA_BOT_CONFIG"] = args.config
+    if args.browser_profile:
+        os.environ["BROWSER_PROFILE"] = args.browser_profile
+
+    t0 = time.perf_counter()
+    import keiba_bot as kb
+    if args.import_time:
+        print(f"import keiba_bot: {(time.perf_counter() - t0) * 1000:.0f} ms", file=sys.stderr)
+
+    if dates is None:
+        dates = kb.date_range(args.date_from, args.date_to)
+    jobs = kb.batch_jobs(dates, _parse_places(args.place, kb.PLACE_NAMES), _parse_races(args.races))
+
+    results = []   # (job の順番, race_num, job, block, ok)
+    order = {job.key: i for i, job in enumerate(jobs)}
+    timings = kb.RunTimings()
+    report = {}
+    ok = 0
+    for job, race_num, block, race_ok in kb.run_batch_iter(
+        jobs,
+        fetch_mode=args.fetch_mode,
+        pooled=args.pooled,
+        dify_concurrency=args.dify_concurrency,
+        refresh=args.refresh,
+        dify_refresh=args.dify_refresh,
+        incremental=args.incremental,
+        report=report,
+        timings=timings,
+    ):
+        ok += race_ok
+        results.append((order[job.key], race_num, job, block, race_ok))
+        print(f"{'OK' if race_ok else 'NG'} {job.year}/{job.month}/{job.day} {job.place_name} {race_num}R", file=sys.stderr)
+
+    results.sort(key=lambda r: (r[0], r[1]))
+
+    text = "\n\n".join(block.strip() for *_, block, _ in results) + "\n"
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.jsonl:
+        with open(args.jsonl, "a", encoding="utf-8") as f:
+            for _, race_num, job, block, race_ok in results:
+                f.write(json.dumps({
+                    "date": f"{job.year}{job.month}{job.day}",
+                    "place_code": job.place_code,
+                    "place_name": job.place_name,
+                    "race_num": race_num,
+                    "ok": race_ok,
+                    "prompt_tokens": (report.get(job.key, {}).get(race_num) or {}).get("prompt_tokens"),
+                    "missing": (report.get(job.key, {}).get(race_num) or {}).get("missing") or [],
+                    "text": block,
+                }, ensure_ascii=False) + "\n")
+
+    if args.timings:
+        timings.export_jsonl(args.timings)
+
+    if kb.SUPABASE_URL and kb.SUPABASE_ANON_KEY:
+        if not kb.flush_history(timeout=60):
+            print("history: Supabase への保存が終わりませんでした（未送信分は次回起動時に再送）", file=sys.stderr)
+
+    for line in kb.circuit_report():
+        print(f"circuit: {line}", file=sys.stderr)
+    print(f"done: {ok}/{len(results)} races", file=sys.stderr)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
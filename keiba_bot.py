@@ -1,72 +1,427 @@
 # keiba_bot.py
+from __future__ import annotations
+
+import os
+import sys
 import time
 import json
+import hashlib
+import asyncio
+import email.utils
+import atexit
+import functools
 import re
+import queue
+import threading
+import tomllib
+from abc import ABC, abstractmethod
+from collections import deque
 import requests
-import streamlit as st
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeout
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
-from bs4 import BeautifulSoup
-from supabase import create_client, Client
+from bs4 import BeautifulSoup, SoupStrainer
+from typing import TYPE_CHECKING, Callable
 
 from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
 from urllib3.util.retry import Retry
 
+# streamlit / selenium / supabase / httpx は使う時に読み込む（CLI・ワーカーの起動を軽くする）
+if TYPE_CHECKING:
+    import httpx
+    from selenium import webdriver
+    from selenium.webdriver.support.ui import WebDriverWait
+    from supabase import Client
+
 # ==================================================
-# 【設定】Secrets読み込み
+# 【設定】環境変数 → 設定ファイル（TOML）→ Streamlit の secrets の順に読む
 # ==================================================
-KEIBA_ID = st.secrets.get("KEIBA_ID", "")
-KEIBA_PASS = st.secrets.get("KEIBA_PASS", "")
-DIFY_API_KEY = st.secrets.get("DIFY_API_KEY", "")
+def _load_config_files() -> dict:
+    """
+    ~/.streamlit/secrets.toml → ./.streamlit/secrets.toml → 環境変数 KEIBA_BOT_CONFIG のファイル
+    の順に読み、後のものを優先する（Streamlit アプリと同じ secrets.toml をそのまま使える）
+    """
+    paths = [
+        os.path.expanduser("~/.streamlit/secrets.toml"),
+        os.path.join(os.getcwd(), ".streamlit", "secrets.toml"),
+    ]
+    explicit = os.environ.get("KEIBA_BOT_CONFIG")
+    if explicit:
+        paths.append(explicit)
+
+    merged = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                merged.update(tomllib.load(f))
+        except FileNotFoundError:
+            if path == explicit:
+                print(f"config not found: {path}")
+        except (OSError, tomllib.TOMLDecodeError) as e:
+            print(f"config load error ({path}):", e)
+    return merged
+
+_CONFIG = _load_config_files()
+
+def _setting(name: str, default=None):
+    if name in os.environ:
+        return os.environ[name]
+    if name in _CONFIG:
+        return _CONFIG[name]
+    # Streamlit から使われている時だけ（secrets がファイル以外から渡される環境向け）
+    st = sys.modules.get("streamlit")
+    if st is not None:
+        try:
+            from streamlit.errors import StreamlitSecretNotFoundError
+        except ImportError:  # 古い Streamlit は secrets.toml が無いと FileNotFoundError
+            StreamlitSecretNotFoundError = FileNotFoundError
+        try:
+            return st.secrets.get(name, default)
+        except (StreamlitSecretNotFoundError, FileNotFoundError):
+            pass
+    return default
+
+KEIBA_ID = _setting("KEIBA_ID", "")
+KEIBA_PASS = _setting("KEIBA_PASS", "")
+DIFY_API_KEY = _setting("DIFY_API_KEY", "")
 
 # self-host の場合はここを自分のDifyドメインに（例: https://dify.example.com）
-DIFY_BASE_URL = st.secrets.get("DIFY_BASE_URL", "https://api.dify.ai")
+DIFY_BASE_URL = _setting("DIFY_BASE_URL", "https://api.dify.ai")
+
+# 取得先（ベンチマーク等でローカルのスタブに向ける時だけ変える）
+KEIBABOOK_BASE_URL = _setting("KEIBABOOK_BASE_URL", "https://s.keibabook.co.jp")
+KEIBAGO_BASE_URL = _setting("KEIBAGO_BASE_URL", "https://www.keiba.go.jp")
+
+SUPABASE_URL = _setting("SUPABASE_URL", "")
+SUPABASE_ANON_KEY = _setting("SUPABASE_ANON_KEY", "")
+
+# ログイン cookie の保存先（次回起動時にフォームログインを省略する）
+KEIBABOOK_COOKIE_FILE = _setting("KEIBABOOK_COOKIE_FILE", ".keibabook_cookies.json")
+
+# 取得した HTML のキャッシュ（同じ朝に同じレースを再分析してもネットに行かない）
+HTML_CACHE_DIR = _setting("HTML_CACHE_DIR", ".cache/html")
+HTML_CACHE_MAX_BYTES = int(_setting("HTML_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+# Supabase に届かなかった history 行の退避先（次回起動時に再送）
+HISTORY_SPOOL_FILE = _setting("HISTORY_SPOOL_FILE", ".cache/history_spool.jsonl")
+
+# Dify の回答キャッシュ（同じプロンプト＆同じワークフローなら再実行しない）
+DIFY_CACHE_DIR = _setting("DIFY_CACHE_DIR", ".cache/dify")
+DIFY_CACHE_TTL = float(_setting("DIFY_CACHE_TTL", 24 * 60 * 60))
+
+# Dify streaming の期限（秒。0 で無効）：最初のイベントが来ない / イベントが途切れたら blocking を並走させ、先に返った方を使う
+# 並走させるとワークフローが2回走る（負けた方も課金される）ので既定は無効。ping 行もイベントとして数える
+DIFY_FIRST_EVENT_TIMEOUT = float(_setting("DIFY_FIRST_EVENT_TIMEOUT", 0))
+DIFY_IDLE_TIMEOUT = float(_setting("DIFY_IDLE_TIMEOUT", 0))
+
+# Dify を asyncio で同時に流す時の上限（429 が来たら自動で下げる）
+DIFY_MAX_CONCURRENCY = int(_setting("DIFY_MAX_CONCURRENCY", 8))
+
+# レースごとの入力指紋と回答（再実行時に変わったレースだけ AI を回す）
+RACE_STATE_DIR = _setting("RACE_STATE_DIR", ".cache/race_state")
+
+# 取得したデータ（出馬表/談話/調教）を日付×競馬場ごとの Parquet で残す先（空なら残さない）
+ARCHIVE_DIR = _setting("ARCHIVE_DIR", ".cache/archive")
+
+# Dify に渡すプロンプトの形式（full: 従来の項目名つき / compact: 1頭1行の区切り形式）と
+# おおよそのトークン数の上限（超えたら調教の詳細 → 談話の順に削る。0 なら削らない）
+# 既定は従来どおり（full・削らない）。compact と上限は Dify 側のプロンプトを合わせてから使う
+PROMPT_FORMAT = _setting("PROMPT_FORMAT", "full")
+PROMPT_TOKEN_BUDGET = int(_setting("PROMPT_TOKEN_BUDGET", 0))
+
+# HTML パーサのバックエンド（html.parser / scan / lxml / lxml-scan）
+# 既定は html.parser のまま。scan / lxml / lxml-scan は合成ページ（bench/fixtures）でしか html.parser と
+# 同じ結果になることを確かめていない（閉じていない td/tr では lxml 系の結果が変わる。tests/test_parser_parity.py）
+HTML_PARSER = _setting("HTML_PARSER", "html.parser")
+
+# 段階ごとの所要時間を JSON Lines で追記するファイル（空なら書かない）
+TIMINGS_LOG_FILE = _setting("TIMINGS_LOG_FILE", "")
+
+# 常駐させる Chrome の上限数 / 使われずに放置されたら閉じるまでの秒数
+DRIVER_POOL_SIZE = int(_setting("DRIVER_POOL_SIZE", 3))
+DRIVER_IDLE_TTL = float(_setting("DRIVER_IDLE_TTL", 30 * 60))
+
+# Chrome の設定（full: 従来どおり全部読む / fast: DOM ができた時点で返し、画像/フォント/動画と競馬ブック以外のホストを読まない）
+# 既定は full。fast は本番のページ（ログインの外部スクリプトなど）で確かめてから使う
+# BROWSER_ALLOW_HOSTS: fast でも読みに行くホスト（カンマ区切り。ログインに外部のスクリプトが要る時など）
+BROWSER_PROFILE = _setting("BROWSER_PROFILE", "full")
+BROWSER_ALLOW_HOSTS = _setting("BROWSER_ALLOW_HOSTS", "")
+
+# ホストごとのサーキットブレーカー：連続 CIRCUIT_FAILURES 回失敗（接続エラー/タイムアウト/5xx）したら
+# CIRCUIT_COOLDOWN 秒間はそのホストに送らずに即失敗させる
+CIRCUIT_FAILURES = int(_setting("CIRCUIT_FAILURES", 3))
+CIRCUIT_COOLDOWN = float(_setting("CIRCUIT_COOLDOWN", 30))
+
+# 全ホスト共通のリトライ予算：直近 60 秒の送信数 × RETRY_BUDGET_RATIO + RETRY_BUDGET_MIN 回までしかリトライしない
+RETRY_BUDGET_RATIO = float(_setting("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN = int(_setting("RETRY_BUDGET_MIN", 5))
+
+# ==================================================
+# 内部ユーティリティ：プロセスで1つだけ作るもの（セッション/キャッシュ/プール等）
+# ==================================================
+def _resource(fn):
+    """
+    引数ごとに1回だけ作って使い回す（Streamlit の rerun / セッションをまたいでも同じもの）
+    スレッドセーフ。fn.clear() で作り直せる
+    """
+    made = {}
+    lock = threading.Lock()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key not in made:
+                made[key] = fn(*args, **kwargs)
+            return made[key]
 
-SUPABASE_URL = st.secrets.get("SUPABASE_URL", "")
-SUPABASE_ANON_KEY = st.secrets.get("SUPABASE_ANON_KEY", "")
+    wrapper.clear = made.clear
+    return wrapper
 
 # ==================================================
 # 内部ユーティリティ：UI出力のON/OFFを切り替える
 # ==================================================
+def _st():
+    """ui=True の時だけ使う（streamlit はここで初めて読み込む）"""
+    import streamlit as st
+    return st
+
 def _ui_info(ui: bool, msg: str):
     if ui:
-        st.info(msg)
+        _st().info(msg)
 
 def _ui_success(ui: bool, msg: str):
     if ui:
-        st.success(msg)
+        _st().success(msg)
 
 def _ui_warning(ui: bool, msg: str):
     if ui:
-        st.warning(msg)
+        _st().warning(msg)
 
 def _ui_error(ui: bool, msg: str):
     if ui:
-        st.error(msg)
+        _st().error(msg)
 
 def _ui_caption(ui: bool, msg: str):
     if ui:
-        st.caption(msg)
+        _st().caption(msg)
 
 def _ui_markdown(ui: bool, msg: str):
     if ui:
-        st.markdown(msg)
+        _st().markdown(msg)
 
 def _ui_divider(ui: bool):
     if ui:
-        st.divider()
+        _st().divider()
+
+# ==================================================
+# サーキットブレーカー（ホストごと）+ リトライ予算（全体で1つ）
+# ==================================================
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ブレーカーが開いているので送らなかった（ConnectionError として扱える）"""
+
+class CircuitBreaker:
+    """
+    1ホスト分のサーキットブレーカー
+      closed    : 普通に送る。連続 failures 回失敗したら open
+      open      : cooldown 秒間は送らずに即失敗
+      half_open : cooldown 明けに1本だけ試す（成功で closed / 失敗でまた open）
+    失敗 = 接続エラー / タイムアウト / 5xx（リトライの1回ずつを数える）。スレッドセーフ
+    """
+
+    def __init__(self, host: str, failures: int = CIRCUIT_FAILURES, cooldown: float = CIRCUIT_COOLDOWN):
+        self.host = host
+        self.failures = max(1, failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened = 0      # open になった回数
+        self.rejected = 0    # 送らずに失敗させた回数
+        self._streak = 0
+        self._opened_at = 0.0
+        self._probe_at: float | None = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._probe_at = None
+            # 試しの1本が結果を残さずに終わった（キャンセル等）時は cooldown 後にもう1本通す
+            if self.state == "half_open" and (self._probe_at is None or now - self._probe_at >= self.cooldown):
+                self._probe_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def check(self):
+        """送ってよければ何もしない。ダメなら CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self.describe())
+
+    def describe(self) -> str:
+        wait_s = max(0.0, self._opened_at + self.cooldown - time.monotonic())
+        return f"{self.host}: 失敗が続いているため送信を止めています（あと {wait_s:.0f} 秒）"
+
+    def record_success(self):
+        with self._lock:
+            self._streak = 0
+            self.state = "closed"
+            self._probe_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._streak += 1
+            if self.state == "half_open" or (self.state == "closed" and self._streak >= self.failures):
+                self.state = "open"
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_at = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "opened": self.opened, "rejected": self.rejected}
+
+class CircuitBreakers:
+    """ホスト名 → CircuitBreaker（初めて見たホストはその場で作る。URL でもホスト名でも引ける）"""
+
+    def __init__(self, failures: int = CIRCUIT_FAILURES, cooldown: float = CIRCUIT_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._by_host: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> CircuitBreaker:
+        host = (urlsplit(url).hostname or url) if "://" in url else url
+        with self._lock:
+            br = self._by_host.get(host)
+            if br is None:
+                br = self._by_host[host] = CircuitBreaker(host, self.failures, self.cooldown)
+            return br
+
+    def stats(self) -> dict:
+        with self._lock:
+            breakers = list(self._by_host.values())
+        return {br.host: br.stats() for br in breakers}
+
+@_resource
+def get_circuit_breakers() -> CircuitBreakers:
+    return CircuitBreakers()
+
+class RetryBudget:
+    """
+    全ホスト共通のリトライ予算：直近 window 秒の送信数 × ratio + min_retries 回までリトライを許す
+    落ちているホストへのリトライ（とその都度のタイムアウト待ち）が積み重なって開催全体が止まるのを防ぐ
+    スレッドセーフ
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_retries: int = RETRY_BUDGET_MIN, window: float = 60.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.denied = 0
+        self._requests: deque[float] = deque()
+        self._retries: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        for q in (self._requests, self._retries):
+            while q and now - q[0] > self.window:
+                q.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_retry(self) -> bool:
+        """予算があれば1回分使って True"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) < self.min_retries + self.ratio * len(self._requests):
+                self._retries.append(now)
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._trim(time.monotonic())
+            return {"requests": len(self._requests), "retries": len(self._retries), "denied": self.denied}
+
+@_resource
+def get_retry_budget() -> RetryBudget:
+    return RetryBudget()
+
+def circuit_report() -> list[str]:
+    """止めたホスト / 使い切ったリトライ予算の説明（何も無ければ空）"""
+    lines = [
+        f"{host}: {st['state']}（open {st['opened']} 回 / 即失敗 {st['rejected']} 回）"
+        for host, st in get_circuit_breakers().stats().items()
+        if st["opened"] or st["state"] != "closed"
+    ]
+    denied = get_retry_budget().stats()["denied"]
+    if denied:
+        lines.append(f"リトライ予算切れ: {denied} 回")
+    return lines
 
 # ==================================================
 # requests session + retry
 # ==================================================
-def _build_requests_session(total: int = 3, backoff: float = 0.6) -> requests.Session:
+class _BudgetedRetry(Retry):
+    """
+    urllib3 の Retry：失敗した1回ずつ（接続エラー/タイムアウト/リトライ対象の 5xx）をホストのブレーカーに記録し、
+    ブレーカーが開いた / 全体の予算が無い時はリトライせずにそこで諦める
+    記録した 5xx の response には印を付ける（_BreakerAdapter が同じ失敗をもう一度記録しないように）
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        failed = _pool is not None and (error is not None or (response is not None and response.status >= 500))
+        if failed:
+            # 回数切れで super() が諦める時もこの1回は記録する
+            breaker = get_circuit_breakers().get(_pool.host)
+            breaker.record_failure()
+            if response is not None:
+                response.breaker_recorded = True
+        new = super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+        if failed and not breaker.allow():
+            raise MaxRetryError(_pool, url, error or ResponseError(breaker.describe()))
+        if not get_retry_budget().try_retry():
+            raise MaxRetryError(_pool, url, error or ResponseError("retry budget exhausted"))
+        return new
+
+class _BreakerAdapter(HTTPAdapter):
+    """
+    送る前に宛先ホストのブレーカーを確かめ、最後の1回の結果を記録する
+    接続エラー/タイムアウトとリトライ対象の 5xx は _BudgetedRetry が記録済み（ここでは数えない）
+    """
+
+    def send(self, request, **kwargs):
+        breaker = get_circuit_breakers().get(request.url)
+        breaker.check()
+        get_retry_budget().record_request()
+        res = super().send(request, **kwargs)
+        if res.status_code >= 500:
+            if not getattr(res.raw, "breaker_recorded", False):
+                breaker.record_failure()
+        else:
+            breaker.record_success()
+        return res
+
+def _build_requests_session(total: int = 3, backoff: float = 0.6, pool_maxsize: int = 10) -> requests.Session:
     sess = requests.Session()
-    retry = Retry(
+    retry = _BudgetedRetry(
         total=total,
         connect=total,
         read=total,
@@ -75,30 +430,191 @@ def _build_requests_session(total: int = 3, backoff: float = 0.6) -> requests.Se
         allowed_methods=("GET", "POST"),
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = _BreakerAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     sess.mount("https://", adapter)
     sess.mount("http://", adapter)
     return sess
 
 # 使い回し（Dify）
-@st.cache_resource
+@_resource
 def get_http_session() -> requests.Session:
     return _build_requests_session(total=3, backoff=0.6)
 
+# ==================================================
+# ディスクキャッシュ（key の sha256 をファイル名にする）
+# ==================================================
+class DiskCache:
+    """
+    key（URL 等）→ bytes をファイルで持つ簡易キャッシュ。
+    get(key, ttl) は書き込みから ttl 秒を過ぎていれば miss。
+    合計が max_bytes を超えたら古く書かれたものから消して 8 割まで減らす。
+    """
+
+    def __init__(self, root: str, max_bytes: int = 200 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: int | None = None
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        h = self.digest(key)
+        return os.path.join(self.root, h[:2], h)
+
+    def get(self, key: str, ttl: float | None = None) -> bytes | None:
+        path = self._path(key)
+        try:
+            if ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                old = os.path.getsize(path)
+            except OSError:
+                old = 0
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("cache write error:", e)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data) - old
+            if self._size > self.max_bytes:
+                self._evict_locked()
+
+    def invalidate(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+        with self._lock:
+            self._size = None
+
+    def clear(self):
+        for path, _, _ in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def _files(self) -> list[tuple[str, float, int]]:
+        out = []
+        if not os.path.isdir(self.root):
+            return out
+        for d in os.scandir(self.root):
+            if not d.is_dir():
+                continue
+            for f in os.scandir(d.path):
+                if f.name.endswith(".tmp"):
+                    continue
+                try:
+                    st_ = f.stat()
+                except OSError:
+                    continue
+                out.append((f.path, st_.st_mtime, st_.st_size))
+        return out
+
+    def _scan_size(self) -> int:
+        return sum(size for _, _, size in self._files())
+
+    def _evict_locked(self):
+        files = sorted(self._files(), key=lambda x: x[1])
+        total = sum(size for _, _, size in files)
+        target = int(self.max_bytes * 0.8)
+        for path, _, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+# ページ種別ごとの有効期限（秒）
+HTML_CACHE_TTL = {
+    "schedule": 6 * 60 * 60,   # 日程はほぼ変わらない
+    "keibago": 10 * 60,        # 出馬表（騎手変更あり）
+    "danwa": 10 * 60,
+    "cyokyo": 30 * 60,
+}
+
+class HtmlCache(DiskCache):
+    """ページ種別ごとの TTL と hit/miss 集計つき"""
+
+    def __init__(self, root: str, max_bytes: int, ttl: dict[str, float] | None = None):
+        super().__init__(root, max_bytes)
+        self.ttl = dict(ttl or HTML_CACHE_TTL)
+        self._counts: dict[str, dict[str, int]] = {}
+        self._count_lock = threading.Lock()
+
+    def _count(self, kind: str, what: str):
+        with self._count_lock:
+            c = self._counts.setdefault(kind, {"hit": 0, "miss": 0, "refresh": 0})
+            c[what] += 1
+
+    def get_text(self, kind: str, url: str, refresh: bool = False) -> str | None:
+        if refresh:
+            self._count(kind, "refresh")
+            return None
+        data = self.get(url, ttl=self.ttl.get(kind, 0))
+        if data is None:
+            self._count(kind, "miss")
+            return None
+        self._count(kind, "hit")
+        return data.decode("utf-8")
+
+    def put_text(self, kind: str, url: str, text: str):
+        self.put(url, text.encode("utf-8"))
+
+    def stats(self) -> dict:
+        with self._count_lock:
+            per_kind = {k: dict(v) for k, v in self._counts.items()}
+        return {
+            "hit": sum(v["hit"] for v in per_kind.values()),
+            "miss": sum(v["miss"] for v in per_kind.values()),
+            "refresh": sum(v["refresh"] for v in per_kind.values()),
+            "by_kind": per_kind,
+        }
+
+@_resource
+def get_html_cache() -> HtmlCache:
+    return HtmlCache(HTML_CACHE_DIR, HTML_CACHE_MAX_BYTES)
+
 # ==================================================
 # Supabase
 # ==================================================
-@st.cache_resource
+@_resource
 def get_supabase_client() -> Client | None:
     if not SUPABASE_URL or not SUPABASE_ANON_KEY:
         return None
     try:
+        from supabase import create_client
+
         return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
     except Exception as e:
         print("Supabase client error:", e)
         return None
 
 def save_history(year, place_code, place_name, month, day, race_num_str, race_id, ai_answer):
+    """history に1行積む（送信はバックグラウンドの HistoryWriter がまとめて行う）"""
     supabase = get_supabase_client()
     if not supabase:
         return
@@ -112,142 +628,1206 @@ def save_history(year, place_code, place_name, month, day, race_num_str, race_id
         "race_id": str(race_id),
         "output_text": ai_answer,
     }
-    try:
-        supabase.table("history").insert(data).execute()
-    except Exception as e:
-        print("Supabase insert error:", e)
+    get_history_writer().enqueue(data)
+
+class HistoryWriter:
+    """
+    history 行をキューに積み、別スレッドでまとめて insert する（従来どおり実行ごとに1行ずつ積み上がる）
+    - 一時的な失敗（通信エラー / 5xx 等）はバックオフして再送（max_retries 回まで）
+    - 行の値が原因の失敗（型・制約違反）は1行ずつ送り直し、通らなかった行だけ捨てる（dropped）
+    - 4xx / スキーマのエラーは送り直しても通らないので、ログに出して捨てる（dropped）
+    - 401/403（キーの期限切れ・差し替え / RLS の設定）は直るまで spool に退避する
+    - キューが溢れた行 / 再送しても届かなかった行は spool_path（JSONL）に退避し、次回起動時に再送
+    - flush() で送り切るまで待てる。プロセス終了時（atexit）にも flush する
+    """
+
+    def __init__(
+        self,
+        spool_path: str,
+        batch_size: int = 20,
+        flush_interval: float = 2.0,
+        max_queue: int = 500,
+        max_retries: int = 5,
+    ):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._q: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._spool_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True, name="history-writer")
+        self._thread.start()
+        self._replay_spool()
+
+    def enqueue(self, row: dict):
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            self._spool([row])
+
+    def flush(self, timeout: float | None = 30) -> bool:
+        """キューが空になり送信が終わるまで待つ（タイムアウトしたら False）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._q.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout: float | None = 30):
+        self.flush(timeout=timeout)
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        return {"queued": self._q.qsize(), "sent": self.sent, "spooled": self.spooled, "dropped": self.dropped}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            rows = [first]
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send(rows)
+            finally:
+                for _ in rows:
+                    self._q.task_done()
+
+    def _send(self, batch: list[dict]):
+        delay = 1.0
+        for attempt in range(self.max_retries + 1):
+            supabase = get_supabase_client()
+            if not supabase:
+                self._spool(batch)
+                return
+            try:
+                supabase.table("history").insert(batch).execute()
+                self.sent += len(batch)
+                return
+            except Exception as e:
+                kind = _history_error_kind(e)
+                if kind == "row" and len(batch) > 1:
+                    # どの行が悪いか分からないので1行ずつ送り直す（通る行まで捨てない）
+                    print(f"Supabase insert error（{len(batch)} 行を1行ずつ送り直します）:", e)
+                    for row in batch:
+                        self._send([row])
+                    return
+                if kind in ("row", "permanent"):
+                    print(f"Supabase insert error（送り直しても通らないので {len(batch)} 行を捨てます）:", e)
+                    self.dropped += len(batch)
+                    return
+                if kind == "auth":
+                    print(f"Supabase insert error（認証/権限。{len(batch)} 行を退避して次回起動時に再送）:", e)
+                    break
+                print(f"Supabase insert error (attempt {attempt + 1}):", e)
+                if attempt < self.max_retries and not self._stop.wait(delay):
+                    delay = min(delay * 2, 30.0)
+                    continue
+                break
+        self._spool(batch)
+
+    def _spool(self, rows: list[dict]):
+        if not rows:
+            return
+        try:
+            with self._spool_lock:
+                os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+                with open(self.spool_path, "a", encoding="utf-8") as f:
+                    for r in rows:
+                        f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            self.spooled += len(rows)
+        except OSError as e:
+            print("history spool error:", e, rows)
+
+    def _replay_spool(self):
+        """前回届かなかった行を読み込んで送り直す"""
+        with self._spool_lock:
+            try:
+                with open(self.spool_path, encoding="utf-8") as f:
+                    lines = f.readlines()
+                os.remove(self.spool_path)
+            except OSError:
+                return
+        for line in lines:
+            try:
+                self.enqueue(json.loads(line))
+            except ValueError:
+                continue
+
+def _history_error_kind(e: Exception) -> str:
+    """
+    history の insert の失敗の種類
+      "row"      : 行の値が原因（22***: 型・値 / 23***: 制約違反）。他の行は1行ずつなら通る
+      "auth"     : 401/403 / PGRST3**（JWT）。キーの期限切れ・差し替えや RLS の設定で、直れば通る
+      "permanent": 送り直しても通らない（その他の 4xx / PGRST*** / 42***: テーブル・列の定義）
+      "transient": 通信エラー / 5xx / 408 / 429
+    """
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    code = str(getattr(e, "code", "") or "")
+    if status is None and len(code) == 3 and code.isdigit():
+        status = int(code)  # JSON で返らなかった時は code に HTTP ステータスが入る
+    if code[:2] in ("22", "23") and len(code) == 5:
+        return "row"
+    if status in (401, 403) or code.startswith("PGRST3"):
+        return "auth"
+    if status is not None:
+        return "permanent" if 400 <= status < 500 and status not in (408, 429) else "transient"
+    if code.startswith("PGRST") or code[:2] == "42":
+        return "permanent"
+    return "transient"
+
+@_resource
+def get_history_writer() -> HistoryWriter:
+    writer = HistoryWriter(HISTORY_SPOOL_FILE)
+    atexit.register(writer.close)
+    return writer
+
+def flush_history(timeout: float | None = 30) -> bool:
+    return get_history_writer().flush(timeout=timeout)
 
 # ==================================================
 # Selenium Driver（競馬ブック用）
 # ==================================================
-def build_driver() -> webdriver.Chrome:
+class By:
+    """selenium.webdriver.common.by.By と同じ値（W3C の locator strategy）。selenium を読まずに ready を書ける"""
+    ID = "id"
+    NAME = "name"
+    CSS_SELECTOR = "css selector"
+    CLASS_NAME = "class name"
+    TAG_NAME = "tag name"
+    XPATH = "xpath"
+
+def _driver_wait(driver, timeout: float) -> WebDriverWait:
+    from selenium.webdriver.support.ui import WebDriverWait
+    return WebDriverWait(driver, timeout)
+
+# fast プロファイルで読まない URL（Network.setBlockedURLs の形式。* は任意の文字列）
+_BLOCKED_RESOURCE_EXTS = (
+    "png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "bmp",   # 画像
+    "woff", "woff2", "ttf", "otf", "eot",                        # フォント
+    "mp4", "webm", "m3u8", "mp3", "m4a", "ogg", "wav",           # 動画/音声
+)
+_BLOCKED_URL_PATTERNS = [p for ext in _BLOCKED_RESOURCE_EXTS for p in (f"*.{ext}", f"*.{ext}?*")]
+
+BROWSER_PROFILES = ("full", "fast")
+
+def _browser_allowed_hosts() -> list[str]:
+    hosts = [urlsplit(_keibabook_url("/")).hostname or ""]
+    hosts += [h.strip() for h in (BROWSER_ALLOW_HOSTS or "").split(",") if h.strip()]
+    return [h for h in hosts if h]
+
+def build_driver(profile: str | None = None) -> webdriver.Chrome:
+    """
+    profile（省略時は BROWSER_PROFILE = 既定 full）
+      full: 従来どおり（normal で全部読む）
+      fast: page_load_strategy=eager（DOMContentLoaded で返す）、画像/フォント/動画を読まない、
+            競馬ブック（と BROWSER_ALLOW_HOSTS）以外のホストは名前解決させない（広告/解析タグ）
+    """
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    profile = profile or BROWSER_PROFILE
+    if profile not in BROWSER_PROFILES:
+        raise ValueError(f"unknown browser profile: {profile}（{' / '.join(BROWSER_PROFILES)}）")
+
     options = Options()
     options.add_argument("--headless=new")
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--window-size=1400,2200")
-    return webdriver.Chrome(options=options)
+    if profile == "full":
+        options.add_argument("--window-size=1400,2200")
+        return webdriver.Chrome(options=options)
+
+    options.page_load_strategy = "eager"
+    options.add_argument("--window-size=1280,800")
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_argument("--disable-extensions")
+    options.add_argument("--disable-background-networking")
+    options.add_argument("--no-first-run")
+    options.add_argument("--mute-audio")
+    excludes = "".join(f", EXCLUDE {h}" for h in _browser_allowed_hosts())
+    options.add_argument(f"--host-resolver-rules=MAP * ~NOTFOUND{excludes}")
+    options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.media_stream": 2,
+    })
+    driver = webdriver.Chrome(options=options)
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": _BLOCKED_URL_PATTERNS})
+    except Exception as e:
+        # CDP が使えなくても取得はできる（読み込みが重いだけ）
+        print("browser profile: setBlockedURLs error:", e)
+    return driver
+
+def _keibabook_url(path: str) -> str:
+    base = (KEIBABOOK_BASE_URL or "").strip().rstrip("/")
+    return f"{base}{path}"
+
+def login_keibabook(driver: webdriver.Chrome, wait: WebDriverWait, use_saved: bool = True):
+    """
+    use_saved=True: 保存済み cookie があればそれを入れるだけ（フォームは叩かない）
+                    切れていたらページ取得時に検知して use_saved=False で呼び直す
+    """
+    if use_saved and restore_keibabook_cookies(driver):
+        return
+
+    driver.get(_keibabook_url("/login/login"))
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support import expected_conditions as EC
 
-def login_keibabook(driver: webdriver.Chrome, wait: WebDriverWait):
-    driver.get("https://s.keibabook.co.jp/login/login")
     wait.until(EC.visibility_of_element_located((By.NAME, "login_id"))).send_keys(KEIBA_ID)
     driver.find_element(By.CSS_SELECTOR, "input[type='password']").send_keys(KEIBA_PASS)
-    driver.find_element(By.CSS_SELECTOR, "input[type='submit']").click()
-    time.sleep(1)
+    submit = driver.find_element(By.CSS_SELECTOR, "input[type='submit']")
+    submit.click()
+    # 送信後のページに切り替わる（フォームが DOM から外れる）まで待つ
+    try:
+        wait.until(EC.staleness_of(submit))
+    except TimeoutException:
+        pass  # 遷移しなかった（ID/パスワード違い等）：従来どおりその時点の cookie を保存する
+
+    save_keibabook_cookies(driver.get_cookies())
+
+# ==================================================
+# 競馬ブック：ログイン cookie のファイル保存
+# ==================================================
+_cookie_file_lock = threading.Lock()
+
+def save_keibabook_cookies(cookies: list[dict]):
+    if not KEIBABOOK_COOKIE_FILE or not cookies:
+        return
+    tmp = f"{KEIBABOOK_COOKIE_FILE}.tmp"
+    try:
+        with _cookie_file_lock:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"saved_at": time.time(), "cookies": cookies}, f, ensure_ascii=False)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, KEIBABOOK_COOKIE_FILE)
+    except Exception as e:
+        print("cookie save error:", e)
+
+def load_keibabook_cookies() -> list[dict]:
+    """保存済み cookie（期限切れのものは除く）。無ければ []"""
+    if not KEIBABOOK_COOKIE_FILE or not os.path.exists(KEIBABOOK_COOKIE_FILE):
+        return []
+    try:
+        with _cookie_file_lock:
+            with open(KEIBABOOK_COOKIE_FILE, encoding="utf-8") as f:
+                cookies = (json.load(f) or {}).get("cookies") or []
+    except Exception as e:
+        print("cookie load error:", e)
+        return []
+    now = time.time()
+    return [c for c in cookies if not c.get("expiry") or c["expiry"] > now]
+
+def clear_keibabook_cookies():
+    try:
+        os.remove(KEIBABOOK_COOKIE_FILE)
+    except FileNotFoundError:
+        pass
+
+def restore_keibabook_cookies(driver) -> bool:
+    """保存済み cookie を driver に入れる（入れられたら True）"""
+    cookies = load_keibabook_cookies()
+    if not cookies:
+        return False
+    try:
+        # CDP なら対象ドメインを開かずに入れられる
+        driver.execute_cdp_cmd("Network.enable", {})
+        for c in cookies:
+            params = {
+                "name": c["name"],
+                "value": c["value"],
+                "domain": c.get("domain") or urlsplit(_keibabook_url("")).hostname,
+                "path": c.get("path", "/"),
+                "secure": bool(c.get("secure")),
+                "httpOnly": bool(c.get("httpOnly")),
+            }
+            if c.get("expiry"):
+                params["expires"] = c["expiry"]
+            driver.execute_cdp_cmd("Network.setCookie", params)
+        return True
+    except Exception:
+        pass
+    try:
+        driver.get(_keibabook_url("/"))
+        for c in cookies:
+            driver.add_cookie({k: v for k, v in c.items() if k != "sameSite"})
+        return True
+    except Exception as e:
+        print("cookie restore error:", e)
+        return False
+
+# ==================================================
+# 競馬ブック：ページ取得（ブラウザ / HTTP）
+# ==================================================
+def _looks_logged_out(html: str, url: str = "", expect_class: str | None = None) -> bool:
+    """
+    ログイン画面に飛ばされた（= セッション切れ）っぽいか
+    expect_class: 本来あるはずの要素（danwa/cyokyo 等）。無くてログイン導線だけある時も切れ扱い
+    """
+    html = html or ""
+    if "/login/login" in (url or ""):
+        return True
+    if 'name="login_id"' in html:
+        return True
+    # ログインへのリンクはどのページのヘッダにもあるので、本来の要素が無い時だけ見る
+    if expect_class and not _has_class(html, expect_class) and "/login/login" in html:
+        return True
+    return False
+
+@functools.lru_cache(maxsize=32)
+def _class_pattern(cls: str) -> re.Pattern:
+    """class 属性に cls がトークンとして入っているか（class="danwa default" / class='danwa' / class=danwa）"""
+    c = re.escape(cls)
+    return re.compile(
+        rf"""(?<![\w-])class\s*=\s*(?:(["'])(?:[^"']*?\s)?{c}(?:\s[^"']*)?\1|{c}(?=[\s/>]))""",
+        re.IGNORECASE,
+    )
+
+def _has_class(html: str, cls: str) -> bool:
+    return _class_pattern(cls).search(html) is not None
+
+def _expect_class(ready) -> str | None:
+    if ready and ready[0] == By.CLASS_NAME:
+        return ready[1]
+    return None
+
+def _page_kind(url: str) -> str | None:
+    """キャッシュの TTL 区分（対象外なら None）"""
+    for kind in ("nittei", "danwa", "cyokyo"):
+        if f"/chihou/{kind}/" in url:
+            return "schedule" if kind == "nittei" else kind
+    return None
+
+class _PageSource(ABC):
+    """
+    get_html: HTML キャッシュ → 無ければ _get_html_live（各実装）で取得して保存
+    refresh=True ならキャッシュを読まずに取り直す（取り直した結果は保存する）
+    ログイン切れの画面は保存しない
+    """
+
+    @abstractmethod
+    def _get_html_live(self, url: str, ready=None, timeout: float | None = None) -> str:
+        ...
+
+    def get_html(self, url: str, ready=None, timeout: float | None = None, refresh: bool = False) -> str:
+        kind = _page_kind(url)
+        cache = get_html_cache() if kind else None
+        if cache is not None:
+            html = cache.get_text(kind, url, refresh=refresh)
+            if html is not None:
+                return html
+
+        html = self._get_html_live(url, ready=ready, timeout=timeout)
+        if cache is not None and not _looks_logged_out(html, "", _expect_class(ready)):
+            cache.put_text(kind, url, html)
+        return html
+
+class BrowserPageSource(_PageSource):
+    """
+    従来どおり driver.get → WebDriverWait → page_source で取る
+    ログイン画面に飛ばされたら、その driver で再ログインして1回だけ取り直す
+    """
+
+    def __init__(self, driver, wait: WebDriverWait | None = None):
+        self.driver = driver
+        self.wait = wait or _driver_wait(driver, 12)
+
+    def _load(self, url: str, ready=None, timeout: float | None = None) -> str:
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support import expected_conditions as EC
+
+        self.driver.get(url)
+        if ready:
+            w = self.wait if timeout is None else _driver_wait(self.driver, timeout)
+            try:
+                w.until(EC.presence_of_element_located(ready))
+            except TimeoutException:
+                pass  # 目印が無い（ログイン画面 / レース無し）：そのまま返して呼び出し側で判定する
+        return self.driver.page_source
+
+    def relogin(self):
+        login_keibabook(self.driver, self.wait, use_saved=False)
+
+    def _get_html_live(self, url: str, ready=None, timeout: float | None = None) -> str:
+        html = self._load(url, ready=ready, timeout=timeout)
+        if not _looks_logged_out(html, self.driver.current_url, _expect_class(ready)):
+            return html
+        self.relogin()
+        return self._load(url, ready=ready, timeout=timeout)
+
+class HttpPageSource(_PageSource):
+    """
+    Selenium でログインした cookie を requests.Session（コネクションプール）に移して素の HTTP で取る。
+    セッション切れを検知した時だけ Chrome を起動して再ログインする。
+    スレッドセーフ（並列ワーカーで共有してよい）。
+    """
+
+    def __init__(self, pool_maxsize: int = 8, driver_pool=None):
+        self.driver_pool = driver_pool
+        self.sess = _build_requests_session(total=3, backoff=0.6, pool_maxsize=pool_maxsize)
+        self.sess.headers.update(_KEIBAGO_UA)
+        self._login_lock = threading.Lock()
+        self._login_gen = 0
+
+    def _set_cookies(self, cookies: list[dict]):
+        for c in cookies:
+            self.sess.cookies.set(
+                c["name"],
+                c["value"],
+                domain=c.get("domain"),
+                path=c.get("path", "/"),
+            )
+
+    def load_saved_cookies(self) -> bool:
+        """保存済み cookie があれば Chrome を起動せずにそれを使う"""
+        cookies = load_keibabook_cookies()
+        self._set_cookies(cookies)
+        return bool(cookies)
+
+    def adopt_driver_cookies(self, driver):
+        """ログイン済み driver の cookie / User-Agent をコピー"""
+        self._set_cookies(driver.get_cookies())
+        try:
+            ua = driver.execute_script("return navigator.userAgent")
+            if ua:
+                self.sess.headers["User-Agent"] = ua
+        except:
+            pass
+
+    def relogin(self):
+        """Chrome（プールがあれば常駐分）でログインし直し、cookie を取り込む"""
+        if self.driver_pool is not None:
+            with self.driver_pool.lease() as bp:
+                bp.relogin()
+                self.sess.cookies.clear()
+                self.adopt_driver_cookies(bp.driver)
+            return
+
+        driver = build_driver()
+        try:
+            login_keibabook(driver, _driver_wait(driver, 12), use_saved=False)
+            self.sess.cookies.clear()
+            self.adopt_driver_cookies(driver)
+        finally:
+            try:
+                driver.quit()
+            except:
+                pass
+
+    def _fetch(self, url: str) -> tuple[str, str]:
+        r = self.sess.get(url, timeout=25)
+        r.raise_for_status()
+        if "charset" not in r.headers.get("Content-Type", "").lower():
+            r.encoding = r.apparent_encoding or "utf-8"
+        return r.text, r.url
+
+    def _get_html_live(self, url: str, ready=None, timeout: float | None = None) -> str:
+        gen = self._login_gen
+        html, final_url = self._fetch(url)
+        if not _looks_logged_out(html, final_url, _expect_class(ready)):
+            return html
+
+        # セッション切れ：他スレッドが既に再ログインしていればそれを使う
+        with self._login_lock:
+            if gen == self._login_gen:
+                self.relogin()
+                self._login_gen += 1
+        html, _ = self._fetch(url)
+        return html
+
+def _as_page_source(driver):
+    if hasattr(driver, "get_html"):
+        return driver
+    return BrowserPageSource(driver)
+
+# ==================================================
+# Selenium Driver プール（Streamlit の rerun / セッションをまたいで常駐）
+# ==================================================
+def _quit_quietly(driver):
+    try:
+        driver.quit()
+    except:
+        pass
+
+class DriverPool:
+    """
+    ログイン済み Chrome を使い回すプール。
+    checkout() で BrowserPageSource を借りて checkin() で返す（lease() なら with で自動返却）。
+    借りる時に生存確認し、落ちていれば作り直す。セッション切れは BrowserPageSource 側で再ログイン。
+    idle_ttl 秒以上使われていないブラウザは次の checkout 時に閉じる。
+    """
+
+    def __init__(self, max_size: int = 3, idle_ttl: float = 30 * 60):
+        self.max_size = max(1, int(max_size))
+        self.idle_ttl = idle_ttl
+        self._idle: list[tuple[BrowserPageSource, float]] = []
+        self._n_alive = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def _launch(self) -> BrowserPageSource:
+        driver = build_driver()
+        try:
+            pages = BrowserPageSource(driver)
+            login_keibabook(driver, pages.wait)
+            return pages
+        except:
+            _quit_quietly(driver)
+            raise
+
+    @staticmethod
+    def _is_healthy(pages: BrowserPageSource) -> bool:
+        try:
+            pages.driver.current_url
+            return True
+        except:
+            return False
+
+    def _discard(self, pages: BrowserPageSource):
+        _quit_quietly(pages.driver)
+        with self._cond:
+            self._n_alive -= 1
+            self._cond.notify()
+
+    def _pop_stale_locked(self) -> list[BrowserPageSource]:
+        """idle_ttl を過ぎた待機ブラウザを外す（_n_alive もここで減らす）"""
+        now = time.monotonic()
+        stale = [p for p, t in self._idle if now - t > self.idle_ttl]
+        if stale:
+            self._idle = [(p, t) for p, t in self._idle if now - t <= self.idle_ttl]
+            self._n_alive -= len(stale)
+        return stale
+
+    def checkout(self, timeout: float | None = 120) -> BrowserPageSource:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pages = None
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("DriverPool は close 済みです")
+                stale = self._pop_stale_locked()
+                if self._idle:
+                    pages, _ = self._idle.pop()
+                elif self._n_alive < self.max_size:
+                    self._n_alive += 1  # 起動枠を確保
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("DriverPool: 空きブラウザ待ちでタイムアウトしました")
+                    self._cond.wait(remaining)
+                    continue
+
+            for p in stale:
+                _quit_quietly(p.driver)
+
+            if pages is None:
+                try:
+                    return self._launch()
+                except:
+                    with self._cond:
+                        self._n_alive -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(pages):
+                return pages
+            self._discard(pages)
+
+    def checkin(self, pages: BrowserPageSource, broken: bool = False):
+        if broken or self._closed or not self._is_healthy(pages):
+            self._discard(pages)
+            return
+        with self._cond:
+            self._idle.append((pages, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self, timeout: float | None = 120):
+        from selenium.common.exceptions import WebDriverException
+
+        pages = self.checkout(timeout=timeout)
+        broken = False
+        try:
+            yield pages
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            self.checkin(pages, broken=broken)
+
+    def warm(self, n: int = 1):
+        """ログイン済みブラウザを n 個（上限まで）先に用意しておく"""
+        launched = []
+        try:
+            for _ in range(n):
+                with self._cond:
+                    if len(self._idle) + len(launched) >= n or self._n_alive >= self.max_size:
+                        break
+                    self._n_alive += 1
+                try:
+                    launched.append(self._launch())
+                except Exception as e:
+                    with self._cond:
+                        self._n_alive -= 1
+                    print("DriverPool warm error:", e)
+                    break
+        finally:
+            for p in launched:
+                self.checkin(p)
+
+    def warm_async(self, n: int = 1):
+        threading.Thread(target=self.warm, args=(n,), daemon=True, name="driver-pool-warm").start()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"alive": self._n_alive, "idle": len(self._idle), "max_size": self.max_size}
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for p, _ in idle:
+            self._discard(p)
+
+@_resource
+def get_driver_pool() -> DriverPool:
+    pool = DriverPool(max_size=DRIVER_POOL_SIZE, idle_ttl=DRIVER_IDLE_TTL)
+    atexit.register(pool.close)
+    return pool
+
+# ==================================================
+# HTML パーサ（バックエンド切り替え）
+# ==================================================
+# name: (BeautifulSoup の builder, 必要な要素だけ組み立てるか)
+#   scan 系は SoupStrainer で対象テーブル等の部分木だけを作る（それ以外は読み飛ばす）
+#   html.parser 以外は合成ページと、それを崩したもの（閉じタグ抜け等）でしか比べていない。
+#   閉じていない <td>/<tr> は html.parser と lxml で木が変わり、抽出結果も変わる（録ったページで確かめるまで既定にしない）
+_PARSER_BACKENDS = {
+    "html.parser": ("html.parser", False),
+    "scan": ("html.parser", True),
+    "lxml": ("lxml", False),
+    "lxml-scan": ("lxml", True),
+}
+
+# ページごとに抽出で触る部分木
+_KEIBABOOK_ONLY = SoupStrainer(class_=["racetitle", "danwa", "cyokyo"])
+_SCHEDULE_ONLY = SoupStrainer("a", href=True)
+_KEIBAGO_ONLY = SoupStrainer("table")
+
+def _lxml_available() -> bool:
+    try:
+        import lxml  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def available_parser_backends() -> list[str]:
+    if _lxml_available():
+        return list(_PARSER_BACKENDS)
+    return [k for k, (builder, _) in _PARSER_BACKENDS.items() if builder != "lxml"]
+
+def make_soup(html: str, backend: str | None = None, only: SoupStrainer | None = None) -> BeautifulSoup:
+    """
+    backend 未指定なら HTML_PARSER。lxml が入っていなければ html.parser で代用する
+    only: scan 系バックエンドの時だけ使う SoupStrainer
+    """
+    builder, scan = _PARSER_BACKENDS.get(backend or HTML_PARSER, _PARSER_BACKENDS["html.parser"])
+    if builder == "lxml" and not _lxml_available():
+        builder = "html.parser"
+    if scan and only is not None:
+        return BeautifulSoup(html, builder, parse_only=only)
+    return BeautifulSoup(html, builder)
 
 # ==================================================
 # スクレイピング：日程→レースID一覧（競馬ブック）
 # ==================================================
-def fetch_race_ids_from_schedule(driver, year, month, day, target_place_code, ui: bool = False):
+def fetch_race_ids_from_schedule(driver, year, month, day, target_place_code, ui: bool = False, refresh: bool = False):
     """
     日程ページから「指定競馬場コード」のレースID(16桁)を拾う（競馬ブック）
+    driver には webdriver / BrowserPageSource / HttpPageSource のどれでも渡せる
+    """
+    return [rid for _, rid in fetch_schedule_races(driver, year, month, day, target_place_code, ui=ui, refresh=refresh)]
+
+def fetch_schedule_races(driver, year, month, day, target_place_code, ui: bool = False, refresh: bool = False,
+                         target_races: set[int] | None = None):
+    """
+    指定競馬場の [(race_num, race_id), ...]（レース番号順）
+    日程ページは日付ごとに1回だけ取って全場ぶん索引にする（get_schedule_index）
+    target_races のどれかが索引に無い時は、日程ページを1回だけ取り直してから判断する
+    （出走表の公開途中に取った索引が残っていることがある）。取り直しても無ければ索引は残さない
+    """
+    index = get_schedule_index(driver, year, month, day, ui=ui, refresh=refresh)
+    if _missing_races(index.get(target_place_code, []), target_races):
+        _invalidate_schedule(year, month, day)
+        index = get_schedule_index(driver, year, month, day, ui=ui, refresh=True)
+        if _missing_races(index.get(target_place_code, []), target_races):
+            _invalidate_schedule(year, month, day)
+    races = index.get(target_place_code, [])
+    if not races:
+        _ui_warning(ui, f"⚠️ 指定した競馬場コード({target_place_code})のレースIDが見つかりませんでした。")
+    else:
+        _ui_success(ui, f"✅ {len(races)} 件のレースIDを取得しました。")
+    return races
+
+# refresh=True でもこの秒数以内に取った索引は使う（同じ日の複数場を続けて回す時に日程を取り直さない）
+SCHEDULE_REFRESH_GRACE = 60
+
+class ScheduleIndexCache:
+    """日付 → {場コード: [(race_num, race_id), ...]}（プロセス内で実行・場をまたいで共有）"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[float, dict]] = {}
+
+    def get(self, date_str: str, max_age: float | None = None) -> dict | None:
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(date_str)
+        if entry is None or time.time() - entry[0] > max_age:
+            return None
+        return entry[1]
+
+    def put(self, date_str: str, index: dict):
+        with self._lock:
+            self._entries[date_str] = (time.time(), index)
+
+    def invalidate(self, date_str: str):
+        with self._lock:
+            self._entries.pop(date_str, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@_resource
+def get_schedule_index_cache() -> ScheduleIndexCache:
+    return ScheduleIndexCache(HTML_CACHE_TTL["schedule"])
+
+def _schedule_url(date_str: str) -> str:
+    return _keibabook_url(f"/chihou/nittei/{date_str}10")
+
+def _missing_races(races: list[tuple[int, str]], target_races: set[int] | None) -> set[int]:
+    return set(target_races or ()) - {n for n, _ in races}
+
+def _invalidate_schedule(year, month, day):
+    """日程の索引と日程ページの HTML キャッシュを捨てる（次は取り直す）"""
+    date_str = f"{year}{month}{day}"
+    get_schedule_index_cache().invalidate(date_str)
+    get_html_cache().invalidate(_schedule_url(date_str))
+
+def get_schedule_index(driver, year, month, day, ui: bool = False, refresh: bool = False) -> dict[str, list[tuple[int, str]]]:
+    """
+    日程ページ（nittei/{date}10）を取って全場の索引を返す。索引はキャッシュする
+    空の索引 / レース番号が読めずに通し番号にした場がある索引（公開途中・並びが崩れている）は残さない
     """
     date_str = f"{year}{month}{day}"
-    url = f"https://s.keibabook.co.jp/chihou/nittei/{date_str}10"
+    cache = get_schedule_index_cache()
+    index = cache.get(date_str, max_age=SCHEDULE_REFRESH_GRACE if refresh else None)
+    if index is not None:
+        return index
 
+    url = _schedule_url(date_str)
     _ui_info(ui, f"📅 日程ページからレースIDを取得中... ({url})")
-    driver.get(url)
+    pages = _as_page_source(driver)
+    html = pages.get_html(url, ready=(By.TAG_NAME, "a"), timeout=10, refresh=refresh)
 
-    try:
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "a")))
-    except:
-        pass
+    index, positional = _parse_schedule_index(html)
+    if index and not positional:
+        cache.put(date_str, index)
+    elif positional:
+        get_html_cache().invalidate(url)
+    return index
+
+_RACE_NO_TEXT = re.compile(r"^\s*(\d{1,2})\s*R")
+
+def parse_schedule_index(html: str, backend: str | None = None) -> dict[str, list[tuple[int, str]]]:
+    """
+    日程ページの全リンクを1回だけ走査して {場コード: [(race_num, race_id), ...]} にする
+    rid[6:8] が競馬場コード（競馬ブック側）。
+    レース番号はリンク文字列（"1R" 等）から取る。その場の全レースで取れなかった時
+    （番号が欠けている/重複している）だけ race_id 順の通し番号にする
+    """
+    return _parse_schedule_index(html, backend)[0]
 
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    race_ids = []
-    seen = set()
+def _parse_schedule_index(html: str, backend: str | None = None) -> tuple[dict[str, list[tuple[int, str]]], set[str]]:
+    """parse_schedule_index と、通し番号にした場コードの集合"""
+    soup = make_soup(html, backend, only=_SCHEDULE_ONLY)
+    by_place: dict[str, dict[str, int | None]] = {}
 
     for a in soup.find_all("a", href=True):
-        href = a["href"]
-        m = re.search(r"(\d{16})", href)
+        m = re.search(r"(\d{16})", a["href"])
         if not m:
             continue
         rid = m.group(1)
+        ids = by_place.setdefault(rid[6:8], {})
+        if ids.get(rid) is None:
+            t = _RACE_NO_TEXT.match(a.get_text())
+            ids[rid] = int(t.group(1)) if t else None
+
+    index = {}
+    positional = set()
+    for place_code, ids in by_place.items():
+        nums = list(ids.values())
+        if None in nums or len(set(nums)) != len(nums):
+            index[place_code] = list(enumerate(sorted(ids), 1))
+            positional.add(place_code)
+        else:
+            index[place_code] = sorted((n, rid) for rid, n in ids.items())
+    return index, positional
 
-        # rid[6:8] が競馬場コード（競馬ブック側）
-        if rid[6:8] == target_place_code:
-            if rid not in seen:
-                race_ids.append(rid)
-                seen.add(rid)
+def parse_schedule_race_ids(html: str, target_place_code: str, backend: str | None = None) -> list[str]:
+    return [rid for _, rid in parse_schedule_index(html, backend).get(target_place_code, [])]
 
-    race_ids.sort()
-    if not race_ids:
-        _ui_warning(ui, f"⚠️ 指定した競馬場コード({target_place_code})のレースIDが見つかりませんでした。")
-    else:
-        _ui_success(ui, f"✅ {len(race_ids)} 件のレースIDを取得しました。")
-    return race_ids
+# ==================================================
+# データモデル：レース / 出走馬（keiba.go.jp）/ 調教（競馬ブック）
+# ==================================================
+def _umaban_key(u: str) -> int:
+    return int(u) if str(u).isdigit() else 999
+
+@dataclass(slots=True)
+class Entry:
+    """keiba.go.jp 出馬表の1頭"""
+    umaban: str
+    waku: str = ""
+    horse: str = ""
+    trainer: str = "不明"
+    jockey: str = "不明"
+    prev_jockey: str = ""
+    is_change: bool = False
+
+    def to_row(self) -> tuple:
+        return (self.umaban, self.waku, self.horse, self.trainer, self.jockey, self.prev_jockey, self.is_change)
+
+    @classmethod
+    def from_row(cls, row) -> "Entry":
+        return cls(*row)
+
+    def to_dict(self) -> dict:
+        """入力指紋 / 前回との比較（RaceStateStore）で使う従来の形"""
+        return {
+            "waku": self.waku,
+            "umaban": self.umaban,
+            "horse": self.horse,
+            "trainer": self.trainer,
+            "jockey": self.jockey,
+            "prev_jockey": self.prev_jockey,
+            "is_change": self.is_change,
+        }
+
+@dataclass(slots=True)
+class TrainingRow:
+    """競馬ブック調教ページの1頭"""
+    umaban: str
+    horse: str = ""
+    tanpyo: str = ""
+    detail: str = ""
+
+    def to_row(self) -> tuple:
+        return (self.umaban, self.horse, self.tanpyo, self.detail)
+
+    @classmethod
+    def from_row(cls, row) -> "TrainingRow":
+        return cls(*row)
+
+    def text(self) -> str:
+        return f"【馬名】{self.horse} 【短評】{self.tanpyo} 【詳細】{self.detail}"
+
+@dataclass(slots=True)
+class Race:
+    """
+    1レース分の入力（出馬表 + 談話 + 調教）。プロンプトは render_race_prompt で別に作る
+    race_name / cond が None なら競馬ブックのレース名欄が無かった（race_meta = {}）
+    """
+    race_num: int
+    race_id: str
+    race_name: str | None = None
+    cond: str | None = None
+    entries: dict[str, Entry] = field(default_factory=dict)
+    danwa: dict[str, str] = field(default_factory=dict)
+    training: dict[str, TrainingRow] = field(default_factory=dict)
+    keibago_header: str = ""
+    keibago_url: str = ""
+
+    def umabans(self) -> list[str]:
+        """出馬表/談話/調教のどれかにいる馬番（番号順）"""
+        return sorted(self.entries.keys() | self.danwa.keys() | self.training.keys(), key=_umaban_key)
+
+    @property
+    def race_meta(self) -> dict:
+        if self.race_name is None and self.cond is None:
+            return {}
+        return {"race_name": self.race_name or "", "cond": self.cond or ""}
+
+    def to_inputs(self) -> dict:
+        """従来の入力 dict（race_fingerprint / diff_race_inputs / RaceStateStore と互換）"""
+        return {
+            "race_meta": self.race_meta,
+            "keibago": {u: e.to_dict() for u, e in self.entries.items()},
+            "danwa": dict(self.danwa),
+            "cyokyo": {u: t.text() for u, t in self.training.items()},
+        }
+
+    # ---------- 直列化（入れ子のタプル/リストだけにする。JSON にそのまま載る） ----------
+    def to_row(self) -> tuple:
+        return (
+            self.race_num, self.race_id, self.race_name, self.cond,
+            [e.to_row() for e in self.entries.values()],
+            list(self.danwa.items()),
+            [t.to_row() for t in self.training.values()],
+            self.keibago_header, self.keibago_url,
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "Race":
+        race_num, race_id, race_name, cond, entries, danwa, training, header, url = row
+        return cls(
+            race_num, race_id, race_name, cond,
+            {e[0]: Entry.from_row(e) for e in entries},
+            dict(danwa),
+            {t[0]: TrainingRow.from_row(t) for t in training},
+            header, url,
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_row(), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, s: str) -> "Race":
+        return cls.from_row(json.loads(s))
+
+def _clip(text: str, limit: int | None) -> str:
+    """limit=None はそのまま / 0 は空 / それ以外は limit 文字で切って「…」"""
+    if limit is None or len(text) <= limit:
+        return text
+    return text[:limit] + "…" if limit > 0 else ""
+
+def render_horse_lines(race: Race, detail_max: int | None = None, danwa_max: int | None = None) -> list[str]:
+    """馬番で揃えた1頭ずつのプロンプト行（detail_max / danwa_max は予算超過時の切り詰め）"""
+    lines = []
+    for uma in race.umabans():
+        e = race.entries.get(uma) or Entry(uma)
+        alert = "【⚠️乗り替わり】" if e.is_change else ""
+        if e.prev_jockey:
+            alert += f"（前走:{e.prev_jockey}）"
+        t = race.training.get(uma)
+        if t is not None and detail_max is not None:
+            t = TrainingRow(t.umaban, t.horse, t.tanpyo, _clip(t.detail, detail_max))
+        d = race.danwa.get(uma)
+        lines.append(
+            f"▼[馬番{uma}] 馬名:{e.horse} 騎手:{e.jockey} {alert} 調教師:{e.trainer}\n"
+            f"談話: {_clip(d, danwa_max) if d is not None else '（なし）'}\n"
+            f"調教: {t.text() if t else '（なし）'}"
+        )
+    return lines
+
+_COMPACT_LEGEND = "各馬（1行1頭: 馬番|馬名|騎手|調教師|乗替|談話|調教短評|調教詳細。空欄は情報なし）"
+
+def render_compact_lines(race: Race, detail_max: int | None = None, danwa_max: int | None = None) -> list[str]:
+    """1頭1行の区切り形式（項目名は凡例で1回だけ）。乗替は乗り替わりの時だけ「替(前:前走騎手)」"""
+    lines = []
+    for uma in race.umabans():
+        e = race.entries.get(uma)
+        t = race.training.get(uma)
+        fields = [
+            uma,
+            (e.horse if e else "") or (t.horse if t else ""),
+            e.jockey if e else "",
+            e.trainer if e else "",
+            f"替(前:{e.prev_jockey})" if e and e.is_change else "",
+            _clip(race.danwa.get(uma, ""), danwa_max),
+            t.tanpyo if t else "",
+            _clip(t.detail, detail_max) if t else "",
+        ]
+        lines.append("|".join(f.replace("|", "/") for f in fields))
+    return lines
+
+def render_race_prompt(race: Race, place_name: str | None = None, horse_lines: list[str] | None = None) -> str:
+    """Dify に渡すプロンプト。place_name を渡すと先頭に「○○競馬場のレースのデータです。」を付ける"""
+    meta = race.race_meta
+    head = f"{place_name}競馬場のレースのデータです。\n\n" if place_name else ""
+    lines = horse_lines if horse_lines is not None else render_horse_lines(race)
+    return (
+        head
+        + f"レース名: {meta.get('race_name','')}\n"
+        f"条件: {meta.get('cond','')}\n\n"
+        "以下の各馬のデータ（馬名、騎手、乗り替わり、調教師、談話、調教）です。\n"
+        + "\n".join(lines)
+    )
+
+def render_compact_prompt(race: Race, place_name: str | None = None, horse_lines: list[str] | None = None) -> str:
+    meta = race.race_meta
+    head = f"{place_name}競馬場のレースのデータです。\n" if place_name else ""
+    lines = horse_lines if horse_lines is not None else render_compact_lines(race)
+    return (
+        head
+        + f"レース名: {meta.get('race_name','')}\n"
+        f"条件: {meta.get('cond','')}\n"
+        f"{_COMPACT_LEGEND}\n"
+        + "\n".join(lines)
+    )
+
+def approx_tokens(text: str) -> int:
+    """おおよそのトークン数（日本語など非 ASCII は1文字≒1トークン、ASCII は4文字≒1トークン）"""
+    n_ascii = len(text.encode("ascii", "ignore"))
+    return (len(text) - n_ascii) + (n_ascii + 3) // 4
+
+# 予算を超えた時に順に試す切り詰め（価値の低いものから：調教の詳細（時計）→ 談話）
+_PROMPT_TRIM_STEPS = (
+    ("none", None, None),
+    ("detail40", 40, None),
+    ("no_detail", 0, None),
+    ("danwa80", 0, 80),
+    ("danwa40", 0, 40),
+)
+
+def build_race_prompt(
+    race: Race, place_name: str | None = None, fmt: str | None = None, budget: int | None = None,
+) -> tuple[str, dict]:
+    """
+    PROMPT_FORMAT の形式でプロンプトを作り、PROMPT_TOKEN_BUDGET を超えたら切り詰める
+    return: (prompt, {"format", "budget", "tokens_before", "tokens_after", "trim", "over_budget"})
+            tokens_before は切り詰め前、trim は使った切り詰め（"none" なら削っていない）
+            over_budget=True は全部削っても予算に収まらなかった（そのまま送る）
+    """
+    fmt = fmt or PROMPT_FORMAT
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    render_lines, render = (
+        (render_compact_lines, render_compact_prompt) if fmt == "compact" else (render_horse_lines, render_race_prompt)
+    )
+
+    stats = {"format": fmt, "budget": budget}
+    for trim, detail_max, danwa_max in _PROMPT_TRIM_STEPS:
+        prompt = render(race, place_name, render_lines(race, detail_max=detail_max, danwa_max=danwa_max))
+        tokens = approx_tokens(prompt)
+        stats.setdefault("tokens_before", tokens)
+        if budget <= 0 or tokens <= budget:
+            break
+    stats.update(tokens_after=tokens, trim=trim, over_budget=budget > 0 and tokens > budget)
+    return prompt, stats
+
+def format_prompt_stats(stats: dict) -> str:
+    """表示用：「プロンプト 約1234→987トークン（調教詳細を削除）」"""
+    labels = {"detail40": "調教詳細を短縮", "no_detail": "調教詳細を削除", "danwa80": "調教詳細を削除・談話を短縮",
+              "danwa40": "調教詳細を削除・談話を短縮"}
+    text = f"プロンプト 約{stats['tokens_before']}"
+    if stats["tokens_after"] != stats["tokens_before"]:
+        text += f"→{stats['tokens_after']}"
+    text += "トークン"
+    if stats.get("trim") in labels:
+        text += f"（{labels[stats['trim']]}）"
+    if stats.get("over_budget"):
+        text += f"（上限 {stats['budget']} 超過のまま）"
+    return text
 
 # ==================================================
 # 競馬ブック：レース情報/談話/調教
 # ==================================================
-def parse_race_info(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    racetitle = soup.find("div", class_="racetitle")
-    if not racetitle:
-        return {}
+class KeibabookPage:
+    """
+    競馬ブックの1ページを1回だけパースして、各抽出で同じ DOM を使い回す
+    （談話ページ → race_info + danwa_comments、調教ページ → cyokyo）
+    """
+
+    def __init__(self, html: str, backend: str | None = None):
+        self.html = html
+        self.backend = backend
+        self._soup = None
+
+    @property
+    def soup(self) -> BeautifulSoup:
+        if self._soup is None:
+            self._soup = make_soup(self.html, self.backend, only=_KEIBABOOK_ONLY)
+        return self._soup
+
+    def race_info(self) -> dict:
+        racetitle = self.soup.find("div", class_="racetitle")
+        if not racetitle:
+            return {}
+
+        racemei = racetitle.find("div", class_="racemei")
+        p_tags = racemei.find_all("p") if racemei else []
+        race_name = ""
+        if len(p_tags) >= 2:
+            race_name = p_tags[1].get_text(strip=True)
+        elif len(p_tags) == 1:
+            race_name = p_tags[0].get_text(strip=True)
+
+        sub = racetitle.find("div", class_="racetitle_sub")
+        sub_p = sub.find_all("p") if sub else []
+        cond = sub_p[1].get_text(" ", strip=True) if len(sub_p) >= 2 else ""
+
+        return {"race_name": race_name, "cond": cond}
+
+    def danwa_comments(self) -> dict:
+        danwa_dict = {}
+        table = self.soup.find("table", class_="danwa")
+
+        if table:
+            current_uma = None
+            # HTTP で取った生の HTML には tbody が無いことがある（ブラウザの DOM には補われる）
+            for row in (table.tbody or table).find_all("tr"):
+                uma_td = row.find("td", class_="umaban")
+                if uma_td:
+                    current_uma = uma_td.get_text(strip=True)
+                    continue
+
+                txt_td = row.find("td", class_="danwa")
+                if txt_td and current_uma:
+                    danwa_dict[current_uma] = txt_td.get_text(strip=True)
+                    current_uma = None
 
-    racemei = racetitle.find("div", class_="racemei")
-    p_tags = racemei.find_all("p") if racemei else []
-    race_name = ""
-    if len(p_tags) >= 2:
-        race_name = p_tags[1].get_text(strip=True)
-    elif len(p_tags) == 1:
-        race_name = p_tags[0].get_text(strip=True)
-
-    sub = racetitle.find("div", class_="racetitle_sub")
-    sub_p = sub.find_all("p") if sub else []
-    cond = sub_p[1].get_text(" ", strip=True) if len(sub_p) >= 2 else ""
-
-    return {"race_name": race_name, "cond": cond}
-
-def parse_danwa_comments(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    danwa_dict = {}
-    table = soup.find("table", class_="danwa")
-
-    if table and table.tbody:
-        current_uma = None
-        for row in table.tbody.find_all("tr"):
-            uma_td = row.find("td", class_="umaban")
-            if uma_td:
-                current_uma = uma_td.get_text(strip=True)
+        return danwa_dict
+
+    def cyokyo(self) -> dict:
+        return {u: t.text() for u, t in self.training_rows().items()}
+
+    def training_rows(self) -> dict[str, TrainingRow]:
+        rows_by_uma = {}
+        tables = self.soup.find_all("table", class_="cyokyo")
+        for tbl in tables:
+            rows = (tbl.find("tbody") or tbl).find_all("tr", recursive=False)
+            if not rows:
                 continue
 
-            txt_td = row.find("td", class_="danwa")
-            if txt_td and current_uma:
-                danwa_dict[current_uma] = txt_td.get_text(strip=True)
-                current_uma = None
+            h_row = rows[0]
+            uma_td = h_row.find("td", class_="umaban")
+            name_td = h_row.find("td", class_="kbamei")
+            if not uma_td or not name_td:
+                continue
 
-    return danwa_dict
+            umaban = uma_td.get_text(strip=True)
+            bamei = name_td.get_text(" ", strip=True)
 
-def parse_cyokyo(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    cyokyo_dict = {}
-    tables = soup.find_all("table", class_="cyokyo")
-    for tbl in tables:
-        tbody = tbl.find("tbody")
-        if not tbody:
-            continue
-        rows = tbody.find_all("tr", recursive=False)
-        if not rows:
-            continue
+            tanpyo_elem = h_row.find("td", class_="tanpyo")
+            tanpyo = tanpyo_elem.get_text(strip=True) if tanpyo_elem else ""
+            detail = rows[1].get_text(" ", strip=True) if len(rows) > 1 else ""
 
-        h_row = rows[0]
-        uma_td = h_row.find("td", class_="umaban")
-        name_td = h_row.find("td", class_="kbamei")
-        if not uma_td or not name_td:
-            continue
+            rows_by_uma[umaban] = TrainingRow(umaban, bamei, tanpyo, detail)
 
-        umaban = uma_td.get_text(strip=True)
-        bamei = name_td.get_text(" ", strip=True)
+        return rows_by_uma
 
-        tanpyo_elem = h_row.find("td", class_="tanpyo")
-        tanpyo = tanpyo_elem.get_text(strip=True) if tanpyo_elem else ""
-        detail = rows[1].get_text(" ", strip=True) if len(rows) > 1 else ""
+def parse_race_info(html: str, backend: str | None = None):
+    return KeibabookPage(html, backend).race_info()
 
-        cyokyo_dict[umaban] = f"【馬名】{bamei} 【短評】{tanpyo} 【詳細】{detail}"
+def parse_danwa_comments(html: str, backend: str | None = None):
+    return KeibabookPage(html, backend).danwa_comments()
 
-    return cyokyo_dict
+def parse_cyokyo(html: str, backend: str | None = None):
+    return KeibabookPage(html, backend).cyokyo()
 
 # ==================================================
 # 地方競馬公式（keiba.go.jp）：DOMで出馬表を堅牢にパース
@@ -274,21 +1854,103 @@ def _extract_jockey_from_cell(td) -> str:
         return lines2[0].replace(" ", "")
     return "不明"
 
-def fetch_keibago_debatable_small(year: str, month: str, day: str, race_no: int, baba_code: str):
-    """
-    keiba.go.jp DebaTableSmall を堅牢に読む版（rowspan/列ズレ耐性あり）
-    """
+# keiba.go.jp の出馬表は UTF-8 固定（ヘッダに charset が無い時も全文の文字コード推定はしない）
+_KEIBAGO_ENCODING = "utf-8"
+
+# 使い回し（keiba.go.jp）：keep-alive で同じ接続を使う
+@_resource
+def get_keibago_session() -> requests.Session:
+    sess = _build_requests_session(total=3, backoff=0.6, pool_maxsize=12)
+    sess.headers.update(_KEIBAGO_UA)
+    return sess
+
+def _keibago_url(path: str) -> str:
+    base = (KEIBAGO_BASE_URL or "").strip().rstrip("/")
+    return f"{base}{path}"
+
+def _keibago_debatable_url(year: str, month: str, day: str, race_no: int, baba_code: str) -> str:
     date_str = f"{year}/{str(month).zfill(2)}/{str(day).zfill(2)}"
-    url = (
-        "https://www.keiba.go.jp/KeibaWeb/TodayRaceInfo/DebaTableSmall"
+    return _keibago_url(
+        "/KeibaWeb/TodayRaceInfo/DebaTableSmall"
         f"?k_raceDate={requests.utils.quote(date_str)}&k_raceNo={race_no}&k_babaCode={baba_code}"
     )
 
-    sess = _build_requests_session(total=3, backoff=0.6)
-    r = sess.get(url, headers=_KEIBAGO_UA, timeout=25)
-    r.raise_for_status()
-    r.encoding = r.apparent_encoding or "utf-8"
-    soup = BeautifulSoup(r.text, "html.parser")
+def _decode_keibago(r: requests.Response) -> str:
+    if "charset" in r.headers.get("Content-Type", "").lower():
+        return r.text
+    try:
+        return r.content.decode(_KEIBAGO_ENCODING)
+    except UnicodeDecodeError:
+        # 想定外の文字コードの時だけ推定する
+        r.encoding = r.apparent_encoding or "utf-8"
+        return r.text
+
+def fetch_keibago_debatable_small(year: str, month: str, day: str, race_no: int, baba_code: str, refresh: bool = False):
+    """
+    keiba.go.jp DebaTableSmall を堅牢に読む版（rowspan/列ズレ耐性あり）
+    refresh=True: HTML キャッシュを使わず取り直す
+    return: (header, {umaban: Entry}, url)
+    """
+    url = _keibago_debatable_url(year, month, day, race_no, baba_code)
+
+    cache = get_html_cache()
+    html = cache.get_text("keibago", url, refresh=refresh)
+    if html is None:
+        r = get_keibago_session().get(url, timeout=25)
+        r.raise_for_status()
+        html = _decode_keibago(r)
+        cache.put_text("keibago", url, html)
+
+    header, entries = parse_keibago_entries(html)
+    return header, entries, url
+
+def prefetch_keibago_debatables(
+    year: str,
+    month: str,
+    day: str,
+    race_nos: list[int],
+    baba_code: str,
+    max_workers: int = 6,
+    refresh: bool = False,
+    timings=None,
+) -> dict:
+    """
+    選択レースの DebaTableSmall をまとめて並列取得する（実行の最初に1回呼ぶ用）
+    return: {race_no: (header, horses, url)}（失敗したレースは例外オブジェクトが入る）
+    timings: RunTimings を渡すとレースごとに "keibago" の span を残す
+    """
+    race_nos = list(race_nos)
+    if not race_nos:
+        return {}
+
+    get_keibago_session()
+    get_html_cache()
+
+    def _one(race_no: int):
+        with timings.span("keibago", race_no) if timings is not None else nullcontext():
+            return fetch_keibago_debatable_small(
+                year=str(year), month=str(month), day=str(day),
+                race_no=race_no, baba_code=str(baba_code), refresh=refresh,
+            )
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(race_nos))), thread_name_prefix="keibago") as ex:
+        futures = {ex.submit(_one, n): n for n in race_nos}
+        for fut in as_completed(futures):
+            try:
+                results[futures[fut]] = fut.result()
+            except Exception as e:
+                results[futures[fut]] = e
+    return results
+
+def parse_keibago_debatable_small(html: str, backend: str | None = None):
+    """DebaTableSmall の HTML → (header, {umaban: 従来の dict})"""
+    header, entries = parse_keibago_entries(html, backend)
+    return header, {u: e.to_dict() for u, e in entries.items()}
+
+def parse_keibago_entries(html: str, backend: str | None = None) -> tuple[str, dict[str, Entry]]:
+    """DebaTableSmall の HTML → (header, {umaban: Entry})"""
+    soup = make_soup(html, backend, only=_KEIBAGO_ONLY)
 
     header = ""
     top_bs = soup.select_one("table.bs")
@@ -303,7 +1965,7 @@ def fetch_keibago_debatable_small(year: str, month: str, day: str, race_no: int,
     last_waku = ""
 
     if not main_table:
-        return header, horses, url
+        return header, horses
 
     for tr in main_table.find_all("tr"):
         if not tr.select_one("font.bamei"):
@@ -358,17 +2020,17 @@ def fetch_keibago_debatable_small(year: str, month: str, day: str, race_no: int,
         pj = _norm_name(prev_jockey)
         is_change = bool(pj and cj and pj != cj)
 
-        horses[str(umaban)] = {
-            "waku": str(waku),
-            "umaban": str(umaban),
-            "horse": horse,
-            "trainer": trainer if trainer else "不明",
-            "jockey": jockey if jockey else "不明",
-            "prev_jockey": prev_jockey,
-            "is_change": is_change,
-        }
+        horses[str(umaban)] = Entry(
+            umaban=str(umaban),
+            waku=str(waku),
+            horse=horse,
+            trainer=trainer if trainer else "不明",
+            jockey=jockey if jockey else "不明",
+            prev_jockey=prev_jockey,
+            is_change=is_change,
+        )
 
-    return header, horses, url
+    return header, horses
 
 # ==================================================
 # Dify：堅牢版（streaming + blockingフォールバック）
@@ -411,11 +2073,28 @@ def _pick_output(outputs: dict) -> str:
                 best_len = len(s)
     return best.strip()
 
-def stream_dify_workflow(full_text: str):
+def _parse_sse_line(line: str) -> dict | None:
+    """SSE の1行（"data: {...}"）→ イベント dict（それ以外の行は None）"""
+    if not line or not line.startswith("data:"):
+        return None
+    raw = line[5:].lstrip()
+    if not raw:
+        return None
+    try:
+        evt = json.loads(raw)
+    except:
+        return None
+    return evt if isinstance(evt, dict) else None
+
+def stream_dify_workflow(full_text: str, on_delta=None, on_event=None, cancel: threading.Event | None = None):
     """
     streaming のイベントから「回答テキストのみ」を返す。
     ★重要：node_finished の outputs（queries/STOP等）が混ざるので基本拾わない
     ★workflow_finished は、answer増分が1文字も来なかった時の保険としてのみ採用
+    on_delta: 途中経過の表示用。answer 増分と workflow の text_chunk（data.text）が届くたびに呼ぶ
+              （text_chunk は yield しない。回答は従来どおり workflow_finished の outputs から取る）
+    on_event: SSE の空でない行（"event: ping" などの keep-alive も含む）が届くたびに呼ぶ（期限の判定用）
+    cancel  : set されたら次のイベントで読むのをやめる（並走させた blocking が先に返った時）
     """
     if not DIFY_API_KEY:
         yield "⚠️ DIFY_API_KEY未設定"
@@ -436,120 +2115,1439 @@ def stream_dify_workflow(full_text: str):
 
     sess = get_http_session()
 
+    res = None
     try:
         res = sess.post(url, headers=headers, json=payload, stream=True, timeout=300)
         if res.status_code != 200:
             yield _format_http_error(res)
             return
+        # SSE は UTF-8 固定（charset 無しだと requests が ISO-8859-1 で読んで行が壊れる）
+        if "charset" not in res.headers.get("Content-Type", "").lower():
+            res.encoding = "utf-8"
 
         got_any_event = False
         got_any_answer = False
         final_from_outputs = ""
 
         for line in res.iter_lines(decode_unicode=True):
-            if not line:
+            if cancel is not None and cancel.is_set():
+                return
+            # Dify は LLM が黙っている間も ping を流すので、パースできない行も生きている印として数える
+            if line and on_event is not None:
+                on_event()
+            evt = _parse_sse_line(line)
+            if evt is None:
+                continue
+
+            got_any_event = True
+
+            # ✅ 1) まず answer 増分だけを拾う（これが最優先）
+            if "answer" in evt and isinstance(evt["answer"], str) and evt["answer"]:
+                got_any_answer = True
+                if on_delta is not None:
+                    on_delta(evt["answer"])
+                yield evt["answer"]
                 continue
 
-            # SSE: "data: {...}"
-            if not line.startswith("data:"):
-                continue
+            ev = evt.get("event")
+            if ev == "text_chunk":
+                text = (evt.get("data", {}) or {}).get("text")
+                if on_delta is not None and isinstance(text, str) and text:
+                    on_delta(text)
+                continue
+
+            if ev == "workflow_finished":
+                data = evt.get("data", {}) or {}
+                outputs = data.get("outputs", {}) or {}
+                final_from_outputs = _pick_output(outputs)
+
+                # answer増分が1文字も来なかった場合のみ、outputsを返す
+                if (not got_any_answer) and final_from_outputs:
+                    yield final_from_outputs
+                else:
+                    # 既に answer を返している場合は重複を避けて何も返さない
+                    pass
+                return
+
+        if not got_any_event:
+            yield "⚠️ DifyがSSEを返しませんでした（URL/キー/アプリ種別/inputs名/ネットワークの可能性）"
+
+    except Exception as e:
+        yield f"⚠️ Dify API Error: {str(e)}"
+
+    finally:
+        if res is not None:
+            res.close()
+
+def run_dify_workflow_blocking(full_text: str) -> str:
+    """結果だけ欲しいならこれが一番安定"""
+    if not DIFY_API_KEY:
+        return "⚠️ DIFY_API_KEY未設定"
+
+    url = _dify_url("/v1/workflows/run")
+    payload = {
+        "inputs": {"text": full_text},
+        "response_mode": "blocking",
+        "user": "keiba-bot",
+    }
+    headers = {
+        "Authorization": f"Bearer {DIFY_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+    sess = get_http_session()
+
+    try:
+        res = sess.post(url, headers=headers, json=payload, timeout=300)
+        if res.status_code != 200:
+            return _format_http_error(res)
+
+        j = res.json() or {}
+        data = j.get("data", {}) or {}
+        outputs = data.get("outputs", {}) or {}
+
+        picked = _pick_output(outputs)
+        if picked:
+            return picked
+
+        err = data.get("error")
+        if err:
+            return f"⚠️ blocking error: {err}"
+
+        return "⚠️ blockingで outputs が空でした"
+
+    except Exception as e:
+        return f"⚠️ blocking API Error: {str(e)}"
+
+def _stream_failed(streamed: str) -> bool:
+    """streaming の結果が使えない（空 / SSE なし / HTTP・通信エラー）"""
+    return (
+        (not streamed)
+        or ("SSEを返しません" in streamed)
+        or streamed.startswith(("⚠️ Dify HTTP", "⚠️ Dify API Error"))
+    )
+
+def _hedge_deadline(t_open: float | None, n_events: int, t_last: float | None,
+                    first_event_timeout: float, idle_timeout: float) -> tuple[float | None, str]:
+    """次に blocking を並走させる時刻と理由（期限なしなら None）"""
+    if t_open is None:
+        return None, ""
+    if n_events == 0:
+        return (t_open + first_event_timeout if first_event_timeout > 0 else None), "first_event"
+    return (t_last + idle_timeout if idle_timeout > 0 else None), "idle"
+
+# cancel を見に行く間隔（秒）と、中断した時に返す文字列
+_CANCEL_POLL_S = 0.2
+DIFY_CANCELLED = "⚠️ 中断しました"
+
+def run_dify_with_fallback(
+    full_text: str,
+    stats: dict | None = None,
+    on_chunk=None,
+    first_event_timeout: float | None = None,
+    idle_timeout: float | None = None,
+    cancel: threading.Event | None = None,
+) -> str:
+    """
+    streaming で回収 → 使えない時は blocking にフォールバック
+    streaming が最初のイベントを first_event_timeout 秒返さない / イベントが idle_timeout 秒途切れた時は
+    streaming を待ったまま blocking を並走させ、先に返った使える回答を採用する（負けた方は捨てる）
+    stats: dict を渡すと {"mode": "stream" | "blocking", "first_token_s", "hedged", "hedge_reason"} が入る
+           mode は採用した方。hedge_reason は first_event / idle / stream_error（並走しなかった時は無し）
+    on_chunk: 回答の増分が届くたびに on_chunk(text) を呼ぶ（blocking を採用した時は戻り値が正）
+    cancel: set されたら回答を待たずに "⚠️ 中断しました" を返す（stats["mode"]="cancelled"。裏の通信は捨てる）
+    """
+    stats = {} if stats is None else stats
+    first_event_timeout = DIFY_FIRST_EVENT_TIMEOUT if first_event_timeout is None else first_event_timeout
+    idle_timeout = DIFY_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+
+    t0 = time.perf_counter()
+    results: queue.Queue = queue.Queue()
+    decided = threading.Event()
+    progress = {"events": 0, "last": t0}
+
+    def _event():
+        progress["events"] += 1
+        progress["last"] = time.perf_counter()
+
+    def _delta(text: str):
+        if decided.is_set():
+            return
+        stats.setdefault("first_token_s", time.perf_counter() - t0)
+        if on_chunk is not None:
+            on_chunk(text)
+
+    def _stream():
+        chunks = []
+        try:
+            for c in stream_dify_workflow(full_text, on_delta=_delta, on_event=_event, cancel=decided):
+                chunks.append(c)
+                if isinstance(c, str) and c.startswith(("⚠️ Dify HTTP", "⚠️ Dify API Error")):
+                    chunks = [c]
+                    break
+                stats.setdefault("first_token_s", time.perf_counter() - t0)
+        finally:
+            results.put(("stream", "".join(chunks).strip()))
+
+    def _blocking():
+        answer = ""
+        try:
+            answer = (run_dify_workflow_blocking(full_text) or "").strip()
+        finally:
+            results.put(("blocking", answer))
+
+    threading.Thread(target=_stream, name="dify-stream", daemon=True).start()
+    hedge_started = False
+    stream_done = blocking_done = False
+    blocking_answer = ""
+
+    def _hedge(reason: str):
+        nonlocal hedge_started
+        hedge_started = True
+        stats["hedged"] = True
+        stats["hedge_reason"] = reason
+        threading.Thread(target=_blocking, name="dify-hedge", daemon=True).start()
+
+    try:
+        while True:
+            timeout = None
+            if not hedge_started:
+                deadline, reason = _hedge_deadline(t0, progress["events"], progress["last"],
+                                                   first_event_timeout, idle_timeout)
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.perf_counter())
+            if cancel is not None:
+                if cancel.is_set():
+                    stats["mode"] = "cancelled"
+                    return DIFY_CANCELLED
+                timeout = _CANCEL_POLL_S if timeout is None else min(timeout, _CANCEL_POLL_S)
+            try:
+                path, answer = results.get(timeout=timeout)
+            except queue.Empty:
+                # 期限は最後のイベントから測り直す（get の間に届いていればもう一周待つ）
+                deadline, reason = _hedge_deadline(t0, progress["events"], progress["last"],
+                                                   first_event_timeout, idle_timeout)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    _hedge(reason)
+                continue
+
+            if path == "stream":
+                stream_done = True
+                if not _stream_failed(answer):
+                    stats["mode"] = "stream"
+                    return answer
+                if not hedge_started:
+                    _hedge("stream_error")
+            else:
+                blocking_done = True
+                blocking_answer = answer
+                if answer and not answer.startswith("⚠️"):
+                    stats["mode"] = "blocking"
+                    stats["first_token_s"] = time.perf_counter() - t0
+                    return answer
+
+            if stream_done and blocking_done:
+                stats["mode"] = "blocking"
+                stats["first_token_s"] = time.perf_counter() - t0
+                return blocking_answer or "⚠️ Dify出力が空でした"
+    finally:
+        decided.set()
+
+def dify_span_attrs(stats: dict) -> dict:
+    """timings の dify span に残す値（どちらが勝ったか / 並走させた理由）"""
+    attrs = {"mode": stats.get("mode")}
+    if stats.get("hedged"):
+        attrs["hedged"] = True
+        attrs["hedge_reason"] = stats.get("hedge_reason")
+    return attrs
+
+# ==================================================
+# Dify：回答キャッシュ（プロンプトのハッシュ → 回答）
+# ==================================================
+class DifyResultCache(DiskCache):
+    """
+    key = ワークフロー識別（DIFY_BASE_URL + API キーのハッシュ）+ プロンプト全文
+    「⚠️」で始まるエラー出力は保存しない
+    """
+
+    def __init__(self, root: str, ttl: float, max_bytes: int = 50 * 1024 * 1024):
+        super().__init__(root, max_bytes)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(prompt: str) -> str:
+        workflow = hashlib.sha256((DIFY_API_KEY or "").encode("utf-8")).hexdigest()[:16]
+        return json.dumps(
+            {"base": _dify_url(""), "workflow": workflow, "prompt": prompt},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+
+    def lookup(self, prompt: str) -> str | None:
+        data = self.get(self.key_for(prompt), ttl=self.ttl)
+        answer = ""
+        if data is not None:
+            try:
+                answer = json.loads(data.decode("utf-8")).get("answer") or ""
+            except Exception:
+                answer = ""
+        hit = bool(answer) and not answer.startswith("⚠️")
+        # 並列ワーカー / asyncio スレッドから同時に呼ばれる
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return answer if hit else None
+
+    def store(self, prompt: str, answer: str):
+        answer = (answer or "").strip()
+        if not answer or answer.startswith("⚠️"):
+            return
+        body = {"answer": answer, "saved_at": time.time()}
+        self.put(self.key_for(prompt), json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+    def invalidate_prompt(self, prompt: str):
+        self.invalidate(self.key_for(prompt))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hit": self.hits, "miss": self.misses}
+
+@_resource
+def get_dify_cache() -> DifyResultCache:
+    return DifyResultCache(DIFY_CACHE_DIR, DIFY_CACHE_TTL)
+
+def run_dify_cached(full_text: str, refresh: bool = False, stats: dict | None = None, on_chunk=None,
+                    cancel: threading.Event | None = None) -> str:
+    """
+    run_dify_with_fallback の結果をキャッシュする版
+    refresh=True: キャッシュを読まずに実行し直す（成功すれば上書き）
+    stats / on_chunk / cancel: run_dify_with_fallback と同じ（キャッシュから返した時は mode="cache"、on_chunk は呼ばない）
+    """
+    cache = get_dify_cache()
+    if not refresh:
+        cached = cache.lookup(full_text)
+        if cached is not None:
+            if stats is not None:
+                stats["mode"] = "cache"
+            return cached
+
+    answer = run_dify_with_fallback(full_text, stats=stats, on_chunk=on_chunk, cancel=cancel)
+    cache.store(full_text, answer)
+    return answer
+
+# ==================================================
+# 差分再分析：レースごとの入力指紋（keiba.go.jp / 談話 / 調教）
+# ==================================================
+_FIELD_LABELS = {
+    "race_name": "レース名",
+    "cond": "条件",
+    "horse": "馬名",
+    "jockey": "騎手",
+    "trainer": "調教師",
+    "prev_jockey": "前走騎手",
+    "is_change": "乗り替わり",
+    "waku": "枠",
+    "danwa": "談話",
+    "cyokyo": "調教",
+}
+
+def race_fingerprint(inputs: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(inputs, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+def diff_race_inputs(old: dict, new: dict) -> list[dict]:
+    """
+    前回と今回の入力を比べて変わったところを返す
+    return: [{"umaban": "3"|"", "field": "jockey", "before": ..., "after": ...}, ...]
+    """
+    changes = []
+
+    old_meta = old.get("race_meta") or {}
+    new_meta = new.get("race_meta") or {}
+    for f in sorted(set(old_meta) | set(new_meta)):
+        if old_meta.get(f) != new_meta.get(f):
+            changes.append({"umaban": "", "field": f, "before": old_meta.get(f), "after": new_meta.get(f)})
+
+    old_kg = old.get("keibago") or {}
+    new_kg = new.get("keibago") or {}
+    for uma in sorted(set(old_kg) | set(new_kg), key=lambda x: int(x) if str(x).isdigit() else 999):
+        a = old_kg.get(uma)
+        b = new_kg.get(uma)
+        if a is None or b is None:
+            changes.append({"umaban": uma, "field": "entry", "before": a, "after": b})
+            continue
+        for f in sorted(set(a) | set(b)):
+            if a.get(f) != b.get(f):
+                changes.append({"umaban": uma, "field": f, "before": a.get(f), "after": b.get(f)})
+
+    for kind in ("danwa", "cyokyo"):
+        a = old.get(kind) or {}
+        b = new.get(kind) or {}
+        for uma in sorted(set(a) | set(b), key=lambda x: int(x) if str(x).isdigit() else 999):
+            if a.get(uma) != b.get(uma):
+                changes.append({"umaban": uma, "field": kind, "before": a.get(uma), "after": b.get(uma)})
+
+    return changes
+
+def format_race_changes(changes: list[dict]) -> list[str]:
+    lines = []
+    for c in changes:
+        head = f"{c['umaban']}番 " if c["umaban"] else ""
+        if c["field"] == "entry":
+            lines.append(f"{head}{'追加' if c['before'] is None else '取消'}")
+        elif c["field"] in ("danwa", "cyokyo"):
+            lines.append(f"{head}{_FIELD_LABELS[c['field']]}が更新")
+        else:
+            label = _FIELD_LABELS.get(c["field"], c["field"])
+            lines.append(f"{head}{label}: {c['before']} → {c['after']}")
+    return lines
+
+class RaceStateStore:
+    """{date}_{place_code}_{race_num}.json に前回の入力・指紋・回答を置く"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, year, month, day, place_code, race_num: int) -> str:
+        name = f"{year}{str(month).zfill(2)}{str(day).zfill(2)}_{place_code}_{int(race_num):02}.json"
+        return os.path.join(self.root, name)
+
+    def load(self, year, month, day, place_code, race_num: int) -> dict | None:
+        try:
+            with open(self._path(year, month, day, place_code, race_num), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, year, month, day, place_code, race_num: int, race_id: str, inputs: dict, output: str):
+        path = self._path(year, month, day, place_code, race_num)
+        body = {
+            "race_id": race_id,
+            "fingerprint": race_fingerprint(inputs),
+            "inputs": inputs,
+            "output": output,
+            "saved_at": time.time(),
+        }
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(body, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("race state save error:", e)
+
+@_resource
+def get_race_state_store() -> RaceStateStore:
+    return RaceStateStore(RACE_STATE_DIR)
+
+# ==================================================
+# アーカイブ：取得データを日付×競馬場ごとの Parquet に残す（pandas + pyarrow）
+# ==================================================
+# 1行 = 1レースの1頭
+ARCHIVE_COLUMNS = [
+    "date", "place_code", "place_name", "race_num", "race_id", "race_name", "cond",
+    "umaban", "waku", "horse", "jockey", "trainer", "prev_jockey", "is_change",
+    "danwa", "cyokyo_tanpyo", "cyokyo_detail", "scraped_at",
+]
+
+def _pyarrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def race_archive_rows(date_str: str, place_code: str, place_name: str, race: Race, scraped_at: float | None = None) -> list[dict]:
+    """Race → アーカイブの行（出馬表/談話/調教のどれかにいる馬ごと）"""
+    scraped_at = time.time() if scraped_at is None else scraped_at
+    meta = race.race_meta
+    rows = []
+    for uma in race.umabans():
+        e = race.entries.get(uma)
+        t = race.training.get(uma)
+        rows.append({
+            "date": date_str,
+            "place_code": place_code,
+            "place_name": place_name,
+            "race_num": race.race_num,
+            "race_id": race.race_id,
+            "race_name": meta.get("race_name"),
+            "cond": meta.get("cond"),
+            "umaban": uma,
+            "waku": e.waku if e else None,
+            "horse": e.horse if e else (t.horse if t else None),
+            "jockey": e.jockey if e else None,
+            "trainer": e.trainer if e else None,
+            "prev_jockey": e.prev_jockey if e else None,
+            "is_change": e.is_change if e else None,
+            "danwa": race.danwa.get(uma),
+            "cyokyo_tanpyo": t.tanpyo if t else None,
+            "cyokyo_detail": t.detail if t else None,
+            "scraped_at": scraped_at,
+        })
+    return rows
+
+class RaceArchive:
+    """
+    {root}/date=YYYYMMDD/place=NN/entries.parquet（Hive 形式の区切り）
+    同じレースを書き直すとそのレースの行だけ入れ替わる（書き込みは一時ファイル → os.replace）
+    scan は区切り（日付/競馬場）で読むファイルを絞り、必要な列だけ読む
+
+        archive = get_race_archive()
+        archive.scan(date_from="20250101", places=["10"], columns=["date", "race_num", "horse"], jockey="佐藤一郎")
+        archive.jockey_rides("佐藤一郎", 2025)
+    """
+
+    FILE_NAME = "entries.parquet"
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _partition_dir(self, date_str: str, place_code: str) -> str:
+        return os.path.join(self.root, f"date={date_str}", f"place={place_code}")
+
+    # ---------- 書き込み ----------
+    def write_race(self, year, month, day, place_code: str, place_name: str, race: Race) -> int:
+        """1レース分を書く（同じ race_num の行は置き換える）。return: 書いた行数"""
+        import pandas as pd
+
+        date_str = f"{year}{str(month).zfill(2)}{str(day).zfill(2)}"
+        rows = race_archive_rows(date_str, str(place_code), place_name, race)
+        if not rows:
+            return 0
+        new = pd.DataFrame(rows, columns=ARCHIVE_COLUMNS)
+
+        part = self._partition_dir(date_str, str(place_code))
+        path = os.path.join(part, self.FILE_NAME)
+        with self._lock:
+            os.makedirs(part, exist_ok=True)
+            if os.path.exists(path):
+                old = pd.read_parquet(path)
+                new = pd.concat([old[old["race_num"] != race.race_num], new], ignore_index=True)
+            new["_uma"] = pd.to_numeric(new["umaban"], errors="coerce")
+            new = new.sort_values(["race_num", "_uma"], kind="stable").drop(columns="_uma")
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            new.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+        return len(rows)
+
+    # ---------- 読み込み ----------
+    def partitions(self, date_from: str | None = None, date_to: str | None = None, places=None) -> list[tuple[str, str, str]]:
+        """[(date, place_code, path), ...]（日付順）。date_from / date_to は "YYYYMMDD"（両端含む）"""
+        places = {str(p) for p in places} if places else None
+        out = []
+        try:
+            date_dirs = sorted(os.listdir(self.root))
+        except OSError:
+            return out
+        for dd in date_dirs:
+            if not dd.startswith("date="):
+                continue
+            date_str = dd[5:]
+            if (date_from and date_str < date_from) or (date_to and date_str > date_to):
+                continue
+            for pd_ in sorted(os.listdir(os.path.join(self.root, dd))):
+                if not pd_.startswith("place="):
+                    continue
+                place_code = pd_[6:]
+                if places is not None and place_code not in places:
+                    continue
+                path = os.path.join(self.root, dd, pd_, self.FILE_NAME)
+                if os.path.exists(path):
+                    out.append((date_str, place_code, path))
+        return out
+
+    def scan(
+        self,
+        date_from: str | None = None,
+        date_to: str | None = None,
+        places=None,
+        columns: list[str] | None = None,
+        **equals,
+    ):
+        """
+        区切りで絞ってから読む。equals は列 = 値 の絞り込み（Parquet の統計で読み飛ばせる所は読まない）
+        return: pandas.DataFrame（該当なしなら columns だけの空 DataFrame）
+        """
+        import pandas as pd
+
+        cols = list(columns or ARCHIVE_COLUMNS)
+        read_cols = list(dict.fromkeys(cols + list(equals)))
+        filters = [(k, "==", v) for k, v in equals.items()] or None
+        frames = [
+            pd.read_parquet(path, columns=read_cols, filters=filters)
+            for _, _, path in self.partitions(date_from, date_to, places)
+        ]
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return pd.DataFrame(columns=cols)
+        return pd.concat(frames, ignore_index=True)[cols]
+
+    def jockey_rides(self, jockey: str, season, places=None, columns: list[str] | None = None):
+        """その年（season=2025 等）に jockey が乗った馬（減量記号・空白の違いは無視）"""
+        season = str(season)
+        cols = columns or ["date", "place_name", "race_num", "race_name", "umaban", "horse", "jockey", "trainer",
+                           "prev_jockey", "is_change"]
+        df = self.scan(f"{season}0101", f"{season}1231", places, columns=list(dict.fromkeys(cols + ["jockey"])))
+        if df.empty:
+            return df[cols]
+        want = _norm_name(jockey).replace(" ", "")
+        hit = df["jockey"].fillna("").map(lambda j: _norm_name(j).replace(" ", "")) == want
+        return df.loc[hit, cols].reset_index(drop=True)
+
+    def load_race(self, date_str: str, place_code: str, race_num: int) -> Race | None:
+        """アーカイブから Race を組み立て直す（取り直さずにプロンプトを作り直せる）"""
+        import pandas as pd
+
+        df = self.scan(date_str, date_str, [place_code], race_num=int(race_num))
+        if df.empty:
+            return None
+
+        def _s(v):
+            return None if pd.isna(v) else v
+
+        first = df.iloc[0]
+        race = Race(int(race_num), first["race_id"], _s(first["race_name"]), _s(first["cond"]))
+        for r in df.itertuples(index=False):
+            if _s(r.jockey) is not None:
+                race.entries[r.umaban] = Entry(
+                    r.umaban, _s(r.waku) or "", _s(r.horse) or "", r.trainer, r.jockey, _s(r.prev_jockey) or "",
+                    bool(r.is_change),
+                )
+            if _s(r.danwa) is not None:
+                race.danwa[r.umaban] = r.danwa
+            if _s(r.cyokyo_tanpyo) is not None or _s(r.cyokyo_detail) is not None:
+                race.training[r.umaban] = TrainingRow(
+                    r.umaban, _s(r.horse) or "", _s(r.cyokyo_tanpyo) or "", _s(r.cyokyo_detail) or "",
+                )
+        return race
+
+@_resource
+def get_race_archive() -> RaceArchive | None:
+    """ARCHIVE_DIR が空、または pyarrow が無い時は None（アーカイブしない）"""
+    if not ARCHIVE_DIR or not _pyarrow_available():
+        return None
+    return RaceArchive(ARCHIVE_DIR)
+
+def archive_race(year, month, day, place_code: str, place_name: str, race: Race | None, ui: bool = False, missing=()):
+    """
+    取得データをアーカイブに残す（失敗しても分析は止めない）
+    missing: 取れずに抜きで続行したもの。抜けのあるレースは残さない（前に残した揃ったデータを上書きしない）
+    """
+    archive = get_race_archive()
+    if archive is None or race is None or missing:
+        return
+    try:
+        archive.write_race(year, month, day, place_code, place_name, race)
+    except Exception as e:
+        _ui_warning(ui, f"⚠️ 取得データをアーカイブに残せませんでした: {e}")
+
+# ==================================================
+# Dify：asyncio クライアント（同時実行数の上限 + 429 で自動的に絞る）
+# ==================================================
+def _retry_after_seconds(value: str | None, default: float) -> float:
+    """Retry-After（秒 or HTTP日付）→ 秒"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+        return max(0.0, dt.timestamp() - time.time())
+    except Exception:
+        return default
+
+class AdaptiveLimiter:
+    """
+    同時実行数の上限を自動調整する（AIMD）
+    - 429/503 を受けたら上限を半分にして、Retry-After の間は新規送信を止める
+    - 上限ぶん連続で成功したら上限を +1（max_limit まで）
+    イベントループのスレッドからだけ触る
+    """
+
+    def __init__(self, initial: int, max_limit: int, min_limit: int = 1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = max(self.min_limit, min(initial, self.max_limit))
+        self.in_flight = 0
+        self.throttled = 0
+        self._ok_streak = 0
+        self._paused_until = 0.0
+        self._cond: asyncio.Condition | None = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        cond = self._condition()
+        async with cond:
+            while self.in_flight >= self.limit:
+                await cond.wait()
+            self.in_flight += 1
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    def on_success(self):
+        self._ok_streak += 1
+        if self._ok_streak >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self._ok_streak = 0
+
+    def on_throttle(self, retry_after: float):
+        self.throttled += 1
+        self._ok_streak = 0
+        self.limit = max(self.min_limit, self.limit // 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    async def resize(self, initial: int, max_limit: int):
+        """上限を付け替える（実行ごと。429 で下げた分もここで initial に戻る）。待っている acquire も起こす"""
+        self.max_limit = max(1, max_limit)
+        self.min_limit = min(self.min_limit, self.max_limit)
+        self.limit = max(self.min_limit, min(initial, self.max_limit))
+        self._ok_streak = 0
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+class _LoopThread:
+    """専用スレッドで asyncio のイベントループを回し、同期コードから coroutine を投げる"""
+
+    def __init__(self, name: str):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name=name)
+        self.thread.start()
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+class AsyncDifyClient:
+    """
+    Dify workflow を asyncio で N 本同時に流す（SSE を読み、ダメなら blocking にフォールバック）
+    同期コードからは submit(prompt) → concurrent.futures.Future[str] で使う
+    """
+
+    def __init__(self, concurrency: int = 4, max_concurrency: int = 8, max_retries: int = 4):
+        self.limiter = AdaptiveLimiter(concurrency, max_concurrency)
+        self.max_retries = max_retries
+        self._runner = _LoopThread("dify-async")
+        self._client: httpx.AsyncClient | None = None
+        self._client_connections = 0
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            import httpx
+
+            # streaming と並走させた blocking で 1本あたり最大2接続
+            self._client_connections = self.limiter.max_limit * 2
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(300, connect=10),
+                limits=httpx.Limits(max_connections=self._client_connections),
+            )
+        return self._client
+
+    def resize(self, concurrency: int, max_concurrency: int):
+        """同時実行数（と上限）を付け替える。イベントループ / httpx.AsyncClient は作り直さない"""
+        self._runner.submit(self._resize(concurrency, max_concurrency)).result()
+
+    async def _resize(self, concurrency: int, max_concurrency: int):
+        await self.limiter.resize(concurrency, max_concurrency)
+        # 接続数の上限を超える時だけ、使っていなければ閉じて次の要求で作り直す
+        if self._client is not None and self.limiter.in_flight == 0 and self._client_connections < max_concurrency * 2:
+            old, self._client = self._client, None
+            await old.aclose()
+
+    def submit(self, full_text: str, stats: dict | None = None, on_chunk=None) -> Future:
+        return self._runner.submit(self.run(full_text, stats=stats, on_chunk=on_chunk))
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limiter.limit,
+            "in_flight": self.limiter.in_flight,
+            "throttled": self.limiter.throttled,
+        }
 
-            raw = line[5:].lstrip()
-            if not raw:
-                continue
+    async def run(
+        self,
+        full_text: str,
+        stats: dict | None = None,
+        on_chunk=None,
+        first_event_timeout: float | None = None,
+        idle_timeout: float | None = None,
+    ) -> str:
+        """
+        run_dify_with_fallback の async 版（stats / on_chunk / 期限も同じ。first_token_s は順番待ちの時間を含む）
+        期限は streaming の要求を送った時から測る（上限待ちの間に blocking を並走させない）
+        on_chunk はイベントループのスレッドから呼ばれる
+        """
+        if not DIFY_API_KEY:
+            return "⚠️ DIFY_API_KEY未設定"
+
+        stats = {} if stats is None else stats
+        first_event_timeout = DIFY_FIRST_EVENT_TIMEOUT if first_event_timeout is None else first_event_timeout
+        idle_timeout = DIFY_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        t0 = time.perf_counter()
+        progress = {"open": None, "events": 0, "last": None}
+        decided = False
+
+        def _first_token():
+            if not decided:
+                stats.setdefault("first_token_s", time.perf_counter() - t0)
+
+        def _open():
+            progress["open"] = progress["last"] = time.perf_counter()
+            progress["events"] = 0
+
+        def _event():
+            progress["events"] += 1
+            progress["last"] = time.perf_counter()
+
+        def _chunk(text: str):
+            if not decided and on_chunk is not None:
+                on_chunk(text)
+
+        stream_task = asyncio.ensure_future(self._with_backoff(
+            lambda text: self._stream_once(text, on_first=_first_token, on_chunk=_chunk, on_open=_open, on_event=_event),
+            full_text,
+        ))
+        blocking_task = None
+
+        def _hedge(reason: str):
+            nonlocal blocking_task
+            stats["hedged"] = True
+            stats["hedge_reason"] = reason
+            # 止まった streaming の代わりなので上限待ちに並ばせない（並ぶと止まった streaming が枠を塞いだままになる）
+            blocking_task = asyncio.ensure_future(self._with_backoff(self._blocking_once, full_text, limited=False))
 
+        try:
+            while True:
+                if stream_task.done():
+                    streamed = (stream_task.result() or "").strip()
+                    if not _stream_failed(streamed):
+                        stats["mode"] = "stream"
+                        return streamed
+                    if blocking_task is None:
+                        _hedge("stream_error")
+
+                if blocking_task is not None and blocking_task.done():
+                    blocking = (blocking_task.result() or "").strip()
+                    if (blocking and not blocking.startswith("⚠️")) or stream_task.done():
+                        stats["mode"] = "blocking"
+                        stats["first_token_s"] = time.perf_counter() - t0
+                        return blocking or "⚠️ Dify出力が空でした"
+
+                timeout = None
+                if blocking_task is None:
+                    deadline, reason = _hedge_deadline(progress["open"], progress["events"], progress["last"],
+                                                       first_event_timeout, idle_timeout)
+                    if deadline is not None and time.perf_counter() >= deadline:
+                        _hedge(reason)
+                        continue
+                    if deadline is not None:
+                        timeout = deadline - time.perf_counter()
+                    elif progress["open"] is None and first_event_timeout > 0:
+                        # まだ上限待ち：送った時刻が決まったら期限を測り直す
+                        timeout = min(first_event_timeout, 1.0)
+
+                pending = [t for t in (stream_task, blocking_task) if t is not None and not t.done()]
+                await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            decided = True
+            for t in (stream_task, blocking_task):
+                if t is not None and not t.done():
+                    t.cancel()
+
+    async def _with_backoff(self, once, full_text: str, limited: bool = True) -> str:
+        """
+        limited=False は同時実行の上限に数えない（429 の時に上限を絞るのは同じ）
+        Dify ホストのブレーカーが開いていれば送らずに失敗を返す。503 の再送は全体のリトライ予算から引く
+        """
+        breaker = get_circuit_breakers().get(_dify_url("/"))
+        get_retry_budget().record_request()
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                return f"⚠️ Dify API Error: {breaker.describe()}"
+            if limited:
+                await self.limiter.acquire()
             try:
-                evt = json.loads(raw)
-            except:
-                continue
+                result = await once(full_text)
+            finally:
+                if limited:
+                    await self.limiter.release()
+
+            if isinstance(result, tuple):
+                # (429/503, Retry-After) → 上限を絞って待ってから再送
+                status, retry_after = result
+                if status == 503:
+                    breaker.record_failure()
+                wait_s = _retry_after_seconds(retry_after, default=min(30.0, 2.0 ** attempt))
+                self.limiter.on_throttle(wait_s)
+                if attempt < self.max_retries and (status == 429 or get_retry_budget().try_retry()):
+                    continue
+                return f"⚠️ Dify HTTP {status}: リトライ上限に達しました"
+
+            if _dify_host_failed(result):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            self.limiter.on_success()
+            return result
+        return ""
 
-            got_any_event = True
+    async def _stream_once(self, full_text: str, on_first=None, on_chunk=None, on_open=None, on_event=None):
+        payload = {
+            "inputs": {"text": full_text},
+            "response_mode": "streaming",
+            "user": "keiba-bot",
+        }
+        headers = {
+            "Authorization": f"Bearer {DIFY_API_KEY}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            "Cache-Control": "no-cache",
+        }
+        if on_open is not None:
+            on_open()
+        try:
+            async with self._http().stream("POST", _dify_url("/v1/workflows/run"), headers=headers, json=payload) as res:
+                if res.status_code in (429, 503):
+                    return (res.status_code, res.headers.get("Retry-After"))
+                if res.status_code != 200:
+                    await res.aread()
+                    return _format_async_http_error(res)
+
+                got_any_event = False
+                answer = []
+                async for line in res.aiter_lines():
+                    if line and on_event is not None:
+                        on_event()   # ping も含めて数える（stream_dify_workflow と同じ）
+                    evt = _parse_sse_line(line)
+                    if evt is None:
+                        continue
+                    got_any_event = True
+
+                    if isinstance(evt.get("answer"), str) and evt["answer"]:
+                        if on_first and not answer:
+                            on_first()
+                        answer.append(evt["answer"])
+                        if on_chunk is not None:
+                            on_chunk(evt["answer"])
+                        continue
+
+                    if evt.get("event") == "text_chunk":
+                        # workflow の途中経過（表示用。回答は workflow_finished の outputs から取る）
+                        text = (evt.get("data", {}) or {}).get("text")
+                        if isinstance(text, str) and text:
+                            if on_first:
+                                on_first()
+                            if on_chunk is not None:
+                                on_chunk(text)
+                        continue
+
+                    if evt.get("event") == "workflow_finished":
+                        if not answer:
+                            outputs = (evt.get("data", {}) or {}).get("outputs", {}) or {}
+                            picked = _pick_output(outputs)
+                            if on_first and picked:
+                                on_first()
+                            return picked
+                        break
+
+                if not got_any_event:
+                    return "⚠️ DifyがSSEを返しませんでした（URL/キー/アプリ種別/inputs名/ネットワークの可能性）"
+                return "".join(answer)
+
+        except Exception as e:
+            return f"⚠️ Dify API Error: {str(e)}"
+
+    async def _blocking_once(self, full_text: str):
+        payload = {
+            "inputs": {"text": full_text},
+            "response_mode": "blocking",
+            "user": "keiba-bot",
+        }
+        headers = {
+            "Authorization": f"Bearer {DIFY_API_KEY}",
+            "Content-Type": "application/json",
+        }
+        try:
+            res = await self._http().post(_dify_url("/v1/workflows/run"), headers=headers, json=payload)
+            if res.status_code in (429, 503):
+                return (res.status_code, res.headers.get("Retry-After"))
+            if res.status_code != 200:
+                return _format_async_http_error(res)
+
+            j = res.json() or {}
+            data = j.get("data", {}) or {}
+            picked = _pick_output(data.get("outputs", {}) or {})
+            if picked:
+                return picked
+            err = data.get("error")
+            if err:
+                return f"⚠️ blocking error: {err}"
+            return "⚠️ blockingで outputs が空でした"
+
+        except Exception as e:
+            return f"⚠️ blocking API Error: {str(e)}"
+
+def _dify_host_failed(result: str) -> bool:
+    """ブレーカーに失敗として数える結果（通信エラー / 5xx。4xx や空の回答はホストの不調ではない）"""
+    return isinstance(result, str) and (
+        result.startswith(("⚠️ Dify API Error", "⚠️ blocking API Error"))
+        or re.match(r"⚠️ Dify HTTP 5\d\d", result) is not None
+    )
 
-            # ✅ 1) まず answer 増分だけを拾う（これが最優先）
-            if "answer" in evt and isinstance(evt["answer"], str) and evt["answer"]:
-                got_any_answer = True
-                yield evt["answer"]
-                continue
+def _format_async_http_error(res: httpx.Response) -> str:
+    try:
+        return f"⚠️ Dify HTTP {res.status_code}: {res.json()}"
+    except:
+        return f"⚠️ Dify HTTP {res.status_code}: {(res.text or '')[:800]}"
 
-            ev = evt.get("event")
-            if ev == "workflow_finished":
-                data = evt.get("data", {}) or {}
-                outputs = data.get("outputs", {}) or {}
-                final_from_outputs = _pick_output(outputs)
+@_resource
+def _async_dify_client() -> AsyncDifyClient:
+    return AsyncDifyClient(max_concurrency=DIFY_MAX_CONCURRENCY)
 
-                # answer増分が1文字も来なかった場合のみ、outputsを返す
-                if (not got_any_answer) and final_from_outputs:
-                    yield final_from_outputs
-                else:
-                    # 既に answer を返している場合は重複を避けて何も返さない
-                    pass
-                return
+def get_async_dify_client(concurrency: int = 4) -> AsyncDifyClient:
+    """
+    プロセスで1つの AsyncDifyClient（イベントループのスレッド / httpx.AsyncClient も1つ）を
+    concurrency 本同時に合わせて返す（値が変わっても作り直さない）
+    """
+    client = _async_dify_client()
+    client.resize(concurrency, max(concurrency, DIFY_MAX_CONCURRENCY))
+    return client
 
-        if not got_any_event:
-            yield "⚠️ DifyがSSEを返しませんでした（URL/キー/アプリ種別/inputs名/ネットワークの可能性）"
+def submit_dify_cached(
+    client: AsyncDifyClient, full_text: str, refresh: bool = False, stats: dict | None = None, on_chunk=None,
+) -> Future:
+    """
+    run_dify_cached の非同期版：キャッシュにあれば完了済み Future を返す
+    成功した回答は完了時にキャッシュへ保存する
+    """
+    cache = get_dify_cache()
+    if not refresh:
+        cached = cache.lookup(full_text)
+        if cached is not None:
+            if stats is not None:
+                stats["mode"] = "cache"
+            fut = Future()
+            fut.set_result(cached)
+            return fut
+
+    fut = client.submit(full_text, stats=stats, on_chunk=on_chunk)
+    fut.add_done_callback(lambda f: (not f.cancelled() and f.exception() is None) and cache.store(full_text, f.result()))
+    return fut
 
-    except Exception as e:
-        yield f"⚠️ Dify API Error: {str(e)}"
+# ==================================================
+# 計測：段階ごとの所要時間（span）
+# ==================================================
+class RunTimings:
+    """
+    1回の実行（run_races_iter / run_all_races）の段階ごとの所要時間を集める
+      with timings.span("danwa", race_num): ...
+      timings.add("dify_first_token", race_num, seconds)
+    race=None は開催単位の段階（login / schedule / keibago_prefetch）
+    スレッドセーフ（並列ワーカー / asyncio スレッドから書いてよい）
+    scoped(**attrs) は attrs を全 span に付けて同じ所に書く（run_batch_iter で開催ごとに分ける）
+    """
 
-def run_dify_workflow_blocking(full_text: str) -> str:
-    """結果だけ欲しいならこれが一番安定"""
-    if not DIFY_API_KEY:
-        return "⚠️ DIFY_API_KEY未設定"
+    # 表示順（ここに無い段階は後ろに並ぶ）
+    STAGES = (
+        "login", "schedule", "keibago_prefetch",
+        "keibago", "danwa", "cyokyo", "parse", "prompt",
+        "dify_first_token", "dify", "persist", "race",
+    )
 
-    url = _dify_url("/v1/workflows/run")
-    payload = {
-        "inputs": {"text": full_text},
-        "response_mode": "blocking",
-        "user": "keiba-bot",
-    }
-    headers = {
-        "Authorization": f"Bearer {DIFY_API_KEY}",
-        "Content-Type": "application/json",
+    def __init__(self, meta: dict | None = None):
+        self.meta = dict(meta or {})
+        self.spans: list[dict] = []
+        self.started_at = time.time()
+        self.attrs: dict = {}
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def scoped(self, **attrs) -> RunTimings:
+        """attrs を付けた span を self に記録する RunTimings（race() などは attrs が一致する span だけを見る）"""
+        child = RunTimings(self.meta)
+        child.spans, child.started_at, child._t0, child._lock = self.spans, self.started_at, self._t0, self._lock
+        child.attrs = {**self.attrs, **attrs}
+        return child
+
+    def _mine(self, sp: dict) -> bool:
+        return all(sp.get(k) == v for k, v in self.attrs.items())
+
+    @contextmanager
+    def span(self, stage: str, race: int | None = None, **attrs):
+        """with で囲んだ区間を記録する。yield した dict に書いた値も span に残る"""
+        t0 = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException:
+            attrs["error"] = True
+            raise
+        finally:
+            self.add(stage, race, time.perf_counter() - t0, start=t0, **attrs)
+
+    def add(self, stage: str, race: int | None, seconds: float, start: float | None = None, **attrs):
+        rec = {
+            "stage": stage,
+            "race": race,
+            "start_s": round((start if start is not None else time.perf_counter() - seconds) - self._t0, 4),
+            "seconds": round(seconds, 4),
+            "thread": threading.current_thread().name,
+        }
+        rec.update(self.attrs)
+        rec.update(attrs)
+        with self._lock:
+            self.spans.append(rec)
+
+    def _order(self, stage: str) -> int:
+        return self.STAGES.index(stage) if stage in self.STAGES else len(self.STAGES)
+
+    def race(self, race_num: int) -> dict:
+        """{stage: seconds}（同じ段階が複数回あれば合計）"""
+        out: dict[str, float] = {}
+        with self._lock:
+            spans = [sp for sp in self.spans if sp["race"] == race_num and self._mine(sp)]
+        for sp in sorted(spans, key=lambda sp: self._order(sp["stage"])):
+            out[sp["stage"]] = round(out.get(sp["stage"], 0.0) + sp["seconds"], 4)
+        return out
+
+    def per_race(self) -> dict[int, dict]:
+        with self._lock:
+            races = sorted({sp["race"] for sp in self.spans if sp["race"] is not None and self._mine(sp)})
+        return {r: self.race(r) for r in races}
+
+    def summary(self) -> dict:
+        """{"wall_s", "stages": {stage: {"count", "total_s", "mean_s", "max_s"}}}"""
+        with self._lock:
+            spans = [sp for sp in self.spans if self._mine(sp)]
+        by_stage: dict[str, list[float]] = {}
+        for sp in spans:
+            by_stage.setdefault(sp["stage"], []).append(sp["seconds"])
+        stages = {}
+        for stage in sorted(by_stage, key=self._order):
+            xs = by_stage[stage]
+            stages[stage] = {
+                "count": len(xs),
+                "total_s": round(sum(xs), 4),
+                "mean_s": round(sum(xs) / len(xs), 4),
+                "max_s": round(max(xs), 4),
+            }
+        return {"wall_s": round(time.perf_counter() - self._t0, 4), "stages": stages}
+
+    def to_jsonl(self) -> str:
+        """span 1個 = 1行（meta と実行開始時刻を各行に付ける）"""
+        started = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at))
+        with self._lock:
+            spans = [sp for sp in self.spans if self._mine(sp)]
+        lines = [json.dumps({"run_started_at": started, **self.meta, **sp}, ensure_ascii=False) for sp in spans]
+        return "".join(line + "\n" for line in lines)
+
+    def export_jsonl(self, path: str):
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(self.to_jsonl())
+        except OSError as e:
+            print("timings export error:", e)
+
+# ==================================================
+# 共通：1レース分のデータ収集・統合
+# ==================================================
+def _collect_race_inputs(
+    pages, year, month, day, race_num: int, race_id: str, baba_code: str, ui: bool = False, refresh: bool = False,
+    keibago=None, timings: RunTimings | None = None, missing: list | None = None,
+):
+    """
+    keiba.go.jp 出馬表 + 競馬ブック（談話/調教）を集めて返す
+    pages: BrowserPageSource / HttpPageSource
+    refresh: HTML キャッシュを使わず取り直す
+    keibago: prefetch_keibago_debatables の結果（あれば取りに行かない。例外なら取れなかった扱い）
+    timings: 取得（keibago/danwa/cyokyo）とパース（parse）の span を残す先
+    missing: list を渡すと、取れずに抜きで続行したもの（"keibago"）を入れる
+    return: Race
+    """
+    timings = timings if timings is not None else RunTimings()
+
+    # 0) keiba.go.jp 出馬表（取れなければ騎手/調教師なしで続行する。落ちているホストでレースごと止めない）
+    keibago_error = keibago if isinstance(keibago, Exception) else None
+    if keibago is None:
+        try:
+            with timings.span("keibago", race_num):
+                keibago = fetch_keibago_debatable_small(
+                    year=str(year),
+                    month=str(month),
+                    day=str(day),
+                    race_no=race_num,
+                    baba_code=str(baba_code),
+                    refresh=refresh,
+                )
+        except Exception as e:
+            keibago_error = e
+    if keibago_error is not None:
+        _ui_warning(ui, f"⚠️ keiba.go.jp の出馬表が取れませんでした（続行：騎手/調教師が不明になります）: {keibago_error}")
+        if missing is not None:
+            missing.append("keibago")
+        keibago = ("", {}, _keibago_debatable_url(str(year), str(month), str(day), race_num, str(baba_code)))
+    header, entries, keibago_url = keibago
+    _ui_caption(ui, f"keiba.go.jp: {keibago_url}")
+    if header:
+        _ui_caption(ui, f"keiba.go.jp header: {header}")
+
+    if not entries:
+        _ui_warning(ui, "⚠️ keiba.go.jp から出馬表が取れませんでした（続行：騎手/調教師が不明になります）")
+
+    # 1) 談話
+    _ui_info(ui, "📡 データ収集中...（談話）")
+    with timings.span("danwa", race_num):
+        html_danwa = pages.get_html(
+            _keibabook_url(f"/chihou/danwa/1/{race_id}"),
+            ready=(By.CLASS_NAME, "danwa"),
+            refresh=refresh,
+        )
+    with timings.span("parse", race_num):
+        danwa_page = KeibabookPage(html_danwa)
+        race_meta = danwa_page.race_info()
+        danwa = danwa_page.danwa_comments()
+
+    # 2) 調教
+    _ui_info(ui, "📡 データ収集中...（調教）")
+    with timings.span("cyokyo", race_num):
+        html_cyokyo = pages.get_html(
+            _keibabook_url(f"/chihou/cyokyo/1/{race_id}"),
+            ready=(By.CLASS_NAME, "cyokyo"),
+            refresh=refresh,
+        )
+    with timings.span("parse", race_num):
+        training = KeibabookPage(html_cyokyo).training_rows()
+
+    return Race(
+        race_num=race_num,
+        race_id=race_id,
+        race_name=race_meta.get("race_name"),
+        cond=race_meta.get("cond"),
+        entries=entries,
+        danwa=danwa,
+        training=training,
+        keibago_header=header,
+        keibago_url=keibago_url,
+    )
+
+@dataclass
+class _RaceRunContext:
+    """1開催（日付×競馬場）の実行設定。レース処理の各段で共有する"""
+    year: str
+    month: str
+    day: str
+    place_code: str
+    place_name: str
+    baba_code: str
+    ui: bool = False
+    refresh: bool = False
+    dify_refresh: bool = False
+    incremental: bool = False
+    report: dict | None = None
+    keibago_pre: dict = field(default_factory=dict)
+    timings: RunTimings = field(default_factory=RunTimings)
+    on_chunk: Callable[[int, str], None] | None = None   # Dify の回答の増分（どのスレッドから呼ばれてもよいこと）
+    batch_job: BatchJob | None = None                    # run_batch_iter の時の開催（yield する job）
+    failed: set[int] = field(default_factory=set)        # error_block を返したレース（replace した ctx とも共有）
+
+    def block(self, race_num: int, text: str) -> str:
+        return f"【{self.place_name} {race_num}R】\n{text}"
+
+    def error_block(self, race_num: int, text: str) -> str:
+        """失敗（取得エラー/データなし/Dify エラー）の block。ok() で見分けられるように覚えておく"""
+        self.failed.add(race_num)
+        return self.block(race_num, text)
+
+    def ok(self, race_num: int) -> bool:
+        return race_num not in self.failed
+
+    def chunk_sink(self, race_num: int):
+        """Dify 側に渡す on_chunk(text)（レース番号を付けて ctx.on_chunk に流す）"""
+        if self.on_chunk is None:
+            return None
+        return lambda text: self.on_chunk(race_num, text)
+
+    def race_done(self, job: dict):
+        """レース1本の開始（_prepare_race）から block ができるまでを "race" として残す"""
+        self.timings.add("race", job["race_num"], time.perf_counter() - job["t0"], start=job["t0"])
+
+    def dify_done(self, race_num: int, t0: float, t1: float, stats: dict):
+        self.timings.add("dify", race_num, t1 - t0, start=t0, **dify_span_attrs(stats))
+        if "first_token_s" in stats:
+            self.timings.add("dify_first_token", race_num, stats["first_token_s"], start=t0)
+
+def _prepare_race(ctx: _RaceRunContext, pages, race_num: int, race_id: str) -> dict:
+    """
+    データ収集 → 統合 → プロンプト作成まで（Dify の手前）
+    return: {"race_num", "race_id", "race", "prompt", "inputs", "block"}
+            block が入っていればそのレースはここで終わり（スキップ/前回の回答/エラー）
+    """
+    job = _fetch_race(ctx, pages, race_num, race_id)
+    if job["block"] is None:
+        _build_race_prompt(ctx, job)
+    return job
+
+def _fetch_race(ctx: _RaceRunContext, pages, race_num: int, race_id: str) -> dict:
+    """データ収集（pages を使うのはここだけ）。job["race"] に出馬表/談話/調教（Race）を入れる"""
+    job = {
+        "race_num": race_num, "race_id": race_id, "race": None, "prompt": "", "inputs": None, "block": None,
+        "missing": [], "t0": time.perf_counter(),
     }
+    info = {"race_id": race_id, "reused": False, "changes": None, "prompt_tokens": None, "missing": job["missing"]}
+    if ctx.report is not None:
+        ctx.report[race_num] = info
+    ui = ctx.ui
 
-    sess = get_http_session()
+    _ui_markdown(ui, f"## {ctx.place_name} {race_num}R")
+    _ui_caption(ui, f"race_id(keibabook): {race_id}")
 
     try:
-        res = sess.post(url, headers=headers, json=payload, timeout=300)
-        if res.status_code != 200:
-            return _format_http_error(res)
+        job["race"] = _collect_race_inputs(
+            pages, ctx.year, ctx.month, ctx.day, race_num, race_id, ctx.baba_code, ui=ui, refresh=ctx.refresh,
+            keibago=ctx.keibago_pre.get(race_num), timings=ctx.timings, missing=job["missing"],
+        )
+        return job
 
-        j = res.json() or {}
-        data = j.get("data", {}) or {}
-        outputs = data.get("outputs", {}) or {}
+    except Exception as e:
+        _ui_error(ui, f"Error: {e}")
+        job["block"] = ctx.error_block(race_num, f"⚠️ Error: {e}")
+        ctx.race_done(job)
+        return job
 
-        picked = _pick_output(outputs)
-        if picked:
-            return picked
+def _build_race_prompt(ctx: _RaceRunContext, job: dict):
+    """統合 → プロンプト作成 → 前回との比較（incremental なら前回の回答で job["block"] を埋める）"""
+    race_num = job["race_num"]
+    info = ctx.report.get(race_num, {}) if ctx.report is not None else {}
+    ui = ctx.ui
 
-        err = data.get("error")
-        if err:
-            return f"⚠️ blocking error: {err}"
+    try:
+        race = job["race"]
+
+        if not race.umabans():
+            _ui_warning(ui, "データなしのためスキップ")
+            job["block"] = ctx.error_block(race_num, "⚠️ データなしのためスキップ")
+            ctx.race_done(job)
+            return job
+
+        with ctx.timings.span("prompt", race_num) as sp:
+            job["prompt"], prompt_stats = build_race_prompt(race)
+            sp.update(prompt_stats)
+        info["prompt_tokens"] = prompt_stats
+        _ui_caption(ui, "🧮 " + format_prompt_stats(prompt_stats))
+        inputs = job["inputs"] = race.to_inputs()
+
+        prev = get_race_state_store().load(ctx.year, ctx.month, ctx.day, ctx.place_code, race_num)
+        if prev and prev.get("inputs") is not None:
+            info["changes"] = diff_race_inputs(prev["inputs"], inputs)
+            if info["changes"]:
+                _ui_caption(ui, "🔁 前回からの変更: " + " / ".join(format_race_changes(info["changes"])))
+
+        prev_ok = bool(prev and prev.get("output") and not prev["output"].startswith("⚠️"))
+        if ctx.incremental and prev_ok and prev.get("fingerprint") == race_fingerprint(inputs):
+            info["reused"] = True
+            _ui_success(ui, "✅ 前回から変更なし（前回の回答を表示）")
+            with ctx.timings.span("persist", race_num):
+                archive_race(ctx.year, ctx.month, ctx.day, ctx.place_code, ctx.place_name, race, ui=ui, missing=job["missing"])
+            job["block"] = ctx.block(race_num, prev["output"])
+            ctx.race_done(job)
+            return job
+
+        _ui_info(ui, "🤖 AI分析中...（Dify）")
+        return job
 
-        return "⚠️ blockingで outputs が空でした"
+    except Exception as e:
+        _ui_error(ui, f"Error: {e}")
+        job["block"] = ctx.error_block(race_num, f"⚠️ Error: {e}")
+        ctx.race_done(job)
+        return job
+
+def _finish_race(ctx: _RaceRunContext, job: dict, full_ans: str) -> str:
+    """Dify の回答を受けて保存（history / 入力指紋）し、block_text を返す"""
+    race_num = job["race_num"]
+    try:
+        full_ans = (full_ans or "").strip()
+        if full_ans == "":
+            full_ans = "⚠️ AIの出力が空でした（Dify応答なし/エラーの可能性）"
+
+        _ui_success(ctx.ui, "✅ 完了")
+
+        with ctx.timings.span("persist", race_num):
+            save_history(
+                ctx.year, ctx.place_code, ctx.place_name, ctx.month, ctx.day,
+                f"{race_num:02}", job["race_id"], full_ans,
+            )
+            if not full_ans.startswith("⚠️"):
+                get_race_state_store().save(
+                    ctx.year, ctx.month, ctx.day, ctx.place_code, race_num, job["race_id"], job["inputs"], full_ans,
+                )
+            archive_race(
+                ctx.year, ctx.month, ctx.day, ctx.place_code, ctx.place_name, job.get("race"),
+                ui=ctx.ui, missing=job.get("missing"),
+            )
+
+        if full_ans.startswith("⚠️"):
+            return ctx.error_block(race_num, full_ans)
+        return ctx.block(race_num, full_ans)
 
     except Exception as e:
-        return f"⚠️ blocking API Error: {str(e)}"
+        _ui_error(ctx.ui, f"Error: {e}")
+        return ctx.error_block(race_num, f"⚠️ Error: {e}")
 
-def run_dify_with_fallback(full_text: str) -> str:
+    finally:
+        ctx.race_done(job)
+
+def _run_race_block(ctx: _RaceRunContext, pages, race_num: int, race_id: str) -> str:
     """
-    streaming で回収 → 何も得られない/エラーっぽい時は blocking にフォールバック
+    run_races_iter 用：1レースを最後まで処理して block_text を返す（例外もblock化）
     """
-    chunks = []
-    got_error = False
-
-    for c in stream_dify_workflow(full_text):
-        chunks.append(c)
-        if isinstance(c, str) and (c.startswith("⚠️ Dify HTTP") or c.startswith("⚠️ Dify API Error")):
-            got_error = True
-            break
-
-    streamed = "".join(chunks).strip()
+    job = _prepare_race(ctx, pages, race_num, race_id)
+    if job["block"] is not None:
+        return job["block"]
+    return _finish_race(ctx, job, _run_race_dify(ctx, job))
+
+def _run_race_dify(ctx: _RaceRunContext, job: dict, cancel: threading.Event | None = None) -> str:
+    """job["prompt"] を Dify（キャッシュ込み）に投げて回答を返す（エラーも文字列で返す）"""
+    stats = {}
+    t0 = time.perf_counter()
+    try:
+        full_ans = run_dify_cached(
+            job["prompt"], refresh=ctx.dify_refresh, stats=stats, on_chunk=ctx.chunk_sink(job["race_num"]),
+            cancel=cancel,
+        )
+    except Exception as e:
+        full_ans = f"⚠️ Dify API Error: {e}"
+    ctx.dify_done(job["race_num"], t0, time.perf_counter(), stats)
+    return full_ans
 
-    if (not streamed) or ("SSEを返しません" in streamed) or got_error:
-        return (run_dify_workflow_blocking(full_text) or "").strip() or "⚠️ Dify出力が空でした"
+# 競馬ブックの場コード → 競馬場名 / keiba.go.jp の babaCode
+PLACE_NAMES = {"10": "大井", "11": "川崎", "12": "船橋", "13": "浦和"}
+_BABA_CODES = {"10": "20", "11": "21", "12": "19", "13": "18"}
 
-    return streamed
+def _select_target_race_ids(races: list[tuple[int, str]], target_races: set[int] | None) -> list[tuple[int, str]]:
+    """races: fetch_schedule_races の [(race_num, race_id), ...]"""
+    return [(n, rid) for n, rid in races if target_races is None or n in target_races]
 
 # ==================================================
 # メイン：全レース実行（文字列を return）
@@ -561,6 +3559,9 @@ def run_all_races(
     place_code: str,
     target_races: set[int] | None,
     ui: bool = False,
+    refresh: bool = False,
+    dify_refresh: bool = False,
+    timings: RunTimings | None = None,
 ) -> str:
     """
     place_code：競馬ブック側（10大井/11川崎/12船橋/13浦和）
@@ -568,147 +3569,109 @@ def run_all_races(
 
     ui=False: 画面描画せず結果文字列だけ返す
     ui=True : 進捗を st.* で表示
+    refresh=True: HTML キャッシュを使わず取り直す
+    dify_refresh=True: 同じプロンプトの回答がキャッシュにあっても Dify を実行し直す
+    timings: RunTimings を渡すと段階ごとの所要時間が入る（run_races_iter と同じ）
     """
-    place_names = {"10": "大井", "11": "川崎", "12": "船橋", "13": "浦和"}
-    place_name = place_names.get(place_code, "地方")
+    place_name = PLACE_NAMES.get(place_code, "地方")
 
-    baba_map = {"10": "20", "11": "21", "12": "19", "13": "18"}
-    baba_code = baba_map.get(place_code)
+    baba_code = _BABA_CODES.get(place_code)
     if not baba_code:
         _ui_error(ui, "babaCode mapping が未定義です。place_code を確認してください。")
         return "⚠️ babaCode mapping が未定義です。place_code を確認してください。"
 
+    timings = timings if timings is not None else RunTimings()
+    timings.meta.update({"date": f"{year}{month}{day}", "place_code": place_code, "fetch_mode": "browser"})
+
     result_blocks: list[str] = []
 
-    driver = build_driver()
-    wait = WebDriverWait(driver, 12)
+    driver = None
 
     try:
-        _ui_info(ui, "🔑 ログイン中...（競馬ブック）")
-        login_keibabook(driver, wait)
-
-        race_ids = fetch_race_ids_from_schedule(driver, year, month, day, place_code, ui=ui)
-        if not race_ids:
+        with timings.span("login"):
+            driver = build_driver()
+            wait = _driver_wait(driver, 12)
+            _ui_info(ui, "🔑 ログイン中...（競馬ブック）")
+            login_keibabook(driver, wait)
+
+        pages = BrowserPageSource(driver, wait)
+
+        with timings.span("schedule"):
+            races = fetch_schedule_races(
+                pages, year, month, day, place_code, ui=ui, refresh=refresh, target_races=target_races,
+            )
+        if not races:
             return "⚠️ レースIDが取得できませんでした。日付/競馬場コードを確認してください。"
 
-        for i, race_id in enumerate(race_ids):
-            race_num = i + 1
-            if target_races is not None and race_num not in target_races:
-                continue
+        targets = _select_target_race_ids(races, target_races)
+        with timings.span("keibago_prefetch"):
+            keibago_pre = prefetch_keibago_debatables(
+                year, month, day, [n for n, _ in targets], baba_code, refresh=refresh, timings=timings,
+            )
 
+        for race_num, race_id in targets:
             race_num_str = f"{race_num:02}"
+            race_t0 = time.perf_counter()
 
             _ui_markdown(ui, f"## {place_name} {race_num}R")
             _ui_caption(ui, f"race_id(keibabook): {race_id}")
 
+            missing = []
             try:
-                # 0) keiba.go.jp 出馬表
-                header, keibago_dict, keibago_url = fetch_keibago_debatable_small(
-                    year=str(year),
-                    month=str(month),
-                    day=str(day),
-                    race_no=race_num,
-                    baba_code=str(baba_code),
-                )
-                _ui_caption(ui, f"keiba.go.jp: {keibago_url}")
-                if header:
-                    _ui_caption(ui, f"keiba.go.jp header: {header}")
-
-                if not keibago_dict:
-                    _ui_warning(ui, "⚠️ keiba.go.jp から出馬表が取れませんでした（続行：騎手/調教師が不明になります）")
-
-                # 1) 談話
-                _ui_info(ui, "📡 データ収集中...（談話）")
-                driver.get(f"https://s.keibabook.co.jp/chihou/danwa/1/{race_id}")
-                try:
-                    wait.until(EC.presence_of_element_located((By.CLASS_NAME, "danwa")))
-                except:
-                    pass
-
-                html_danwa = driver.page_source
-                race_meta = parse_race_info(html_danwa)
-                danwa_dict = parse_danwa_comments(html_danwa)
-
-                # 2) 調教
-                _ui_info(ui, "📡 データ収集中...（調教）")
-                driver.get(f"https://s.keibabook.co.jp/chihou/cyokyo/1/{race_id}")
-                try:
-                    wait.until(EC.presence_of_element_located((By.CLASS_NAME, "cyokyo")))
-                except:
-                    pass
-
-                cyokyo_dict = parse_cyokyo(driver.page_source)
-
-                # 統合（馬番で揃える）
-                all_uma = sorted(
-                    set(danwa_dict.keys()) | set(cyokyo_dict.keys()) | set(keibago_dict.keys()),
-                    key=lambda x: int(x) if str(x).isdigit() else 999,
+                race = _collect_race_inputs(
+                    pages, year, month, day, race_num, race_id, baba_code, ui=ui, refresh=refresh,
+                    keibago=keibago_pre.get(race_num), timings=timings, missing=missing,
                 )
-
-                merged_text = []
-                for uma in all_uma:
-                    kg = keibago_dict.get(uma, {})
-                    horse = kg.get("horse", "")
-                    jockey = kg.get("jockey", "不明")
-                    trainer = kg.get("trainer", "不明")
-                    prev_jockey = kg.get("prev_jockey", "")
-                    is_change = kg.get("is_change", False)
-
-                    alert = "【⚠️乗り替わり】" if is_change else ""
-                    if prev_jockey:
-                        alert += f"（前走:{prev_jockey}）"
-
-                    d = danwa_dict.get(uma, "（なし）")
-                    c = cyokyo_dict.get(uma, "（なし）")
-
-                    merged_text.append(
-                        f"▼[馬番{uma}] 馬名:{horse} 騎手:{jockey} {alert} 調教師:{trainer}\n"
-                        f"談話: {d}\n"
-                        f"調教: {c}"
-                    )
-
-                if not merged_text:
+                if not race.umabans():
                     block = f"【{place_name} {race_num}R】\n⚠️ データなしのためスキップ"
                     result_blocks.append(block)
                     _ui_warning(ui, "データなしのためスキップ")
+                    timings.add("race", race_num, time.perf_counter() - race_t0, start=race_t0)
                     _ui_divider(ui)
                     continue
 
-                prompt = (
-                    f"{place_name}競馬場のレースのデータです。\n\n"
-                    f"レース名: {race_meta.get('race_name','')}\n"
-                    f"条件: {race_meta.get('cond','')}\n\n"
-                    "以下の各馬のデータ（馬名、騎手、乗り替わり、調教師、談話、調教）です。\n"
-                    + "\n".join(merged_text)
-                )
+                with timings.span("prompt", race_num) as sp:
+                    prompt, prompt_stats = build_race_prompt(race, place_name=place_name)
+                    sp.update(prompt_stats)
+                _ui_caption(ui, "🧮 " + format_prompt_stats(prompt_stats))
 
                 # 3) Dify
                 _ui_info(ui, "🤖 AI分析中...（Dify）")
 
-                if ui:
+                dify_stats = {}
+                dify_t0 = time.perf_counter()
+                cached = None if dify_refresh else get_dify_cache().lookup(prompt)
+                if cached is not None:
+                    dify_stats["mode"] = "cache"
+                    full_ans = cached
+                    if ui:
+                        _st().empty().markdown(full_ans)
+                elif ui:
                     # ✅ UI時：streamingは「answer増分」だけを表示する（node_finished等は拾わない実装になってる）
-                    result_area = st.empty()
-                    answer_buf = ""
-
-                    got_error = False
-                    for chunk in stream_dify_workflow(prompt):
-                        if isinstance(chunk, str) and (chunk.startswith("⚠️ Dify HTTP") or chunk.startswith("⚠️ Dify API Error")):
-                            got_error = True
-                            answer_buf = chunk
-                            result_area.markdown(answer_buf)
-                            break
-
-                        answer_buf += chunk
-                        result_area.markdown(answer_buf + "▌")
-
-                    if (not answer_buf) or ("SSEを返しません" in answer_buf) or got_error:
-                        answer_buf = run_dify_workflow_blocking(prompt) or ""
+                    # Dify は別スレッドで待ち（期限切れなら blocking を並走）、描画はこのスレッドで行う
+                    result_area = _st().empty()
+                    live_buf = []
+                    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="dify-ui") as ex:
+                        fut = ex.submit(run_dify_with_fallback, prompt, dify_stats, live_buf.append)
+                        shown = 0
+                        while True:
+                            try:
+                                answer_buf = fut.result(timeout=0.15)
+                                break
+                            except FuturesTimeout:
+                                if len(live_buf) != shown:
+                                    shown = len(live_buf)
+                                    result_area.markdown("".join(live_buf[:shown]) + "▌")
 
                     full_ans = (answer_buf or "").strip()
                     result_area.markdown(full_ans if full_ans else "⚠️ AIの出力が空でした")
+                    get_dify_cache().store(prompt, full_ans)
                 else:
                     # UIなし：最初からフォールバック込み
-                    full_ans = run_dify_with_fallback(prompt)
+                    full_ans = run_dify_cached(prompt, refresh=True, stats=dify_stats)
+                timings.add("dify", race_num, time.perf_counter() - dify_t0, start=dify_t0, **dify_span_attrs(dify_stats))
+                if "first_token_s" in dify_stats:
+                    timings.add("dify_first_token", race_num, dify_stats["first_token_s"], start=dify_t0)
 
                 full_ans = (full_ans or "").strip()
                 if full_ans == "":
@@ -716,7 +3679,9 @@ def run_all_races(
 
                 _ui_success(ui, "✅ 完了")
 
-                save_history(year, place_code, place_name, month, day, race_num_str, race_id, full_ans)
+                with timings.span("persist", race_num):
+                    save_history(year, place_code, place_name, month, day, race_num_str, race_id, full_ans)
+                    archive_race(year, month, day, place_code, place_name, race, ui=ui, missing=missing)
 
                 block = f"【{place_name} {race_num}R】\n{full_ans}"
                 result_blocks.append(block)
@@ -726,13 +3691,13 @@ def run_all_races(
                 result_blocks.append(msg)
                 _ui_error(ui, f"Error: {e}")
 
+            timings.add("race", race_num, time.perf_counter() - race_t0, start=race_t0)
             _ui_divider(ui)
 
     finally:
-        try:
-            driver.quit()
-        except:
-            pass
+        if driver is not None:
+            _quit_quietly(driver)
+        timings.export_jsonl(TIMINGS_LOG_FILE)
 
     return "\n\n".join(result_blocks).strip()
 
@@ -743,141 +3708,585 @@ def run_races_iter(
     place_code: str,
     target_races: set[int] | None,
     ui: bool = False,
+    workers: int = 1,
+    fetch_mode: str = "browser",
+    pooled: bool = False,
+    refresh: bool = False,
+    dify_refresh: bool = False,
+    incremental: bool = False,
+    report: dict | None = None,
+    dify_concurrency: int = 0,
+    timings: RunTimings | None = None,
+    pipeline_depth: int = 0,
+    on_chunk=None,
 ):
     """
     1レース処理が完了するたびに (race_num:int, block_text:str) を yield
     app.py 側で逐次表示する用途
-    """
-    place_names = {"10": "大井", "11": "川崎", "12": "船橋", "13": "浦和"}
-    place_name = place_names.get(place_code, "地方")
 
-    baba_map = {"10": "20", "11": "21", "12": "19", "13": "18"}
-    baba_code = baba_map.get(place_code)
-    if not baba_code:
+    workers=1 : 1レースずつ（レース番号順に yield）。既定（pipeline_depth=0）は1レースを最後まで終えてから次へ
+                pipeline_depth>=1 なら取得/プロンプト/Dify/保存を段に分けて重ねる
+                （レースN の Dify 待ちの間にレースN+1 を取得。先読みは pipeline_depth レースまで。
+                  st.* の途中経過は出さない）
+    workers>=2: 複数レースを並列処理し、終わった順に yield
+                （st.* 表示は並列時・パイプライン時は出さない）
+
+    fetch_mode="browser": 競馬ブックの各ページを Chrome で開く（従来）
+    fetch_mode="http"   : ログインだけ Chrome で行い、cookie を移した requests で取る
+                          （Chrome はセッション切れ時の再ログインにだけ使う）
+
+    pooled=True: 毎回 Chrome を起動＆ログインせず、常駐プール（get_driver_pool）から借りる
+    refresh=True: HTML キャッシュを使わず全ページ取り直す
+    dify_refresh=True: 同じプロンプトの回答がキャッシュにあっても Dify を実行し直す
+    incremental=True: 入力（出馬表/談話/調教）が前回と同じレースは Dify を呼ばず前回の回答を返す
+    report: dict を渡すと report[race_num] に {"race_id", "reused", "changes", "prompt_tokens", "missing"} が入る
+            （yield より前に入るので、受け取った時点で参照できる）
+    dify_concurrency>=1: 取得は1レースずつ進めつつ、Dify は asyncio で同時に流して終わった順に yield
+                         （429 が返ると同時実行数を自動で下げる。workers より優先）
+    timings: RunTimings を渡すと段階ごとの所要時間が入る（レース分は yield より前に入る）
+             TIMINGS_LOG_FILE があれば実行の最後に JSON Lines で追記する
+    on_chunk: on_chunk(race_num, text) で Dify の回答を届いた分ずつ受け取る（別スレッドから呼ばれる）
+              逐次表示したいだけなら run_races_events を使う
+    """
+    if place_code not in _BABA_CODES:
         yield (0, "⚠️ babaCode mapping が未定義です。place_code を確認してください。")
         return
 
-    driver = build_driver()
-    wait = WebDriverWait(driver, 12)
+    timings = timings if timings is not None else RunTimings()
+    timings.meta.update({
+        "date": f"{year}{month}{day}", "place_code": place_code, "fetch_mode": fetch_mode,
+        "workers": workers, "dify_concurrency": dify_concurrency, "pooled": pooled,
+    })
 
+    session = None
     try:
-        _ui_info(ui, "🔑 ログイン中...（競馬ブック）")
-        login_keibabook(driver, wait)
+        session = _PageSession(fetch_mode, pooled=pooled, workers=workers, ui=ui, timings=timings)
+        pages = session.pages
+
+        ctx, targets, err = _open_card(
+            pages, year, month, day, place_code, target_races,
+            ui=ui, refresh=refresh, dify_refresh=dify_refresh, incremental=incremental,
+            report=report, timings=timings, on_chunk=on_chunk,
+        )
+        if err:
+            yield (0, err)
+            return
 
-        race_ids = fetch_race_ids_from_schedule(driver, year, month, day, place_code, ui=ui)
-        if not race_ids:
-            yield (0, "⚠️ レースIDが取得できませんでした。日付/競馬場コードを確認してください。")
+        if dify_concurrency > 0 and len(targets) > 1:
+            sched = _AsyncLlmScheduler(get_async_dify_client(dify_concurrency), ui=ui)
+            try:
+                for race_num, race_id in targets:
+                    for _, n, block in sched.start(ctx, pages, race_num, race_id):
+                        yield (n, block)
+                for _, n, block in sched.finish():
+                    yield (n, block)
+            finally:
+                sched.cancel()
             return
 
-        for i, race_id in enumerate(race_ids):
-            race_num = i + 1
-            if target_races is not None and race_num not in target_races:
-                continue
+        if (workers <= 1 and pipeline_depth <= 0) or len(targets) <= 1:
+            for race_num, race_id in targets:
+                block = _run_race_block(ctx, pages, race_num, race_id)
+                yield (race_num, block)
+                _ui_divider(ui)
+            return
 
-            race_num_str = f"{race_num:02}"
+        if workers <= 1:
+            yield from _run_races_pipelined(ctx, pages, targets, depth=pipeline_depth)
+            return
 
-            _ui_markdown(ui, f"## {place_name} {race_num}R")
-            _ui_caption(ui, f"race_id(keibabook): {race_id}")
+        # 並列時はワーカーがそれぞれプールから借りるので、手元の1台も返しておく
+        session.release_lease()
 
-            try:
-                header, keibago_dict, keibago_url = fetch_keibago_debatable_small(
-                    year=str(year),
-                    month=str(month),
-                    day=str(day),
-                    race_no=race_num,
-                    baba_code=str(baba_code),
-                )
-                _ui_caption(ui, f"keiba.go.jp: {keibago_url}")
-                if header:
-                    _ui_caption(ui, f"keiba.go.jp header: {header}")
+        yield from _run_races_parallel(ctx, pages, targets, workers=workers, driver_pool=session.pool)
 
-                if not keibago_dict:
-                    _ui_warning(ui, "⚠️ keiba.go.jp から出馬表が取れませんでした（続行：騎手/調教師が不明になります）")
+    finally:
+        if session is not None:
+            session.close()
+        timings.export_jsonl(TIMINGS_LOG_FILE)
 
-                _ui_info(ui, "📡 データ収集中...（談話）")
-                driver.get(f"https://s.keibabook.co.jp/chihou/danwa/1/{race_id}")
-                try:
-                    wait.until(EC.presence_of_element_located((By.CLASS_NAME, "danwa")))
-                except:
-                    pass
+def run_races_events(*args, **kwargs):
+    """
+    run_races_iter と同じ引数で、Dify の回答を届いた分ずつ流す（app.py の逐次表示用。ui=False で使う）
+      ("chunk", race_num, text) : 回答の増分（同じレースの chunk をつなげたものが途中経過）
+      ("done", race_num, block) : 完成した block_text（run_races_iter が yield するもの）
+                                  途中経過はこれで置き換える（blocking に切り替わった時などは chunk と一致しない）
+    あるレースの chunk は必ずそのレースの done より前に来る。取得/Dify は裏のスレッドで進める
+    """
+    events: queue.Queue = queue.Queue()
+    stop = threading.Event()
 
-                html_danwa = driver.page_source
-                race_meta = parse_race_info(html_danwa)
-                danwa_dict = parse_danwa_comments(html_danwa)
+    def _produce():
+        it = run_races_iter(*args, on_chunk=lambda n, text: events.put(("chunk", n, text)), **kwargs)
+        try:
+            for race_num, block in it:
+                events.put(("done", race_num, block))
+                if stop.is_set():
+                    break
+        except Exception as e:
+            events.put(("done", 0, f"⚠️ Error: {e}"))
+        finally:
+            it.close()
+            events.put(_PIPE_END)
+
+    producer = threading.Thread(target=_produce, name="race-events", daemon=True)
+    producer.start()
+    try:
+        while True:
+            ev = events.get()
+            if ev is _PIPE_END:
+                return
+            yield ev
+    finally:
+        stop.set()
 
-                _ui_info(ui, "📡 データ収集中...（調教）")
-                driver.get(f"https://s.keibabook.co.jp/chihou/cyokyo/1/{race_id}")
-                try:
-                    wait.until(EC.presence_of_element_located((By.CLASS_NAME, "cyokyo")))
-                except:
-                    pass
+class _PageSession:
+    """
+    ログイン済みの取得口（run_races_iter / run_batch_iter が1回の実行の間だけ持つ）
+    fetch_mode="http": HttpPageSource（保存済み cookie があれば Chrome は起動しない）
+    pooled=True      : 常駐プールから借りたブラウザ（http 時は再ログイン用）
+    それ以外          : 自前で Chrome を起動してログイン
+    close() で借りたものを返す / 起動したものを閉じる
+    """
 
-                cyokyo_dict = parse_cyokyo(driver.page_source)
+    def __init__(self, fetch_mode: str, pooled: bool = False, workers: int = 1, ui: bool = False,
+                 timings: RunTimings | None = None):
+        self.pool = get_driver_pool() if pooled else None
+        self.driver = None   # 自前で起動した Chrome（pooled=False）
+        self.lease = None    # プールから借りたブラウザ（pooled=True）
+        timings = timings if timings is not None else RunTimings()
+        try:
+            with timings.span("login") as sp:
+                self.pages = self._open(fetch_mode, workers, ui, sp)
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self, fetch_mode: str, workers: int, ui: bool, sp: dict):
+        pool = self.pool
+        if fetch_mode == "http":
+            pages = HttpPageSource(pool_maxsize=max(workers, 1) * 2, driver_pool=pool)
+            # 保存済み cookie があれば Chrome は起動しない（切れていたら取得時に再ログイン）
+            sp["saved_cookies"] = pages.load_saved_cookies()
+            if not sp["saved_cookies"]:
+                _ui_info(ui, "🔑 ログイン中...（競馬ブック）")
+                if pool is not None:
+                    with pool.lease() as bp:
+                        pages.adopt_driver_cookies(bp.driver)
+                else:
+                    pages.relogin()
+            return pages
+        if pool is not None:
+            _ui_info(ui, "🔑 ログイン済みブラウザを準備中...（競馬ブック）")
+            self.lease = pool.checkout()
+            return self.lease
+        self.driver = build_driver()
+        wait = _driver_wait(self.driver, 12)
+        _ui_info(ui, "🔑 ログイン中...（競馬ブック）")
+        login_keibabook(self.driver, wait)
+        return BrowserPageSource(self.driver, wait)
+
+    def release_lease(self):
+        if self.lease is not None:
+            self.pool.checkin(self.lease)
+            self.lease = None
+
+    def close(self):
+        self.release_lease()
+        if self.driver is not None:
+            _quit_quietly(self.driver)
+            self.driver = None
+
+def _open_card(
+    pages, year: str, month: str, day: str, place_code: str, target_races: set[int] | None,
+    ui: bool = False, refresh: bool = False, dify_refresh: bool = False, incremental: bool = False,
+    report: dict | None = None, timings: RunTimings | None = None, on_chunk=None, batch_job: BatchJob | None = None,
+):
+    """
+    1開催ぶんの準備：日程 → 対象レース → keiba.go.jp 出馬表の先読み
+    return: (ctx, targets, error)（error が入っていたら ctx/targets は使わない）
+    """
+    baba_code = _BABA_CODES.get(place_code)
+    if not baba_code:
+        return None, [], "⚠️ babaCode mapping が未定義です。place_code を確認してください。"
+    timings = timings if timings is not None else RunTimings()
+
+    with timings.span("schedule"):
+        races = fetch_schedule_races(
+            pages, year, month, day, place_code, ui=ui, refresh=refresh, target_races=target_races,
+        )
+    if not races:
+        return None, [], "⚠️ レースIDが取得できませんでした。日付/競馬場コードを確認してください。"
+
+    targets = _select_target_race_ids(races, target_races)
+
+    # keiba.go.jp の出馬表は最初に全レース分まとめて取っておく
+    with timings.span("keibago_prefetch"):
+        keibago_pre = prefetch_keibago_debatables(
+            year, month, day, [n for n, _ in targets], baba_code, refresh=refresh, timings=timings,
+        )
+    ctx = _RaceRunContext(
+        year=year, month=month, day=day,
+        place_code=place_code, place_name=PLACE_NAMES.get(place_code, "地方"), baba_code=baba_code,
+        ui=ui, refresh=refresh, dify_refresh=dify_refresh, incremental=incremental,
+        report=report, keibago_pre=keibago_pre, timings=timings, on_chunk=on_chunk, batch_job=batch_job,
+    )
+    return ctx, targets, None
 
-                all_uma = sorted(
-                    set(danwa_dict.keys()) | set(cyokyo_dict.keys()) | set(keibago_dict.keys()),
-                    key=lambda x: int(x) if str(x).isdigit() else 999,
-                )
+# ==================================================
+# 並列実行：レース単位でワーカーに振り分け、終わった順に yield
+# ==================================================
+def _run_races_parallel(
+    ctx: _RaceRunContext,
+    pages,
+    targets: list[tuple[int, str]],
+    workers: int,
+    driver_pool: DriverPool | None = None,
+):
+    """
+    HttpPageSource はスレッドセーフなので全ワーカーで共有する。
+    BrowserPageSource（Selenium の driver）はスレッド間で共有できないので、
+    driver_pool があればそこから借り、無ければログイン済み driver をキューで貸し出す
+    （足りなければワーカー側で起動＆ログイン）。
+    呼び出し元の pages もキューに入れて再利用する（quit は呼び出し元の責務）。
+    """
+    n_workers = min(workers, len(targets))
+    shared = isinstance(pages, HttpPageSource)
+    idle_pages: queue.Queue = queue.Queue()
+    if driver_pool is None:
+        idle_pages.put(pages)
+
+    # st.* はスクリプトスレッド以外から呼べないのでワーカー側は ui=False
+    worker_ctx = replace(ctx, ui=False)
+
+    spawned = []
+    spawned_lock = threading.Lock()
+
+    def _checkout():
+        if shared:
+            return pages
+        if driver_pool is not None:
+            return driver_pool.checkout()
+        try:
+            return idle_pages.get_nowait()
+        except queue.Empty:
+            pass
+        d = build_driver()
+        with spawned_lock:
+            spawned.append(d)
+        p = BrowserPageSource(d)
+        login_keibabook(d, p.wait)
+        return p
+
+    def _work(race_num: int, race_id: str) -> str:
+        try:
+            p = _checkout()
+        except Exception as e:
+            return ctx.error_block(race_num, f"⚠️ Error: {e}")
+        try:
+            return _run_race_block(worker_ctx, p, race_num, race_id)
+        finally:
+            if shared:
+                pass
+            elif driver_pool is not None:
+                driver_pool.checkin(p)
+            else:
+                idle_pages.put(p)
+
+    _ui_info(ctx.ui, f"⚡ {len(targets)} レースを {n_workers} 並列で処理中...（終わった順に表示）")
+
+    # 共有リソースはワーカーより先にここで作っておく
+    get_http_session()
+    get_supabase_client()
+    get_history_writer()
+    get_html_cache()
+    get_dify_cache()
+    get_race_state_store()
+    get_race_archive()
+
+    executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="race")
+    try:
+        futures = {executor.submit(_work, race_num, race_id): race_num for race_num, race_id in targets}
+        for fut in as_completed(futures):
+            yield (futures[fut], fut.result())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for d in spawned:
+            _quit_quietly(d)
 
-                merged_text = []
-                for uma in all_uma:
-                    kg = keibago_dict.get(uma, {})
-                    horse = kg.get("horse", "")
-                    jockey = kg.get("jockey", "不明")
-                    trainer = kg.get("trainer", "不明")
-                    prev_jockey = kg.get("prev_jockey", "")
-                    is_change = kg.get("is_change", False)
-
-                    alert = "【⚠️乗り替わり】" if is_change else ""
-                    if prev_jockey:
-                        alert += f"（前走:{prev_jockey}）"
-
-                    d = danwa_dict.get(uma, "（なし）")
-                    c = cyokyo_dict.get(uma, "（なし）")
-
-                    merged_text.append(
-                        f"▼[馬番{uma}] 馬名:{horse} 騎手:{jockey} {alert} 調教師:{trainer}\n"
-                        f"談話: {d}\n"
-                        f"調教: {c}"
-                    )
-
-                if not merged_text:
-                    block = f"【{place_name} {race_num}R】\n⚠️ データなしのためスキップ"
-                    yield (race_num, block)
-                    _ui_warning(ui, "データなしのためスキップ")
-                    _ui_divider(ui)
-                    continue
+# ==================================================
+# パイプライン：取得/統合 → プロンプト → Dify → 保存 を段に分けて重ねる
+# ==================================================
+_PIPE_END = object()
 
-                prompt = (
-                    f"レース名: {race_meta.get('race_name','')}\n"
-                    f"条件: {race_meta.get('cond','')}\n\n"
-                    "以下の各馬のデータ（馬名、騎手、乗り替わり、調教師、談話、調教）です。\n"
-                    + "\n".join(merged_text)
-                )
+# 途中で止めた時に段のスレッドを待つ上限（秒）。取得中の1ページなどは待たずに捨てる
+_PIPE_STOP_WAIT_S = 2.0
 
-                _ui_info(ui, "🤖 AI分析中...（Dify）")
-                full_ans = run_dify_with_fallback(prompt)
+def _pipe_put(q: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
 
-                full_ans = (full_ans or "").strip()
-                if full_ans == "":
-                    full_ans = "⚠️ AIの出力が空でした（Dify応答なし/エラーの可能性）"
+def _pipe_stage(ctx: _RaceRunContext, fn, q_in: queue.Queue, q_out: queue.Queue, stop: threading.Event):
+    """q_in から job を受けて fn(job) を実行し q_out に流す（block が入った job は素通り）"""
+    while not stop.is_set():
+        try:
+            job = q_in.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if stop.is_set():
+            return
+        if job is not _PIPE_END and job["block"] is None:
+            try:
+                fn(job)
+            except Exception as e:
+                job["block"] = ctx.error_block(job["race_num"], f"⚠️ Error: {e}")
+                ctx.race_done(job)
+        _pipe_put(q_out, job, stop)
+        if job is _PIPE_END:
+            return
 
-                _ui_success(ui, "✅ 完了")
+def _run_races_pipelined(ctx: _RaceRunContext, pages, targets: list[tuple[int, str]], depth: int = 2):
+    """
+    1レースずつ（並列にはしない）だが、段ごとに別スレッドで動かして段の間を長さ depth のキューでつなぐ：
+        取得/統合（pages） → プロンプト作成 → Dify → 保存（history / 入力指紋）
+    レースN の Dify を待っている間にレースN+1 の取得が進む（取得が先に進めるのは depth レースまで）。
+    yield はレース番号順（終わった順ではない）
+    """
+    # st.* はスクリプトスレッド以外から呼べないので各段は ui=False
+    worker_ctx = replace(ctx, ui=False)
+    stop = threading.Event()
+    q_prompt, q_dify, q_persist = (queue.Queue(maxsize=max(depth, 1)) for _ in range(3))
+    q_done: queue.Queue = queue.Queue()
+
+    def _fetch():
+        for race_num, race_id in targets:
+            if stop.is_set():
+                return
+            _pipe_put(q_prompt, _fetch_race(worker_ctx, pages, race_num, race_id), stop)
+        _pipe_put(q_prompt, _PIPE_END, stop)
+
+    def _dify(job):
+        # 止められたら回答を待たない（中断した回答は stop で次の段に渡らないので保存されない）
+        job["answer"] = _run_race_dify(worker_ctx, job, cancel=stop)
+
+    def _persist(job):
+        job["block"] = _finish_race(worker_ctx, job, job.pop("answer", ""))
+
+    _ui_info(ctx.ui, f"⚡ {len(targets)} レースを取得とAI分析を重ねて処理中...")
+
+    # 共有リソースは段のスレッドより先にここで作っておく
+    get_http_session()
+    get_history_writer()
+    get_html_cache()
+    get_dify_cache()
+    get_race_state_store()
+    get_race_archive()
+
+    threads = [
+        threading.Thread(target=_fetch, name="pipe-fetch", daemon=True),
+        threading.Thread(target=_pipe_stage, args=(worker_ctx, lambda job: _build_race_prompt(worker_ctx, job),
+                                                   q_prompt, q_dify, stop), name="pipe-prompt", daemon=True),
+        threading.Thread(target=_pipe_stage, args=(worker_ctx, _dify, q_dify, q_persist, stop),
+                         name="pipe-dify", daemon=True),
+        threading.Thread(target=_pipe_stage, args=(worker_ctx, _persist, q_persist, q_done, stop),
+                         name="pipe-persist", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    order = [race_num for race_num, _ in targets]
+    done: dict[int, str] = {}
+    try:
+        for race_num in order:
+            while race_num not in done:
+                job = q_done.get()
+                if job is _PIPE_END:
+                    # 途中の段が止まった（通常は来ない）：残りはエラーにする
+                    for n in order:
+                        done.setdefault(n, ctx.error_block(n, "⚠️ Error: パイプラインが途中で止まりました"))
+                    break
+                done[job["race_num"]] = job["block"]
+            yield (race_num, done.pop(race_num))
+    finally:
+        # 途中で止めた時（受け取り側が break した等）は段を止めて少しだけ待つ。
+        # Dify は cancel で即座に返るので、残るのは取得中の1ページくらい（daemon なので待たずに捨てる）
+        stop.set()
+        deadline = time.monotonic() + _PIPE_STOP_WAIT_S
+        for t in threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+
+# ==================================================
+# 非同期 LLM：取得は順番に、Dify は AsyncDifyClient で同時に流す
+# ==================================================
+def _future_answer(fut: Future) -> str:
+    try:
+        return fut.result()
+    except Exception as e:
+        return f"⚠️ Dify API Error: {e}"
 
-                save_history(year, place_code, place_name, month, day, race_num_str, race_id, full_ans)
+class _AsyncLlmScheduler:
+    """
+    レースN の Dify を投げたらすぐレースN+1 の取得に進む（開催をまたいでもよい）。
+    Dify の同時実行数は client 側（429 を見て自動調整）で抑える。
+    start / finish は終わった分を (ctx, race_num, block_text) で返す（保存・表示は呼び出し側のスレッド）
+    使い終わったら cancel() で残りを取り消す
+    """
 
-                block = f"【{place_name} {race_num}R】\n{full_ans}"
-                yield (race_num, block)
+    def __init__(self, client: AsyncDifyClient, ui: bool = False):
+        self.client = client
+        self.pending: dict[Future, tuple[_RaceRunContext, dict]] = {}
+        _ui_info(ui, f"⚡ AI分析を最大 {client.limiter.limit} 本同時に実行します（終わった順に表示）")
+
+    def start(self, ctx: _RaceRunContext, pages, race_num: int, race_id: str):
+        job = _prepare_race(ctx, pages, race_num, race_id)
+        if job["block"] is not None:
+            yield (ctx, race_num, job["block"])
+        else:
+            job["dify_stats"] = {}
+            job["dify_t0"] = time.perf_counter()
+            fut = submit_dify_cached(
+                self.client, job["prompt"], refresh=ctx.dify_refresh, stats=job["dify_stats"],
+                on_chunk=ctx.chunk_sink(race_num),
+            )
+            # 完了時刻は drain を待たずに取る（取得中に終わっていても Dify の時間だけを残す）
+            fut.add_done_callback(lambda f, job=job: job.setdefault("dify_t1", time.perf_counter()))
+            self.pending[fut] = (ctx, job)
+
+        # 取得の合間に、終わった分を先に返す
+        yield from self._drain(block=False)
+
+    def finish(self):
+        while self.pending:
+            yield from self._drain(block=True)
+
+    def cancel(self):
+        for f in self.pending:
+            f.cancel()
+        self.pending.clear()
+
+    def _drain(self, block: bool):
+        if not self.pending:
+            return
+        if block:
+            done, _ = wait_futures(list(self.pending), return_when=FIRST_COMPLETED)
+        else:
+            done = [f for f in self.pending if f.done()]
+        for f in done:
+            ctx, job = self.pending.pop(f)
+            ctx.dify_done(job["race_num"], job["dify_t0"], job.get("dify_t1") or time.perf_counter(), job["dify_stats"])
+            yield (ctx, job["race_num"], _finish_race(ctx, job, _future_answer(f)))
+
+# ==================================================
+# バッチ：複数開催（日付×競馬場）をまとめて実行
+# ==================================================
+@dataclass(frozen=True)
+class BatchJob:
+    """1開催ぶんの指定。target_races=None なら全レース"""
+    year: str
+    month: str
+    day: str
+    place_code: str
+    target_races: frozenset[int] | None = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.year}{self.month}{self.day}_{self.place_code}"
+
+    @property
+    def place_name(self) -> str:
+        return PLACE_NAMES.get(self.place_code, "地方")
+
+def date_range(start: str, end: str) -> list[str]:
+    """"YYYYMMDD" の start〜end（両端含む）"""
+    d0 = datetime.strptime(start, "%Y%m%d").date()
+    d1 = datetime.strptime(end, "%Y%m%d").date()
+    return [(d0 + timedelta(days=i)).strftime("%Y%m%d") for i in range((d1 - d0).days + 1)]
+
+def batch_jobs(dates, place_codes, target_races: set[int] | None = None) -> list[BatchJob]:
+    """
+    dates（"YYYYMMDD" の並び）× place_codes の全組み合わせ
+    （開催の無い日/場は実行時に「レースIDが取得できませんでした」になるだけ）
+    """
+    races = frozenset(target_races) if target_races else None
+    return [
+        BatchJob(d[:4], d[4:6], d[6:8], str(pc), races)
+        for d in dates
+        for pc in place_codes
+    ]
+
+def run_batch_iter(
+    jobs: list[BatchJob],
+    fetch_mode: str = "http",
+    pooled: bool = False,
+    dify_concurrency: int = 4,
+    refresh: bool = False,
+    dify_refresh: bool = False,
+    incremental: bool = False,
+    report: dict | None = None,
+    timings: RunTimings | None = None,
+):
+    """
+    複数開催を1つのログイン済みセッション（HTTP なら requests、browser なら Chrome 1台）で続けて処理し、
+    1レース終わるたびに (job, race_num, block_text, ok) を yield する（history への保存は1レースごと）
+    ok=False は取得エラー/データなし/Dify エラー（block_text の中身では判定しない。回答に ⚠️ が入ることがある）
+
+    取得は開催をまたいで1レースずつ順番に進め、Dify は dify_concurrency 本まで同時に流す
+    （前の開催の Dify を待たずに次の開催の日程/出馬表を取りに行く）。
+    dify_concurrency=0 なら開催ごとに run_races_iter と同じパイプライン（取得と Dify を1レースずらして重ねる）
+    開催ごとの失敗（日程が取れない等）は (job, 0, "⚠️ ...", False) を返して次の開催に進む
+
+    report : dict を渡すと report[job.key][race_num] に run_races_iter と同じ情報が入る
+    timings: run_races_iter と同じ RunTimings。開催ごとの span には "job"（job.key）/ "date" / "place_code" が付く
+             （timings.scoped(job=job.key) で1開催ぶんだけを見られる。ログインは job なし）
+    """
+    timings = timings if timings is not None else RunTimings()
+    timings.meta.update({
+        "batch": True, "fetch_mode": fetch_mode, "jobs": len(jobs), "dify_concurrency": dify_concurrency,
+        "pooled": pooled,
+    })
+
+    session = None
+    sched = None
+    try:
+        session = _PageSession(fetch_mode, pooled=pooled, ui=False, timings=timings)
+        if dify_concurrency > 0:
+            sched = _AsyncLlmScheduler(get_async_dify_client(dify_concurrency))
 
+        for job in jobs:
+            job_t = timings.scoped(job=job.key, date=f"{job.year}{job.month}{job.day}", place_code=job.place_code)
+            job_report = report.setdefault(job.key, {}) if report is not None else None
+            try:
+                ctx, targets, err = _open_card(
+                    session.pages, job.year, job.month, job.day, job.place_code,
+                    set(job.target_races) if job.target_races else None,
+                    refresh=refresh, dify_refresh=dify_refresh, incremental=incremental,
+                    report=job_report, timings=job_t, batch_job=job,
+                )
             except Exception as e:
-                block = f"【{place_name} {race_num}R】\n⚠️ Error: {e}"
-                yield (race_num, block)
-                _ui_error(ui, f"Error: {e}")
+                ctx, targets, err = None, [], f"⚠️ Error: {e}"
+            if err:
+                yield (job, 0, f"【{job.place_name} {job.year}/{job.month}/{job.day}】\n{err}", False)
+                continue
 
-            _ui_divider(ui)
+            if sched is None:
+                for race_num, block in _run_races_pipelined(ctx, session.pages, targets):
+                    yield (job, race_num, block, ctx.ok(race_num))
+                continue
+            for race_num, race_id in targets:
+                for done_ctx, n, block in sched.start(ctx, session.pages, race_num, race_id):
+                    yield (done_ctx.batch_job, n, block, done_ctx.ok(n))
+
+        if sched is not None:
+            for done_ctx, n, block in sched.finish():
+                yield (done_ctx.batch_job, n, block, done_ctx.ok(n))
 
     finally:
-        try:
-            driver.quit()
-        except:
-            pass
+        if sched is not None:
+            sched.cancel()
+        if session is not None:
+            session.close()
+        timings.export_jsonl(TIMINGS_LOG_FILE)
@@ -0,0 +1,17 @@
+"""
+FixtureSet の保存 / 読み込み
+"""
+from bench.fixtures import FixtureSet, synthetic
+
+
+def test_load_keeps_keibago_race_numbers(tmp_path):
+    fx = synthetic(races=3, horses=4)
+    # 日程に抜けがある / 1 から始まらない開催（record.py は日程のレース番号で保存する）
+    fx.keibago = {no: fx.keibago[i] for i, no in zip((1, 2, 3), (2, 5, 11))}
+    fx.save(str(tmp_path))
+
+    loaded = FixtureSet.load(str(tmp_path))
+
+    assert loaded.keibago == fx.keibago
+    assert loaded.danwa == fx.danwa and loaded.cyokyo == fx.cyokyo
+    assert loaded.source == fx.source
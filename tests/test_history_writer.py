@@ -0,0 +1,101 @@
+"""
+HistoryWriter の失敗の扱い：悪い行だけを捨てる / 認証エラーは spool に退避する
+"""
+import json
+
+import pytest
+
+import keiba_bot as kb
+
+
+class FakeAPIError(Exception):
+    """postgrest の APIError と同じく code（SQLSTATE / PGRST*** / HTTP ステータス）を持つ"""
+
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.code = code
+
+
+class FakeSupabase:
+    """insert(rows).execute() で、fail(rows) が返した例外を投げる（None なら通す）"""
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.inserted = []
+        self.calls = 0
+
+    def table(self, name):
+        assert name == "history"
+        return self
+
+    def insert(self, rows):
+        self._rows = list(rows)
+        return self
+
+    def execute(self):
+        self.calls += 1
+        err = self.fail(self._rows)
+        if err is not None:
+            raise err
+        self.inserted.extend(self._rows)
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    def make(fail):
+        client = FakeSupabase(fail)
+        monkeypatch.setattr(kb, "get_supabase_client", lambda: client)
+        w = kb.HistoryWriter(str(tmp_path / "spool.jsonl"), flush_interval=0.05, max_retries=0)
+        w.client = client
+        return w
+
+    made = []
+    yield lambda fail: made.append(make(fail)) or made[-1]
+    for w in made:
+        w.close(timeout=1)
+
+
+def _rows(n):
+    return [{"race_id": f"r{i}", "output": f"answer {i}"} for i in range(n)]
+
+
+def _spooled(w):
+    try:
+        with open(w.spool_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def test_row_error_drops_only_bad_rows(writer):
+    bad = {"r3", "r7"}
+    w = writer(lambda rows: FakeAPIError("23502") if any(r["race_id"] in bad for r in rows) else None)
+    rows = _rows(10)
+
+    w._send(rows)
+
+    assert [r["race_id"] for r in w.client.inserted] == [r["race_id"] for r in rows if r["race_id"] not in bad]
+    assert (w.sent, w.dropped, w.spooled) == (8, 2, 0)
+    assert _spooled(w) == []
+
+
+@pytest.mark.parametrize("code", ["401", "403", "PGRST301"])
+def test_auth_error_spools_batch(writer, code):
+    w = writer(lambda rows: FakeAPIError(code))
+    rows = _rows(3)
+
+    w._send(rows)
+
+    assert w.client.calls == 1
+    assert (w.sent, w.dropped, w.spooled) == (0, 0, 3)
+    assert _spooled(w) == rows
+
+
+@pytest.mark.parametrize("code, kind", [
+    ("23505", "row"), ("22P02", "row"),
+    ("401", "auth"), ("403", "auth"), ("PGRST301", "auth"),
+    ("400", "permanent"), ("404", "permanent"), ("PGRST204", "permanent"), ("42P01", "permanent"),
+    ("408", "transient"), ("429", "transient"), ("503", "transient"), ("", "transient"),
+])
+def test_history_error_kind(code, kind):
+    assert kb._history_error_kind(FakeAPIError(code)) == kind
@@ -0,0 +1,42 @@
+"""
+競馬ブックのページ取得：セッション切れの判定
+"""
+import pytest
+
+import keiba_bot as kb
+
+HEADER = '<header><a href="/login/login">ログイン</a></header>'
+
+
+@pytest.mark.parametrize("body", [
+    '<table class="danwa">',
+    '<table class="danwa default">',
+    "<table class='wide danwa'>",
+    "<table class=danwa>",
+    '<table CLASS="danwa">',
+])
+def test_expected_class_means_logged_in(body):
+    assert not kb._looks_logged_out(HEADER + body, "", "danwa")
+
+
+@pytest.mark.parametrize("body", [
+    '<table class="danwa_sub">',
+    '<table class="pre-danwa">',
+    '<div data-class="danwa">',
+    "<p>danwa</p>",
+])
+def test_missing_class_with_login_link_means_logged_out(body):
+    assert kb._looks_logged_out(HEADER + body, "", "danwa")
+
+
+def test_login_form_means_logged_out():
+    assert kb._looks_logged_out('<table class="danwa"><input name="login_id">', "", "danwa")
+    assert kb._looks_logged_out("", "https://s.keibabook.co.jp/login/login", None)
+
+
+def test_page_source_requires_live_fetch():
+    class Incomplete(kb._PageSource):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,93 @@
+"""
+どのパーサのバックエンド（HTML_PARSER）でも、ページから取れる内容が html.parser と同じであること
+
+bench/fixtures/ の下の録ったカード（record.py）全部と、合成カードの全ページで確かめる。
+録ったページが無い間は、合成ページを崩したもの（bench.parity.MALFORMED：閉じタグ抜け / tbody 無し /
+余計な </div>）でも比べる。lxml 系がずれると分かっている崩れは xfail（strict）で残す。
+"""
+import os
+
+import pytest
+
+import keiba_bot as kb
+from bench.fixtures import FixtureSet, recorded_fixture_dirs, synthetic
+from bench.parity import MALFORMED, extract
+
+
+def _cards() -> list[tuple[str, FixtureSet]]:
+    cards = [(os.path.basename(d), FixtureSet.load(d)) for d in recorded_fixture_dirs()]
+    cards.append(("synthetic", synthetic(races=3, horses=14, seed=1)))
+    return cards
+
+
+PAGES = [
+    pytest.param(kind, html, id=f"{name}-{kind}-{i}")
+    for name, fx in _cards()
+    for kind, pages in fx.pages_by_kind().items()
+    for i, html in enumerate(pages)
+]
+
+MALFORMED_PAGES = [
+    pytest.param(variant, kind, MALFORMED[variant](pages[0]), id=f"{name}-{variant}-{kind}")
+    for name, fx in _cards()
+    for variant in MALFORMED
+    for kind, pages in fx.pages_by_kind().items()
+    if pages
+]
+
+# 閉じていない <td>/<tr>：html.parser は次のセルを前のセルの中に入れ、lxml は閉じて兄弟にする
+# （談話で html.parser は {'2': '...'} だけ / lxml は全頭、など）。lxml 系を既定にしない理由
+LXML_DIVERGES = {
+    ("unclosed_td", "danwa"), ("unclosed_td", "cyokyo"), ("unclosed_td", "keibago"),
+    ("unclosed_tr", "danwa"), ("unclosed_tr", "cyokyo"),
+    ("unclosed_td_tr", "danwa"), ("unclosed_td_tr", "cyokyo"), ("unclosed_td_tr", "keibago"),
+}
+
+# 既定（html.parser）で崩れていないページと同じ内容が取れるもの
+RECOVERABLE = ("unclosed_p", "no_tbody", "stray_div")
+
+BACKENDS = [
+    pytest.param(
+        backend,
+        marks=pytest.mark.skipif(builder == "lxml" and not kb._lxml_available(), reason="lxml が入っていない"),
+    )
+    for backend, (builder, _) in kb._PARSER_BACKENDS.items()
+    if backend != "html.parser"
+]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("kind, html", PAGES)
+def test_backend_matches_html_parser(kind, html, backend):
+    expected = extract(kb, kind, html, "html.parser")
+    assert extract(kb, kind, html, backend) == expected
+
+
+@pytest.mark.parametrize("kind, html", PAGES)
+def test_reference_extraction_is_not_empty(kind, html):
+    """空同士の一致で通らないように、基準（html.parser）が何か取れていること"""
+    got = extract(kb, kind, html, "html.parser")
+    if kind == "danwa":
+        assert got["danwa"]
+    elif kind == "cyokyo":
+        assert got["training"]
+    elif kind == "keibago":
+        assert got[1]
+    else:
+        assert got
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("variant, kind, html", MALFORMED_PAGES)
+def test_backend_matches_html_parser_on_malformed(variant, kind, html, backend, request):
+    if kb._PARSER_BACKENDS[backend][0] == "lxml" and (variant, kind) in LXML_DIVERGES:
+        request.applymarker(pytest.mark.xfail(strict=True, reason="閉じていない td/tr は lxml と木が変わる"))
+    assert extract(kb, kind, html, backend) == extract(kb, kind, html, "html.parser")
+
+
+@pytest.mark.parametrize("variant", RECOVERABLE)
+@pytest.mark.parametrize("kind", ["schedule", "danwa", "cyokyo", "keibago"])
+def test_default_backend_recovers(variant, kind):
+    fx = synthetic(races=1, horses=8, seed=2)
+    html = fx.pages_by_kind()[kind][0]
+    assert extract(kb, kind, MALFORMED[variant](html), "html.parser") == extract(kb, kind, html, "html.parser")
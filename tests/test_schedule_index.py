@@ -0,0 +1,76 @@
+"""
+日程の索引キャッシュ：公開途中の索引を1日残さない
+"""
+import pytest
+
+import keiba_bot as kb
+
+
+def _schedule(races: dict[int, str], numbered: bool = True) -> str:
+    links = "".join(
+        f'<li><a href="/chihou/syutuba/{rid}">{f"{no}R" if numbered else "出馬表"}</a></li>'
+        for no, rid in races.items()
+    )
+    return f"<html><body><ul>{links}</ul></body></html>"
+
+
+def _rid(no: int) -> str:
+    return f"20250110150101{no:02d}"   # rid[6:8] が場コード（大井 = 10）
+
+
+class FakePages:
+    """get_html を呼ばれるたびに htmls を順に返す"""
+
+    def __init__(self, *htmls):
+        self.htmls = list(htmls)
+        self.calls = []
+
+    def get_html(self, url, ready=None, timeout=None, refresh=False):
+        self.calls.append(refresh)
+        return self.htmls[min(len(self.calls), len(self.htmls)) - 1]
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(tmp_path, monkeypatch):
+    index_cache = kb.ScheduleIndexCache(ttl=3600)
+    html_cache = kb.HtmlCache(str(tmp_path / "html"), 1024 * 1024)
+    monkeypatch.setattr(kb, "get_schedule_index_cache", lambda: index_cache)
+    monkeypatch.setattr(kb, "get_html_cache", lambda: html_cache)
+
+
+def test_full_index_is_cached():
+    pages = FakePages(_schedule({n: _rid(n) for n in range(1, 4)}))
+    for _ in range(2):
+        races = kb.fetch_schedule_races(pages, "2025", "01", "15", "10", target_races={1, 2, 3})
+    assert races == [(n, _rid(n)) for n in range(1, 4)]
+    assert pages.calls == [False]
+
+
+def test_missing_requested_race_refetches_once():
+    partial = _schedule({1: _rid(1), 2: _rid(2)})
+    full = _schedule({n: _rid(n) for n in range(1, 5)})
+    pages = FakePages(partial, full)
+
+    races = kb.fetch_schedule_races(pages, "2025", "01", "15", "10", target_races={4})
+
+    assert (4, _rid(4)) in races
+    assert pages.calls == [False, True]
+
+
+def test_still_missing_race_is_not_cached():
+    pages = FakePages(_schedule({1: _rid(1)}))
+
+    kb.fetch_schedule_races(pages, "2025", "01", "15", "10", target_races={2})
+    kb.fetch_schedule_races(pages, "2025", "01", "15", "10", target_races={1})
+
+    # 1回目は取り直しまで、2回目は残していないので取りに行く
+    assert pages.calls == [False, True, False]
+
+
+def test_positional_index_is_not_cached():
+    pages = FakePages(_schedule({n: _rid(n) for n in range(1, 4)}, numbered=False))
+
+    kb.get_schedule_index(pages, "2025", "01", "15")
+    kb.get_schedule_index(pages, "2025", "01", "15")
+
+    assert len(pages.calls) == 2